@@ -1,13 +1,46 @@
+import asyncio
+import base64
+import csv
+import hashlib
+import hmac
+import io
 import os
+import re
+import unicodedata
+from contextlib import AsyncExitStack
+from decimal import Decimal
 from typing import List, Optional
-import requests
+from urllib.parse import urlparse
 import json
-import socket
-from fastapi import FastAPI, HTTPException
+import threading
+import time
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from pydantic import parse_obj_as
 from pydantic import BaseModel
 from sqlalchemy import create_engine, text
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 from dotenv import load_dotenv
+import numpy as np
+
+import metrics
+from columnar import ColumnarTable
+from cube import CUBE_TABLE, SOURCE_TABLE as CUBE_SOURCE_TABLE, CubeInfo, build_cube, load_cube_info
+from flags import FLAG_COLUMNS, TRUTH_VALUES, flag_sum_sql, normalized_flags
+from hospitalization import build_tree as build_hospitalization_tree, parse_edges as parse_hospitalization_edges
+from nl_sql_cache import TranslationCache
+from response_cache import CacheEntry, ResponseCache, etag_matches
+from result_cache import ResultCache, cache_key as result_cache_key, read_data_versions
+from sankey import SankeyCube
+from serialization import (MEDIA_TYPES, CompressionMiddleware, arrow_stream, available as format_available, compress,
+                           dumps_json, dumps_msgpack, loads_json, negotiate_encoding, negotiate_format)
+from sql_guard import add_execution_time_hint, check_budget, explain_cost, install_statement_timeout, is_timeout
+from shared_snapshot import SnapshotStore, pack_water, unpack_water
+from trend import DEFAULT_WINDOW as TREND_DEFAULT_WINDOW, MAX_WINDOW as TREND_MAX_WINDOW, METRICS as TREND_METRICS, TrendCube
+from upstream import UpstreamClient
+from water_pca import WaterMatrix, WaterStats, compute_scores, read_csv as read_water_csv
 
 load_dotenv()
 
@@ -18,6 +51,28 @@ if not DB_URL:
 
 engine = create_engine(DB_URL, pool_pre_ping=True)
 
+# 可选的异步数据库路径：设置 DB_ASYNC_URL（例如 mysql+aiomysql://... 或 sqlite+aiosqlite:///...），
+# 或设置 DB_ASYNC=1 由 DB_URL 推导异步驱动。启用后聚合端点在事件循环上等待数据库，
+# region_analysis 的各条汇总查询并发执行，不再占用线程池。
+ASYNC_DRIVERS = {'mysql+pymysql': 'mysql+aiomysql', 'mysql': 'mysql+aiomysql',
+                 'sqlite': 'sqlite+aiosqlite', 'sqlite+pysqlite': 'sqlite+aiosqlite'}
+DB_ASYNC_URL = os.environ.get('DB_ASYNC_URL')
+if not DB_ASYNC_URL and (os.environ.get('DB_ASYNC') or '').strip().lower() in ('1', 'true', 'yes'):
+    _scheme, _, _rest = DB_URL.partition('://')
+    if _scheme not in ASYNC_DRIVERS:
+        raise RuntimeError(f'无法为 {_scheme} 推导异步驱动，请直接设置 DB_ASYNC_URL')
+    DB_ASYNC_URL = f'{ASYNC_DRIVERS[_scheme]}://{_rest}'
+
+async_engine = None
+if DB_ASYNC_URL:
+    from sqlalchemy.ext.asyncio import create_async_engine
+    _pool_kwargs = {}
+    if not DB_ASYNC_URL.startswith('sqlite'):
+        # SQLite（aiosqlite，本地测试用）默认不使用连接池，不接受这些参数
+        _pool_kwargs = {'pool_size': int(os.environ.get('DB_ASYNC_POOL_SIZE') or 10),
+                        'max_overflow': int(os.environ.get('DB_ASYNC_MAX_OVERFLOW') or 10)}
+    async_engine = create_async_engine(DB_ASYNC_URL, pool_pre_ping=True, **_pool_kwargs)
+
 app = FastAPI(title='Map Data API')
 
 # 省级近似经纬度中心（用于当数据库没有经纬度列时，后端填充）
@@ -81,30 +136,540 @@ class LocationCounts(BaseModel):
     counts: Optional[dict] = {}
 
 
+# ---------- 响应压缩 ----------
+# 不小于 COMPRESSION_MIN_BYTES 的完整响应按 Accept-Encoding 压缩（br 优先，其次 gzip；0 表示关闭）。
+# 必须先于下面的 http 中间件注册（位于其内层）：外层中间件转发的响应体总是分块的，会被当作流式响应跳过。
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES') or 1024)
+if COMPRESSION_MIN_BYTES > 0:
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_BYTES)
+
+
+# ---------- 请求指标（Server-Timing 与 /metrics，见 metrics.py） ----------
+# 每个请求的查询次数、数据库耗时、返回行数与取连接耗时写入 Server-Timing 响应头，
+# 并按路由累计为 Prometheus 直方图；三个 AI 端点的上游耗时按端点单独统计。
+# 流式响应只统计到响应头发出为止（流式上游请求记为上游返回响应头的耗时）。
+metrics.instrument_engine(engine)
+if async_engine is not None:
+    metrics.instrument_engine(async_engine.sync_engine)
+
+REQUEST_SECONDS = metrics.Histogram('http_request_duration_seconds', 'Request latency until the response starts.',
+                                    metrics.LATENCY_BUCKETS, ('route', 'method', 'status'))
+DB_QUERIES = metrics.Histogram('db_queries_per_request', 'Database statements executed per request.',
+                               metrics.COUNT_BUCKETS, ('route',))
+DB_SECONDS = metrics.Histogram('db_time_seconds', 'Time spent executing database statements per request.',
+                               metrics.LATENCY_BUCKETS, ('route',))
+DB_ROWS = metrics.Histogram('db_rows_per_request', 'Rows returned by the database per request.',
+                            metrics.ROW_BUCKETS, ('route',))
+DB_POOL_SECONDS = metrics.Histogram('db_pool_checkout_seconds', 'Time spent checking out pooled connections per request.',
+                                    metrics.LATENCY_BUCKETS, ('route',))
+UPSTREAM_SECONDS = metrics.Histogram('llm_upstream_seconds', 'Upstream LLM call latency (time to headers when streaming).',
+                                     metrics.LATENCY_BUCKETS, ('endpoint', 'status'))
+_HISTOGRAMS = (REQUEST_SECONDS, DB_QUERIES, DB_SECONDS, DB_ROWS, DB_POOL_SECONDS, UPSTREAM_SECONDS)
+
+
+@app.middleware('http')
+async def _request_metrics(request: Request, call_next):
+    stats, token = metrics.start_request()
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.end_request(token)
+    elapsed = time.perf_counter() - started
+    # 以路由模板为标签（未匹配的路径归为一类），避免标签取值无限增长
+    route = getattr(request.scope.get('route'), 'path', None) or 'unmatched'
+    response.headers['Server-Timing'] = stats.server_timing(elapsed)
+    REQUEST_SECONDS.observe(elapsed, route=route, method=request.method, status=response.status_code)
+    DB_QUERIES.observe(stats.queries, route=route)
+    DB_SECONDS.observe(stats.db_seconds, route=route)
+    DB_ROWS.observe(stats.rows, route=route)
+    DB_POOL_SECONDS.observe(stats.pool_seconds, route=route)
+    return response
+
+
+def _observe_upstream(endpoint: str, status, seconds: float):
+    UPSTREAM_SECONDS.observe(seconds, endpoint=endpoint, status=status)
+    stats = metrics.current()
+    if stats is not None:
+        stats.add(upstream_seconds=seconds)
+
+
+@app.get('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(_HISTOGRAMS), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# ---------- 管理端点鉴权 ----------
+# /api/admin/* 会清空缓存、重建汇总表或全量重算，需在请求头中携带 ADMIN_TOKEN
+# （Authorization: Bearer <token> 或 X-Admin-Token）；未配置 ADMIN_TOKEN 时管理端点一律拒绝。
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') or ''
+
+
+def _require_admin(authorization: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail='ADMIN_TOKEN not configured on server')
+    supplied = x_admin_token
+    if supplied is None and authorization and authorization[:7].lower() == 'bearer ':
+        supplied = authorization[7:].strip()
+    if not supplied or not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail='invalid admin token', headers={'WWW-Authenticate': 'Bearer'})
+
+
+# ---------- 表结构缓存 ----------
+# 各端点与 AI 提示词都需要知道表有哪些列；information_schema 查询在并发下较慢，
+# 因此每张表只解析一次并缓存为 ColumnMap，超过 SCHEMA_CACHE_TTL 秒后重新查询，
+# 也可调用 POST /api/admin/schema/refresh 立即失效。
+SCHEMA_CACHE_TTL = float(os.environ.get('SCHEMA_CACHE_TTL') or 600)
+
+_column_map_lock = threading.Lock()
+_column_maps = {}
+
+
+class ColumnMap:
+    """一张表解析后的列信息：原始列名、小写映射，以及各端点按候选规则选出的列。"""
+
+    def __init__(self, table: str, columns: List[str]):
+        self.table = table
+        self.columns = list(columns)
+        self.lowcols = {c.lower(): c for c in self.columns}
+        self.region = _resolve_region_columns(self.lowcols)
+        self.location = _resolve_location_columns(self.lowcols)
+        self.loaded_at = time.time()
+
+    def expired(self) -> bool:
+        return SCHEMA_CACHE_TTL > 0 and time.time() - self.loaded_at > SCHEMA_CACHE_TTL
+
+
+def _table_columns_sql():
+    # SQLite（本地基准测试/开发用）没有 information_schema，改用 pragma_table_info
+    if engine.dialect.name == 'sqlite':
+        return text("SELECT name FROM pragma_table_info(:tbl)")
+    return text("SELECT COLUMN_NAME FROM information_schema.columns WHERE table_schema=:db AND table_name=:tbl")
+
+
+def _query_table_columns(conn, table_name: str) -> List[str]:
+    db_name = engine.url.database
+    return [r[0] for r in conn.execute(_table_columns_sql(), {'db': db_name, 'tbl': table_name}).fetchall()]
+
+
+def _get_column_map(table_name: str = 'china_disease_data', conn=None) -> ColumnMap:
+    """返回缓存的 ColumnMap；缓存缺失或过期时查询一次 information_schema（可复用调用方的连接）。
+    找不到任何列时不写入缓存，避免把一次失败或拼错的表名长期缓存下来。"""
+    cmap = _column_maps.get(table_name)
+    if cmap is not None and not cmap.expired():
+        return cmap
+    with _column_map_lock:
+        cmap = _column_maps.get(table_name)
+        if cmap is not None and not cmap.expired():
+            return cmap
+        if conn is not None:
+            cols = _query_table_columns(conn, table_name)
+        else:
+            with engine.connect() as c:
+                cols = _query_table_columns(c, table_name)
+        cmap = ColumnMap(table_name, cols)
+        if cols:
+            _column_maps[table_name] = cmap
+        return cmap
+
+
+async def _get_column_map_async(table_name: str = 'china_disease_data') -> ColumnMap:
+    """_get_column_map 的异步版本（缓存共用）。"""
+    cmap = _column_maps.get(table_name)
+    if cmap is not None and not cmap.expired():
+        return cmap
+    db_name = engine.url.database
+    async with async_engine.connect() as conn:
+        cols = [r[0] for r in (await conn.execute(_table_columns_sql(), {'db': db_name, 'tbl': table_name})).fetchall()]
+    cmap = ColumnMap(table_name, cols)
+    if cols:
+        _set_column_map(table_name, cols)
+    return cmap
+
+
+def _set_column_map(table_name: str, columns: List[str]):
+    with _column_map_lock:
+        _column_maps[table_name] = ColumnMap(table_name, columns)
+
+
+def _invalidate_column_maps(table_name: Optional[str] = None):
+    with _column_map_lock:
+        if table_name:
+            _column_maps.pop(table_name, None)
+        else:
+            _column_maps.clear()
+
+
+@app.post('/api/admin/schema/refresh', dependencies=[Depends(_require_admin)])
+def refresh_schema(table: Optional[str] = None):
+    """清除表结构缓存（可指定 table），下一次请求会重新读取 information_schema。"""
+    _invalidate_column_maps(table)
+    response_cache.clear()
+    return {'invalidated': table or 'all'}
+
+
+# ---------- 聚合端点响应缓存 ----------
+# /api/china_disease、/api/disease_locations、/api/region_analysis 在数据不变时结果相同，
+# 因此缓存序列化后的 JSON（见 response_cache.py），并支持 ETag / If-None-Match -> 304。
+# 快照刷新、表结构刷新或调用 POST /api/admin/cache/clear 时清空。
+response_cache = ResponseCache(
+    ttl=float(os.environ.get('RESPONSE_CACHE_TTL') or 60),
+    stale_ttl=float(os.environ.get('RESPONSE_CACHE_STALE') or 600),
+    max_bytes=int(float(os.environ.get('RESPONSE_CACHE_MAX_MB') or 64) * 1024 * 1024),
+)
+
+
+# ---------- 响应编码（见 serialization.py） ----------
+# 缓存的聚合端点按 Accept 返回 JSON / MessagePack（表格型结果另有 Arrow IPC），按 Accept-Encoding 压缩；
+# 其它表示形式与压缩结果在缓存条目上生成一次后复用（见 _etag_response）。
+# RESPONSE_MODEL_VALIDATION=0 时不再按 response_model 校验后端自己构造的结果（只影响序列化前的校验）。
+RESPONSE_MODEL_VALIDATION = (os.environ.get('RESPONSE_MODEL_VALIDATION') or '1').strip().lower() not in ('0', 'false', 'no')
+
+
+def _json_bytes(data, model=None) -> bytes:
+    """按 response_model 校验后序列化为与 FastAPI JSONResponse 相同格式的 JSON 字节（有 orjson 时用 orjson）。"""
+    if model is not None and RESPONSE_MODEL_VALIDATION:
+        data = parse_obj_as(model, data)
+    return dumps_json(data)
+
+
+async def _cached_entry(key, loader, aloader=None) -> CacheEntry:
+    """异步模式下用 aloader（协程函数）在事件循环上计算；否则把同步 loader 放到线程池执行。"""
+    if async_engine is not None and aloader is not None:
+        return await response_cache.aget(key, aloader)
+    return await run_in_threadpool(response_cache.get, key, loader)
+
+
+async def _json_bytes_async(coro, model=None) -> bytes:
+    return _json_bytes(await coro, model)
+
+
+def _etag_response(request: Request, entry: CacheEntry, arrow_table=None) -> Response:
+    """按 Accept 选择 JSON（缓存的原始字节）或 MessagePack；给出 arrow_table（JSON 数据 -> (列名, 行)）时
+    还可返回 Arrow IPC 流。再按 Accept-Encoding 压缩。每种表示形式的 ETag 在原 ETag 后加格式与编码后缀。"""
+    offered = ('json', 'msgpack', 'arrow') if arrow_table is not None else ('json', 'msgpack')
+    fmt = negotiate_format(request.headers.get('accept'), offered)
+    body = entry.body
+    if fmt == 'msgpack':
+        body = entry.variant('msgpack', lambda: dumps_msgpack(loads_json(entry.body)))
+    elif fmt == 'arrow':
+        body = entry.variant('arrow', lambda: arrow_stream(*arrow_table(loads_json(entry.body))))
+    coding = None
+    if COMPRESSION_MIN_BYTES > 0 and len(body) >= COMPRESSION_MIN_BYTES:
+        coding = negotiate_encoding(request.headers.get('accept-encoding'))
+    if coding:
+        raw = body
+        body = entry.variant((fmt, coding), lambda: compress(raw, coding))
+    suffix = ''.join(f'-{s}' for s in (fmt if fmt != 'json' else None, coding) if s)
+    etag = entry.etag[:-1] + suffix + '"' if suffix else entry.etag
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept, Accept-Encoding'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    if coding:
+        headers['Content-Encoding'] = coding
+    return Response(content=body, media_type=MEDIA_TYPES[fmt], headers=headers)
+
+
+@app.post('/api/admin/cache/clear', dependencies=[Depends(_require_admin)])
+def clear_response_cache():
+    """清空聚合端点的响应缓存与 execute_sql 的结果缓存（例如在直接改动数据库表之后）。"""
+    response_cache.clear()
+    _data_version_state['cleared'] += 1
+    result_cache.clear()
+    return {**response_cache.stats(), 'execute_sql': result_cache.stats()}
+
+
+# ---------- 内存列式快照（DATA_BACKEND=memory） ----------
+# 启动时把 china_disease_data 整表读入 NumPy 列式结构（见 columnar.py），地图相关端点
+# 直接在内存中做分组聚合而不访问 MySQL。快照可按 SNAPSHOT_REFRESH_SECONDS 定时刷新，
+# 也可调用 POST /api/admin/snapshot/refresh 立即刷新。
+# DATA_BACKEND=shared 时快照由一个进程发布到共享的 mmap 文件（见 shared_snapshot.py），
+# 多个 worker 映射同一份数据（同时共享水质数据），按代号（generation）切换到新发布的快照。
+DATA_BACKEND = (os.environ.get('DATA_BACKEND') or 'mysql').strip().lower()
+SNAPSHOT_REFRESH_SECONDS = float(os.environ.get('SNAPSHOT_REFRESH_SECONDS') or 0)
+SHARED_SNAPSHOT_DIR = os.environ.get('SHARED_SNAPSHOT_DIR')
+SHARED_SNAPSHOT_CHECK_SECONDS = float(os.environ.get('SHARED_SNAPSHOT_CHECK_SECONDS') or 1)
+
+_snapshot_lock = threading.Lock()
+_snapshot_state = {'table': None, 'error': None}
+shared_store = SnapshotStore(SHARED_SNAPSHOT_DIR) if DATA_BACKEND == 'shared' else None
+_shared_lock = threading.Lock()
+_shared_state = {'generation': None, 'checked_at': 0.0, 'water': None}
+
+
+def _load_snapshot():
+    """从数据库重新构建快照；构建完成后整体替换，读者不会看到半成品。"""
+    started = time.time()
+    with engine.connect() as conn:
+        table = ColumnarTable.from_result(conn.execute(text('SELECT * FROM china_disease_data')))
+    with _snapshot_lock:
+        _snapshot_state['table'] = table
+        _snapshot_state['error'] = None
+    # 快照自带准确的列清单，顺带刷新表结构缓存
+    _set_column_map('china_disease_data', table.columns)
+    response_cache.clear()
+    return {'rows': table.nrows, 'columns': table.columns, 'seconds': round(time.time() - started, 3)}
+
+
+def publish_shared_snapshot():
+    """从数据源读取疾病表与水质数据，发布为新一代共享快照（任何进程均可调用，多个发布者依次进行）。"""
+    started = time.time()
+    with engine.connect() as conn:
+        table = ColumnarTable.from_result(conn.execute(text('SELECT * FROM china_disease_data')))
+    # 标志列的布尔数组也一并发布，worker 不必各自计算一份
+    for col in FLAG_COLUMNS:
+        if table.resolve(col):
+            table.flag(col, TRUTH_VALUES)
+    datasets = {'disease': table.to_arrays()}
+    try:
+        datasets['water'] = pack_water(_read_water_source())
+    except FileNotFoundError:
+        # 没有水质数据时只共享疾病表，水质得分仍由各 worker 自行读取
+        pass
+    generation = shared_store.publish(datasets)
+    _attach_shared_snapshot(force=True)
+    return {'generation': generation, 'rows': table.nrows, 'columns': table.columns, 'datasets': sorted(datasets),
+            'seconds': round(time.time() - started, 3)}
+
+
+def _attach_shared_snapshot(force: bool = False):
+    """最多每 SHARED_SNAPSHOT_CHECK_SECONDS 秒检查一次代号，有新快照时映射并整体替换。"""
+    now = time.time()
+    if not force and now - _shared_state['checked_at'] < SHARED_SNAPSHOT_CHECK_SECONDS:
+        return
+    with _shared_lock:
+        _shared_state['checked_at'] = now
+        attached = shared_store.attach(_shared_state['generation'])
+        if attached is None:
+            return
+        generation, datasets = attached
+        table = ColumnarTable.from_arrays(*datasets['disease'])
+        water = unpack_water(*datasets['water']) if 'water' in datasets else None
+        with _snapshot_lock:
+            _snapshot_state['table'] = table
+            _snapshot_state['error'] = None
+            _shared_state.update(generation=generation, water=water)
+    _set_column_map('china_disease_data', table.columns)
+    response_cache.clear()
+
+
+def _current_snapshot() -> Optional[ColumnarTable]:
+    """memory / shared 模式下返回当前快照；未启用或尚未成功加载时返回 None（调用方回退到 SQL）。"""
+    if DATA_BACKEND == 'shared':
+        _attach_shared_snapshot()
+    elif DATA_BACKEND != 'memory':
+        return None
+    return _snapshot_state['table']
+
+
+def _snapshot_refresher():
+    while True:
+        time.sleep(SNAPSHOT_REFRESH_SECONDS)
+        try:
+            if DATA_BACKEND == 'shared':
+                # 只有 leader 发布；原 leader 退出后由下一个拿到锁的 worker 接手
+                if shared_store.try_lead():
+                    publish_shared_snapshot()
+            else:
+                _load_snapshot()
+        except Exception as e:
+            # 刷新失败时保留旧快照继续服务
+            _snapshot_state['error'] = str(e)
+
+
+@app.on_event('startup')
+def _start_snapshot():
+    if DATA_BACKEND not in ('memory', 'shared'):
+        return
+    try:
+        if DATA_BACKEND == 'memory':
+            _load_snapshot()
+        elif shared_store.try_lead():
+            publish_shared_snapshot()
+        else:
+            _attach_shared_snapshot(force=True)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        _snapshot_state['error'] = str(e)
+    if SNAPSHOT_REFRESH_SECONDS > 0:
+        threading.Thread(target=_snapshot_refresher, name='snapshot-refresher', daemon=True).start()
+
+
+@app.get('/api/admin/snapshot/status', dependencies=[Depends(_require_admin)])
+def snapshot_status():
+    table = _current_snapshot()
+    out = {'backend': DATA_BACKEND, 'rows': table.nrows if table is not None else None,
+           'loaded_at': table.loaded_at if table is not None else None, 'error': _snapshot_state['error']}
+    if DATA_BACKEND == 'shared':
+        out.update(generation=_shared_state['generation'], leader=shared_store.is_leader, pid=os.getpid(),
+                   water_rows=_shared_state['water'].nrows if _shared_state['water'] is not None else None,
+                   store=shared_store.status())
+    return out
+
+
+@app.post('/api/admin/snapshot/refresh', dependencies=[Depends(_require_admin)])
+def refresh_snapshot():
+    """立即从数据库重建内存快照（DATA_BACKEND=memory），或发布新一代共享快照（DATA_BACKEND=shared）。"""
+    if DATA_BACKEND not in ('memory', 'shared'):
+        raise HTTPException(status_code=400, detail='snapshot mode is not enabled (set DATA_BACKEND=memory or shared)')
+    try:
+        if DATA_BACKEND == 'shared':
+            return publish_shared_snapshot()
+        return _load_snapshot()
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        _snapshot_state['error'] = str(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _province_cases_items(rows):
+    """(name, cases) 行 -> [{'name', 'cases'}]，cases 统一转为 int。"""
+    items = []
+    for name, cases in rows:
+        try:
+            cases = int(cases) if cases is not None else 0
+        except Exception:
+            cases = 0
+        items.append({'name': name, 'cases': cases})
+    return items
+
+
+def _snapshot_province_cases(table: ColumnarTable):
+    groups = table.group_reduce(['Province'], {'cases': table.values('Reported_Cases')})
+    rows = [(k[0], v['cases']) for k, v in groups]
+    rows.sort(key=lambda r: r[1], reverse=True)
+    return rows
+
+
+# ---------- 预聚合汇总表（rollup cube，见 cube.py） ----------
+# 汇总表构建后，/api/china_disease、/api/disease_locations、/api/region_analysis 在所需的维度与度量
+# 都被汇总表覆盖时自动改查汇总表（其行数只与维度组合数有关，与原表行数无关），否则仍扫描原表；
+# execute_sql 始终查询原表。汇总表反映的是构建时刻的数据：meta 中记录了构建时 china_disease_data 的数据版本，
+# loader.py 导入后版本变化（与 execute_sql 结果缓存共用 _data_version 的读取），在重新构建之前改查原表。
+# 可设置 CUBE_REFRESH_SECONDS 定时重建，或调用 POST /api/admin/cube/rebuild（命令行: python cube.py）；
+# 重建互斥执行。CUBE_ROUTING=0 关闭自动路由。
+CUBE_ROUTING = (os.environ.get('CUBE_ROUTING') or '1').strip().lower() not in ('0', 'false', 'no')
+CUBE_REFRESH_SECONDS = float(os.environ.get('CUBE_REFRESH_SECONDS') or 0)
+
+_cube_lock = threading.Lock()
+_cube_build_lock = threading.Lock()
+_cube_state = {'info': None, 'loaded_at': 0.0}
+
+
+def _cube_state_fresh() -> bool:
+    loaded_at = _cube_state['loaded_at']
+    return bool(loaded_at) and (SCHEMA_CACHE_TTL <= 0 or time.time() - loaded_at <= SCHEMA_CACHE_TTL)
+
+
+def _cube_current(info: Optional[CubeInfo]) -> Optional[CubeInfo]:
+    """汇总表构建之后 china_disease_data 又导入过时返回 None（改查原表）。"""
+    if info is None or info.data_version != dict(_data_version()[1]).get(CUBE_SOURCE_TABLE, 0):
+        return None
+    return info
+
+
+def _get_cube() -> Optional[CubeInfo]:
+    """返回汇总表的列角色（与表结构一样按 SCHEMA_CACHE_TTL 缓存）；尚未构建、已过期或关闭路由时返回 None。"""
+    if not CUBE_ROUTING:
+        return None
+    if _cube_state_fresh():
+        return _cube_current(_cube_state['info'])
+    with _cube_lock:
+        if not _cube_state_fresh():
+            try:
+                with engine.connect() as conn:
+                    info = load_cube_info(conn)
+            except SQLAlchemyError:
+                # 汇总表尚未构建
+                info = None
+            _cube_state.update(info=info, loaded_at=time.time())
+    return _cube_current(_cube_state['info'])
+
+
+async def _get_cube_async() -> Optional[CubeInfo]:
+    if not CUBE_ROUTING:
+        return None
+    if _cube_state_fresh() and not _data_version_due():
+        return _cube_current(_cube_state['info'])
+    return await run_in_threadpool(_get_cube)
+
+
+def _rebuild_cube() -> dict:
+    with _cube_build_lock:
+        with engine.begin() as conn:
+            result = build_cube(conn, TRUTH_VALUES)
+        with _cube_lock:
+            _cube_state.update(info=None, loaded_at=0.0)
+        response_cache.clear()
+    return result
+
+
+def _cube_refresher():
+    while True:
+        time.sleep(CUBE_REFRESH_SECONDS)
+        try:
+            _rebuild_cube()
+        except Exception:
+            # 重建失败时继续使用旧的汇总表
+            import traceback
+            traceback.print_exc()
+
+
+@app.on_event('startup')
+def _start_cube_refresher():
+    if CUBE_REFRESH_SECONDS > 0:
+        threading.Thread(target=_cube_refresher, name='cube-refresher', daemon=True).start()
+
+
+@app.post('/api/admin/cube/rebuild', dependencies=[Depends(_require_admin)])
+def rebuild_cube():
+    """立即从 china_disease_data 重建汇总表。"""
+    try:
+        return _rebuild_cube()
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 按 Province 汇总 Reported_Cases（字段名按你的表结构），返回省份名与病例数
+# 注意：字段名大小写/下划线请根据实际表结构调整
+PROVINCE_CASES_QUERY = '''
+    SELECT Province AS name, SUM(Reported_Cases) AS cases
+    FROM {table}
+    GROUP BY Province
+    ORDER BY cases DESC
+'''
+PROVINCE_CASES_SQL = text(PROVINCE_CASES_QUERY.format(table='china_disease_data'))
+CUBE_PROVINCE_CASES_SQL = text(PROVINCE_CASES_QUERY.format(table=CUBE_TABLE))
+
+
+def _province_cases_sql(cube: Optional[CubeInfo]):
+    if cube is not None and cube.dim('Province') and cube.sum('Reported_Cases'):
+        return CUBE_PROVINCE_CASES_SQL
+    return PROVINCE_CASES_SQL
+
+
 @app.get('/api/china_disease', response_model=List[ProvinceCases])
-def get_china_disease():
+async def get_china_disease(request: Request):
+    entry = await _cached_entry(('china_disease',),
+                                lambda: _json_bytes(_china_disease_data(), List[ProvinceCases]),
+                                lambda: _json_bytes_async(_china_disease_data_async(), List[ProvinceCases]))
+    return _etag_response(request, entry)
+
+
+def _china_disease_data():
     try:
-        # 按 Province 汇总 Reported_Cases（字段名按你的表结构），返回省份名与病例数
+        snap = _current_snapshot()
+        if snap is not None:
+            return _province_cases_items(_snapshot_province_cases(snap))
+        cube = _get_cube()
         with engine.connect() as conn:
-            # 注意：字段名大小写/下划线请根据实际表结构调整
-            q = text('''
-                SELECT Province AS name, SUM(Reported_Cases) AS cases
-                FROM china_disease_data
-                GROUP BY Province
-                ORDER BY cases DESC
-            ''')
-            result = conn.execute(q)
+            result = conn.execute(_province_cases_sql(cube))
             # 使用 mappings() 获得字典风格的结果，避免 Row 对象的属性访问差异
-            items = []
-            for row in result.mappings():
-                name = row.get('name') or row.get('Province')
-                cases = row.get('cases')
-                try:
-                    cases = int(cases) if cases is not None else 0
-                except Exception:
-                    cases = 0
-                items.append({'name': name, 'cases': cases})
-            return items
+            return _province_cases_items((row.get('name') or row.get('Province'), row.get('cases')) for row in result.mappings())
     except SQLAlchemyError as e:
         # 打印到控制台以便调试
         import traceback
@@ -117,121 +682,156 @@ def get_china_disease():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def _china_disease_data_async():
+    try:
+        snap = _current_snapshot()
+        if snap is not None:
+            return _province_cases_items(_snapshot_province_cases(snap))
+        cube = await _get_cube_async()
+        async with async_engine.connect() as conn:
+            result = await conn.execute(_province_cases_sql(cube))
+            return _province_cases_items((row.get('name') or row.get('Province'), row.get('cases')) for row in result.mappings())
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _resolve_location_columns(lowcols: dict) -> dict:
+    """按候选列名（case-insensitive）选出 /api/disease_locations 用到的列。"""
+    def pick(cands):
+        for cand in cands:
+            if cand.lower() in lowcols:
+                return lowcols[cand.lower()]
+        return None
+    return {
+        'disease_col': pick(['disease', 'disease_type', 'diseaseName', 'Disease', 'Type']),
+        # 经纬度候选
+        'lng_col': pick(['lng', 'longitude', 'lon', '经度', 'lng_x']),
+        'lat_col': pick(['lat', 'latitude', '纬度', 'lat_y']),
+        # 地点名称候选（city/location/name/province）
+        'name_col': pick(['location', 'city', 'place', 'name', 'province', '区域', '地区']),
+        'reported_col': pick(['reported_cases', 'reportedcases', 'cases', 'count']),
+    }
+
+
+def _fill_centroid(obj: dict):
+    # 尝试填充缺失的经纬度（按省/地点名匹配 PROVINCE_CENTROIDS）
+    if (obj.get('lng') is None or obj.get('lat') is None) and isinstance(obj.get('name'), str):
+        cent = PROVINCE_CENTROIDS.get(obj['name']) or PROVINCE_CENTROIDS.get(obj['name'].title())
+        if cent:
+            obj['lng'], obj['lat'] = cent[0], cent[1]
+
+
+def _build_locations(rows) -> list:
+    """(name, lng, lat, disease, cases) 行 -> 按地点分组、counts 为 disease->cases 的列表。"""
+    places = {}
+    for pname, lng, lat, disease, cases in rows:
+        if not pname:
+            continue
+        try:
+            cases = int(cases or 0)
+        except Exception:
+            cases = 0
+        if pname not in places:
+            places[pname] = {'name': pname, 'lng': float(lng) if lng is not None else None, 'lat': float(lat) if lat is not None else None, 'counts': {}}
+        places[pname]['counts'][str(disease)] = places[pname]['counts'].get(str(disease), 0) + cases
+    for p in places.values():
+        _fill_centroid(p)
+    return list(places.values())
+
+
+def _build_location_fallback(items) -> list:
+    """按省汇总的 {'name','cases'} -> 只有 counts.all 的地点列表。"""
+    out = []
+    for it in items:
+        obj = {'name': it['name'], 'lng': None, 'lat': None, 'counts': {'all': it['cases']}}
+        _fill_centroid(obj)
+        out.append(obj)
+    return out
+
+
+def _snapshot_locations(table: ColumnarTable, loc: dict) -> list:
+    if not (loc['disease_col'] and loc['name_col']):
+        return _build_location_fallback(_province_cases_items(_snapshot_province_cases(table)))
+    keys = [loc['name_col']] + [c for c in (loc['lng_col'], loc['lat_col']) if c] + [loc['disease_col']]
+    groups = table.group_reduce(keys, {'cases': table.values(loc['reported_col'] or 'Reported_Cases')})
+    rows = []
+    for k, v in groups:
+        k = list(k)
+        name, disease = k[0], k[-1]
+        lng = k[1] if loc['lng_col'] else None
+        lat = k[1 + bool(loc['lng_col'])] if loc['lat_col'] else None
+        rows.append((name, lng, lat, disease, v['cases']))
+    return _build_locations(rows)
+
+
+def _location_query(loc: dict, cube: Optional[CubeInfo] = None):
+    """按地点+病种聚合的查询；缺少病种或地点列时返回 None（调用方回退到按省汇总）。
+    地点、病种都是汇总表维度且没有经纬度列时改查汇总表。"""
+    disease_col, name_col = loc['disease_col'], loc['name_col']
+    if not (disease_col and name_col):
+        return None
+    lng_col, lat_col, reported_col = loc['lng_col'], loc['lat_col'], loc['reported_col']
+    table = 'china_disease_data'
+    if (cube is not None and not lng_col and not lat_col and cube.dim(name_col) and cube.dim(disease_col)
+            and cube.sum(reported_col or 'Reported_Cases')):
+        table = cube.table
+        name_col, disease_col, reported_col = cube.dim(name_col), cube.dim(disease_col), cube.sum(reported_col or 'Reported_Cases')
+    return text(f"""
+        SELECT {name_col} AS name,
+               {lng_col or 'NULL'} AS lng,
+               {lat_col or 'NULL'} AS lat,
+               {disease_col} AS disease,
+               SUM({reported_col or 'Reported_Cases'}) AS cases
+        FROM {table}
+        GROUP BY {name_col}, {lng_col or 'NULL'}, {lat_col or 'NULL'}, {disease_col}
+    """)
+
+
+def _locations_from_result(result, by_location: bool) -> list:
+    if by_location:
+        # 聚合到 Python 结构：按地点分组，counts 为 disease->cases
+        return _build_locations((r.get('name'), r.get('lng'), r.get('lat'), r.get('disease'), r.get('cases')) for r in result.mappings())
+    # 回退：按省/省份聚合（与 /api/china_disease 行为一致）
+    return _build_location_fallback(_province_cases_items((row.get('name') or row.get('Province'), row.get('cases')) for row in result.mappings()))
+
+
 @app.get('/api/disease_locations', response_model=List[LocationCounts])
-def get_disease_locations():
+async def get_disease_locations(request: Request):
     """
     尝试返回每个地点（或城市/省）的各病种计数与经纬度（如果可用）。
     实现策略：先检查表中可用的列名，然后根据可用列聚合出
     name, lng, lat, disease, cases 的中间结果，再在后端将相同地点聚合为 counts 字段。
     若无法找到病种列，则会回退为按 Province 的汇总（与 /api/china_disease 类似），返回只有 name 与 cases。
     """
+    entry = await _cached_entry(('disease_locations',),
+                                lambda: _json_bytes(_disease_locations_data(), List[LocationCounts]),
+                                lambda: _json_bytes_async(_disease_locations_data_async(), List[LocationCounts]))
+    return _etag_response(request, entry, arrow_table=_locations_arrow_table)
+
+
+def _locations_arrow_table(items: list):
+    """Arrow 格式按 (地点, 病种) 展开为长表：name, lng, lat, disease, cases。"""
+    rows = [(it['name'], it.get('lng'), it.get('lat'), disease, cases)
+            for it in items for disease, cases in (it.get('counts') or {}).items()]
+    return ['name', 'lng', 'lat', 'disease', 'cases'], rows
+
+
+def _disease_locations_data():
     try:
+        snap = _current_snapshot()
+        if snap is not None:
+            return _snapshot_locations(snap, _get_column_map().location)
+        cube = _get_cube()
         with engine.connect() as conn:
-            # 先检测表的列名
-            db_name = engine.url.database
-            cols_q = text("SELECT COLUMN_NAME FROM information_schema.columns WHERE table_schema=:db AND table_name='china_disease_data'")
-            cols_res = conn.execute(cols_q, {'db': db_name})
-            cols = [r[0] for r in cols_res.fetchall()]
-
-            # 简单的列名匹配器（case-insensitive）
-            lowcols = {c.lower(): c for c in cols}
-
-            # 可能的列名候选
-            disease_col = None
-            for cand in ['disease', 'disease_type', 'diseaseName', 'Disease', 'Type']:
-                if cand.lower() in lowcols:
-                    disease_col = lowcols[cand.lower()]
-                    break
-
-            # 经纬度候选
-            lng_col = None
-            lat_col = None
-            for cand in ['lng', 'longitude', 'lon', '经度', 'lng_x']:
-                if cand.lower() in lowcols:
-                    lng_col = lowcols[cand.lower()]
-                    break
-            for cand in ['lat', 'latitude', '纬度', 'lat_y']:
-                if cand.lower() in lowcols:
-                    lat_col = lowcols[cand.lower()]
-                    break
-
-            # 地点名称候选（city/location/name/province）
-            name_col = None
-            for cand in ['location', 'city', 'place', 'name', 'province', '区域', '地区']:
-                if cand.lower() in lowcols:
-                    name_col = lowcols[cand.lower()]
-                    break
-
-            reported_col = None
-            for cand in ['reported_cases', 'reportedcases', 'reported_cases', 'Reported_Cases', 'cases', 'count']:
-                if cand.lower() in lowcols:
-                    reported_col = lowcols[cand.lower()]
-                    break
-
-            if disease_col and name_col:
-                # 我们可以按地点+病种聚合
-                q = text(f"""
-                    SELECT {name_col} AS name,
-                           {lng_col or 'NULL'} AS lng,
-                           {lat_col or 'NULL'} AS lat,
-                           {disease_col} AS disease,
-                           SUM({reported_col or 'Reported_Cases'}) AS cases
-                    FROM china_disease_data
-                    GROUP BY {name_col}, {lng_col or 'NULL'}, {lat_col or 'NULL'}, {disease_col}
-                """)
-                rows = conn.execute(q)
-                # 聚合到 Python 结构：按地点分组，counts 为 disease->cases
-                places = {}
-                for r in rows.mappings():
-                    pname = r.get('name')
-                    if not pname:
-                        continue
-                    lng = r.get('lng')
-                    lat = r.get('lat')
-                    disease = r.get('disease')
-                    cases = r.get('cases') or 0
-                    try:
-                        cases = int(cases)
-                    except Exception:
-                        cases = 0
-                    if pname not in places:
-                        places[pname] = {'name': pname, 'lng': float(lng) if lng is not None else None, 'lat': float(lat) if lat is not None else None, 'counts': {}}
-                    places[pname]['counts'][str(disease)] = places[pname]['counts'].get(str(disease), 0) + cases
-
-                # 尝试填充缺失的经纬度（按省/地点名匹配 PROVINCE_CENTROIDS）
-                for p in places.values():
-                    if (p.get('lng') is None or p.get('lat') is None) and isinstance(p.get('name'), str):
-                        cent = PROVINCE_CENTROIDS.get(p['name']) or PROVINCE_CENTROIDS.get(p['name'].title())
-                        if cent:
-                            p['lng'], p['lat'] = cent[0], cent[1]
-                return list(places.values())
-            else:
-                # 回退：按省/省份聚合（与 /api/china_disease 行为一致）
-                q = text('''
-                    SELECT Province AS name, SUM(Reported_Cases) AS cases
-                    FROM china_disease_data
-                    GROUP BY Province
-                    ORDER BY cases DESC
-                ''')
-                result = conn.execute(q)
-                out = []
-                for row in result.mappings():
-                    name = row.get('name') or row.get('Province')
-                    cases = row.get('cases')
-                    try:
-                        cases = int(cases) if cases is not None else 0
-                    except Exception:
-                        cases = 0
-                    obj = {'name': name, 'counts': {'all': cases}}
-                    # 填充经纬度（若能从 PROVINCE_CENTROIDS 匹配）
-                    if isinstance(name, str):
-                        cent = PROVINCE_CENTROIDS.get(name) or PROVINCE_CENTROIDS.get(name.title())
-                        if cent:
-                            obj['lng'], obj['lat'] = cent[0], cent[1]
-                        else:
-                            obj['lng'], obj['lat'] = None, None
-                    out.append(obj)
-                return out
+            # 表的列名与候选列匹配结果来自缓存的 ColumnMap
+            q = _location_query(_get_column_map(conn=conn).location, cube)
+            return _locations_from_result(conn.execute(q if q is not None else _province_cases_sql(cube)), q is not None)
     except SQLAlchemyError as e:
         import traceback
         traceback.print_exc()
@@ -242,658 +842,653 @@ def get_disease_locations():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def _disease_locations_data_async():
+    try:
+        cmap = await _get_column_map_async()
+        snap = _current_snapshot()
+        if snap is not None:
+            return _snapshot_locations(snap, cmap.location)
+        cube = await _get_cube_async()
+        q = _location_query(cmap.location, cube)
+        async with async_engine.connect() as conn:
+            result = await conn.execute(q if q is not None else _province_cases_sql(cube))
+            return _locations_from_result(result, q is not None)
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 月份 -> 季节（当表中没有 Season 列时由月份推导）
+MONTH_TO_SEASON = {1:'Winter',2:'Winter',12:'Winter',3:'Spring',4:'Spring',5:'Spring',6:'Summer',7:'Summer',8:'Summer',9:'Autumn',10:'Autumn',11:'Autumn'}
+
+# 前端可能传中文省名，数据库中为英文省名
+REGION_CN_TO_EN = {
+    '北京':'Beijing','上海':'Shanghai','天津':'Tianjin','重庆':'Chongqing',
+    '四川':'Sichuan','河南':'Henan','广东':'Guangdong','江苏':'Jiangsu',
+    '浙江':'Zhejiang','山东':'Shandong','湖南':'Hunan','湖北':'Hubei',
+    '云南':'Yunnan','贵州':'Guizhou','陕西':'Shaanxi','广西':'Guangxi',
+    '内蒙古':'Inner Mongolia','黑龙江':'Heilongjiang','吉林':'Jilin','辽宁':'Liaoning',
+    '河北':'Hebei','山西':'Shanxi','安徽':'Anhui','福建':'Fujian',
+    '江西':'Jiangxi','海南':'Hainan','新疆':'Xinjiang','西藏':'Tibet',
+    '宁夏':'Ningxia','香港':'Hong Kong','澳门':'Macau','台湾':'Taiwan'
+}
+
+
+def _parse_regions(regions: Optional[str]):
+    """把逗号分隔的 regions 参数解析为省名列表（中文名映射为英文名）；未提供时返回 None。"""
+    if not regions:
+        return None
+    parsed = [r.strip() for r in regions.split(',') if r.strip()]
+    return [REGION_CN_TO_EN.get(r, r) for r in parsed] or None
+
+
+def _region_key(value):
+    # MySQL 默认排序规则对大小写/尾部空白不敏感，这里按同样规则匹配请求的省名与查询结果
+    return str(value).strip().lower() if value is not None else None
+
+
+def _resolve_region_columns(lowcols: dict) -> dict:
+    """根据表的实际列名（lowcols: 小写 -> 原始列名）选出 region_analysis 用到的各列。"""
+    g = lowcols.get
+    return {
+        # province column (support both English and Chinese header)
+        'province_col': g('province') or g('province_name') or g('区域') or g('地区') or 'Province',
+        'disease_col': g('disease') or g('disease_type') or g('disease_name') or g('diseasename') or g('type'),
+        # age: CSV uses Age_Group (strings like '0-14','15-24','65+')
+        'age_col': g('age_group') or g('age') or g('年龄'),
+        'gender_col': g('gender') or g('sex') or g('性别'),
+        # status / confirmed flags: Lab_Confirmed
+        'status_col': g('lab_confirmed') or g('lab_confirm') or g('lab_confirmed_flag'),
+        # date/month/season: CSV has Month, Year, Season columns
+        'date_col': g('month') or g('report_date') or g('date'),
+        'month_col': g('month'),
+        'season_col': g('season') or g('季节'),
+        # clinical outcome: Recovered（若不存在则退回 Deaths 分布）
+        'clinical_col': g('recovered') or g('clinical_result') or g('outcome') or g('结果') or g('deaths'),
+        # social / exposure-like columns (Contact_Tracing, Travel_History, Comorbidity)
+        'social_col': g('contact_tracing') or g('travel_history') or g('exposure') or g('social_activity') or g('comorbidity'),
+        # reported cases column (counts)
+        'reported_col': g('reported_cases') or g('cases') or g('count'),
+        'deaths_col': g('deaths') or g('death'),
+        'recovered_col': g('recovered') or g('recovery'),
+        'hosp_col': g('hospitalized') or g('hospital') or g('icu_admission'),
+        'vacc_col': g('vaccinated') or g('vaccine'),
+        'travel_col': g('travel_history') or g('travel'),
+        'quarant_col': g('quarantined') or g('quarantine'),
+        'urbanr_col': g('urban_rural') or g('urban'),
+        'fever_col': g('symptom_fever'),
+        'cough_col': g('symptom_cough'),
+        'rash_col': g('symptom_rash'),
+        'days_col': g('days_hospitalized') or g('days_hospital'),
+        # 已整数化的标志列（见 flags.py）：小写原列名 -> <列>_flag
+        'flag_cols': normalized_flags(lowcols),
+    }
+
+
+URBAN_VALUES = ('urban', '城镇', 'town', 'city')
+RURAL_VALUES = ('rural', '农村', 'village')
+
+# region_analysis 的各字段 -> (需要的度量, 需要的分布维度)；顺序即响应中的字段顺序
+_REGION_FIELD_NEEDS = {
+    'total': (('total',), ()),
+    'age_distribution': ((), ('age',)),
+    'gender': ((), ('gender',)),
+    'disease_status': ((), ('status',)),
+    'season': ((), ('season',)),
+    'clinical': ((), ('clinical',)),
+    'social': ((), ('social',)),
+    'deaths': (('deaths',), ()),
+    'recovered': (('recovered',), ()),
+    'hospitalized': (('hospitalized',), ()),
+    'vaccinated': (('vaccinated',), ()),
+    'travel_history': (('travel_yes',), ('travel',)),
+    'quarantined': (('quarantined_yes',), ('quarantine',)),
+    'symptoms': (('fever', 'cough', 'rash'), ()),
+    'days_hospitalized': (('days_sum', 'days_count'), ()),
+    'urban_rural': (('urban_sum', 'rural_sum'), ('urban',)),
+    'monthly': ((), ('month',)),
+    'by_disease': ((), ()),
+    # 病种列表只需要按病种分组的总数
+    'disease_list': (('total',), ()),
+}
+REGION_FIELDS = tuple(_REGION_FIELD_NEEDS)
+DISEASE_FIELDS = ('total', 'age_distribution', 'gender', 'season', 'clinical', 'social', 'deaths', 'recovered',
+                  'hospitalized', 'vaccinated', 'travel_history', 'quarantined', 'urban_rural', 'symptoms',
+                  'days_hospitalized', 'monthly')
+
+
+class RegionFields:
+    """region_analysis 的字段投影（fields= / include= 参数）。
+    例如 'total,gender,by_disease.monthly'：地区级只返回 total 与 gender，by_disease 中每个病种只返回 monthly；
+    单独的 'by_disease' 表示病种下的全部字段。只有请求到的度量与分布维度会生成查询，
+    不需要 by_disease / disease_list 时查询也不再按病种分组。"""
+
+    def __init__(self, sections, disease_sections):
+        self.sections = frozenset(sections)
+        self.disease_sections = frozenset(disease_sections)
+        if self.disease_sections:
+            self.sections |= {'by_disease'}
+        self.by_disease = bool(self.sections & {'by_disease', 'disease_list'})
+
+    @classmethod
+    def parse(cls, *raw: Optional[str]) -> Optional['RegionFields']:
+        """解析逗号分隔的字段列表（可给多个参数，取并集）；都为空时返回 None（返回全部字段）。
+        未知字段抛出 ValueError。"""
+        names = [n.strip() for r in raw if r for n in r.split(',') if n.strip()]
+        if not names:
+            return None
+        sections, disease_sections = set(), set()
+        for name in names:
+            if name == 'region':
+                continue
+            if name == 'by_disease':
+                disease_sections.update(DISEASE_FIELDS)
+            elif name.startswith('by_disease.'):
+                sub = name[len('by_disease.'):]
+                if sub not in DISEASE_FIELDS:
+                    raise ValueError(f'unknown field {name}; by_disease fields: {", ".join(DISEASE_FIELDS)}')
+                disease_sections.add(sub)
+            elif name in _REGION_FIELD_NEEDS:
+                sections.add(name)
+            else:
+                raise ValueError(f'unknown field {name}; expected one of {", ".join(REGION_FIELDS)}')
+        return cls(sections, disease_sections)
+
+    @property
+    def key(self) -> tuple:
+        return tuple(sorted(self.sections)), tuple(sorted(self.disease_sections))
+
+    def region_fields(self) -> tuple:
+        return tuple(f for f in REGION_FIELDS if f in self.sections)
+
+    def disease_fields(self) -> tuple:
+        return tuple(f for f in DISEASE_FIELDS if f in self.disease_sections)
+
+    def measures(self) -> set:
+        return {m for f in self.sections | self.disease_sections for m in _REGION_FIELD_NEEDS[f][0]}
+
+    def dims(self, chosen: dict) -> set:
+        dims = {d for f in self.sections | self.disease_sections for d in _REGION_FIELD_NEEDS[f][1]}
+        if 'season' in dims and not chosen.get('season_col'):
+            # 没有 Season 列时季节分布由月份分布推导
+            dims.add('month')
+        return dims
+
+
+def _region_disease_col(chosen: dict, fields: Optional[RegionFields] = None) -> Optional[str]:
+    """分组用的病种列；投影不需要按病种的结果时返回 None，查询只按省（或全表）分组。"""
+    return chosen.get('disease_col') if fields is None or fields.by_disease else None
+
+
+def _region_measure_specs(chosen: dict, fields: Optional[RegionFields] = None) -> dict:
+    """按 (省, 病种) 粒度可一次扫描得到的标量聚合：名称 -> (类型, 列名, 取值集合)。
+    类型: 'sum' 对列求和；'count' 统计非空行数；'flag' 标志列取值属于集合时累加病例数。
+    SQL 路径（_measure_sql）与内存快照路径共用这一份定义；给出 fields 时只保留其需要的度量。"""
+    specs = {'total': ('sum', chosen.get('reported_col') or 'Reported_Cases', None)}
+    if chosen.get('deaths_col'):
+        specs['deaths'] = ('sum', chosen['deaths_col'], None)
+    for name, key in (('recovered', 'recovered_col'), ('hospitalized', 'hosp_col'), ('vaccinated', 'vacc_col'),
+                      ('travel_yes', 'travel_col'), ('quarantined_yes', 'quarant_col'),
+                      ('fever', 'fever_col'), ('cough', 'cough_col'), ('rash', 'rash_col')):
+        if chosen.get(key):
+            specs[name] = ('flag', chosen[key], TRUTH_VALUES)
+    if chosen.get('urbanr_col'):
+        specs['urban_sum'] = ('flag', chosen['urbanr_col'], URBAN_VALUES)
+        specs['rural_sum'] = ('flag', chosen['urbanr_col'], RURAL_VALUES)
+    if chosen.get('days_col'):
+        specs['days_sum'] = ('sum', chosen['days_col'], None)
+        specs['days_count'] = ('count', chosen['days_col'], None)
+    if fields is not None:
+        wanted = fields.measures()
+        specs = {name: spec for name, spec in specs.items() if name in wanted}
+    return specs
+
+
+def _measure_sql(spec: tuple, weight: str, cube: Optional[CubeInfo] = None, flags: Optional[dict] = None) -> str:
+    """flags 为已整数化的标志列（chosen['flag_cols']）；按标准真值集合判断的标志列有整数列时直接整数求和。"""
+    kind, col, values = spec
+    if cube is not None:
+        # 汇总表中非维度列已预先聚合：求和列同名，计数列为 <列>_n，标志列为 <列>_yes
+        if cube.dim(col):
+            col = cube.dim(col)
+        elif kind == 'flag':
+            return f"SUM({cube.flag(col).yes_column})"
+        elif kind == 'count':
+            return f"SUM({cube.count(col)})"
+        else:
+            return f"SUM({cube.sum(col)})"
+    if kind == 'flag':
+        return flag_sum_sql(col, weight, values, flags if tuple(values) == TRUTH_VALUES else None)
+    if kind == 'count':
+        return f"COUNT({col})"
+    return f"SUM({col})"
+
+
+def _region_dimension_exprs(chosen: dict, fields: Optional[RegionFields] = None) -> dict:
+    """需要按取值分布返回的维度：维度名 -> 分组表达式（给出 fields 时只保留其需要的维度）。"""
+    dims = {}
+    for name, key in (('age', 'age_col'), ('gender', 'gender_col'), ('status', 'status_col'),
+                      ('season', 'season_col'), ('clinical', 'clinical_col'), ('social', 'social_col'),
+                      ('travel', 'travel_col'), ('quarantine', 'quarant_col'), ('urban', 'urbanr_col')):
+        if chosen.get(key):
+            dims[name] = chosen[key]
+    if chosen.get('month_col'):
+        dims['month'] = chosen['month_col']
+    elif chosen.get('date_col'):
+        dims['month'] = f"MONTH({chosen['date_col']})"
+    if fields is not None:
+        wanted = fields.dims(chosen)
+        dims = {name: expr for name, expr in dims.items() if name in wanted}
+    return dims
+
+
+def _cube_covers_region(cube: CubeInfo, chosen: dict, fields: Optional[RegionFields] = None) -> bool:
+    """region_analysis（按 fields 投影后）用到的键列、度量与分布维度是否都能由汇总表得到。"""
+    if not cube.dim(chosen['province_col']) or not cube.sum(chosen.get('reported_col') or 'Reported_Cases'):
+        return False
+    disease_col = _region_disease_col(chosen, fields)
+    if disease_col and not cube.dim(disease_col):
+        return False
+    for kind, col, values in _region_measure_specs(chosen, fields).values():
+        if cube.dim(col):
+            ok = kind == 'flag'
+        elif kind == 'sum':
+            ok = cube.sum(col) is not None
+        elif kind == 'count':
+            ok = cube.count(col) is not None
+        else:
+            ok = cube.flag(col) is not None and tuple(values) == TRUTH_VALUES
+        if not ok:
+            return False
+    for expr in _region_dimension_exprs(chosen, fields).values():
+        flag = cube.flag(expr)
+        if not cube.dim(expr) and not (flag and flag.binary):
+            return False
+    return True
+
+
+def _cube_flag_dimension_query(cube: CubeInfo, flag, dim: str, key_select: str, where_clause: str,
+                               group_by: str, weight: str, params: dict):
+    """汇总表不含标志列本身：由 <列>_yes 与总数还原两种取值的分布（只适用于 binary 标志列）。
+    HAVING 按行数过滤，保证与原表一样只返回实际出现过的取值。"""
+    parts = []
+    if flag.yes_value is not None:
+        params[f'{dim}_yes'] = flag.yes_value
+        parts.append(f"SELECT {key_select}, :{dim}_yes AS v, SUM({flag.yes_column}) AS c FROM {cube.table} "
+                     f"{where_clause} {group_by} HAVING SUM({flag.count_column}) > 0")
+    if flag.no_value is not None:
+        params[f'{dim}_no'] = flag.no_value
+        parts.append(f"SELECT {key_select}, :{dim}_no AS v, SUM({weight}) - SUM({flag.yes_column}) AS c FROM {cube.table} "
+                     f"{where_clause} {group_by} HAVING SUM({cube.row_count}) - SUM({flag.count_column}) > 0")
+    return text(' UNION ALL '.join(parts))
+
+
+def _region_rollup_queries(chosen: dict, region_list: Optional[List[str]] = None, cube: Optional[CubeInfo] = None,
+                           fields: Optional[RegionFields] = None):
+    """构造 region_analysis 需要的全部汇总查询，查询条数与请求的地区数无关：
+    - measures: 一条按 (省, 病种) 分组的条件聚合（总数、死亡、各标志计数、住院天数）；
+    - dims: 每个分布维度一条 GROUP BY (省, 病种, 维度) 查询。
+    传入 cube（且 _cube_covers_region 为真）时改查汇总表；传入 fields 时只构造投影需要的查询
+    （不需要任何度量时 measure 查询为 None）。
+    返回 (measure 名称列表, measure 查询, {维度: 查询}, 绑定参数)。"""
+    province_col = chosen['province_col']
+    disease_col = _region_disease_col(chosen, fields)
+    weight = chosen.get('reported_col') or 'Reported_Cases'
+    table = 'china_disease_data'
+    if cube is not None:
+        table = cube.table
+        province_col = cube.dim(province_col)
+        disease_col = cube.dim(disease_col) if disease_col else None
+        weight = cube.sum(weight)
+
+    key_cols = []
+    if region_list:
+        key_cols.append(province_col)
+    if disease_col:
+        key_cols.append(disease_col)
+    key_select = f"{province_col if region_list else 'NULL'} AS region, {disease_col or 'NULL'} AS disease"
+
+    where_clause = ''
+    params = {}
+    if region_list:
+        names = list(dict.fromkeys(region_list))
+        params = {f'r{i}': n for i, n in enumerate(names)}
+        where_clause = f"WHERE {province_col} IN ({', '.join(':' + k for k in params)})"
+
+    def group_by(*extra):
+        cols = key_cols + list(extra)
+        return f"GROUP BY {', '.join(cols)}" if cols else ''
+
+    specs = _region_measure_specs(chosen, fields)
+    names = list(specs.keys())
+    measure_q = None
+    if specs:
+        select_measures = ', '.join(f"{_measure_sql(spec, weight, cube, chosen.get('flag_cols'))} AS m_{name}" for name, spec in specs.items())
+        measure_q = text(f"SELECT {key_select}, {select_measures} FROM {table} {where_clause} {group_by()}")
+    dim_qs = {}
+    for dim, expr in _region_dimension_exprs(chosen, fields).items():
+        if cube is not None and not cube.dim(expr):
+            dim_qs[dim] = _cube_flag_dimension_query(cube, cube.flag(expr), dim, key_select, where_clause, group_by(), weight, params)
+            continue
+        if cube is not None:
+            expr = cube.dim(expr)
+        dim_qs[dim] = text(f"SELECT {key_select}, {expr} AS v, SUM({weight}) AS c FROM {table} {where_clause} {group_by(expr)}")
+    return names, measure_q, dim_qs, params
+
+
+def _region_rollups_from_rows(names: List[str], measure_rows, dim_rows: dict) -> dict:
+    """返回 {'measures': [(region, disease, {名称: 值})], 'dims': {维度: [(region, disease, 取值, 计数)]}}。
+    地区级与全国级数值由 _pivot_region_analysis 在 Python 中累加得到。"""
+    measures = [(r[0], r[1], {name: r[2 + i] for i, name in enumerate(names)}) for r in measure_rows]
+    dims = {dim: [(r[0], r[1], r[2], r[3]) for r in rows] for dim, rows in dim_rows.items()}
+    return {'measures': measures, 'dims': dims}
+
+
+def _fetch_region_rollups(conn, chosen: dict, region_list: Optional[List[str]] = None,
+                          cube: Optional[CubeInfo] = None, fields: Optional[RegionFields] = None) -> dict:
+    """在同一连接上依次执行 _region_rollup_queries 的各条查询。"""
+    names, measure_q, dim_qs, params = _region_rollup_queries(chosen, region_list, cube, fields)
+    measure_rows = conn.execute(measure_q, params).fetchall() if measure_q is not None else []
+    dim_rows = {}
+    for dim, q in dim_qs.items():
+        try:
+            dim_rows[dim] = conn.execute(q, params).fetchall()
+        except SQLAlchemyError:
+            # 个别维度表达式在当前数据库不可用（例如 MONTH() 作用于非日期列）时不阻断其它维度
+            dim_rows[dim] = []
+    return _region_rollups_from_rows(names, measure_rows, dim_rows)
+
+
+async def _fetch_region_rollups_async(chosen: dict, region_list: Optional[List[str]] = None,
+                                      cube: Optional[CubeInfo] = None, fields: Optional[RegionFields] = None) -> dict:
+    """异步模式：各条汇总查询互不依赖，分别从连接池取连接并发执行，耗时约等于最慢的一条。"""
+    names, measure_q, dim_qs, params = _region_rollup_queries(chosen, region_list, cube, fields)
+
+    async def fetch(q):
+        if q is None:
+            return []
+        async with async_engine.connect() as conn:
+            return (await conn.execute(q, params)).fetchall()
+
+    dims = list(dim_qs.keys())
+    results = await asyncio.gather(fetch(measure_q), *(fetch(dim_qs[d]) for d in dims), return_exceptions=True)
+    if isinstance(results[0], BaseException):
+        raise results[0]
+    dim_rows = {}
+    for dim, res in zip(dims, results[1:]):
+        if isinstance(res, SQLAlchemyError):
+            dim_rows[dim] = []
+        elif isinstance(res, BaseException):
+            raise res
+        else:
+            dim_rows[dim] = res
+    return _region_rollups_from_rows(names, results[0], dim_rows)
+
+
+def _snapshot_region_rollups(table: ColumnarTable, chosen: dict, region_list: Optional[List[str]] = None,
+                             fields: Optional[RegionFields] = None) -> dict:
+    """与 _fetch_region_rollups 返回相同结构，但在内存快照上用 bincount 分组计算。"""
+    province_col = chosen['province_col']
+    disease_col = _region_disease_col(chosen, fields)
+    weight_col = chosen.get('reported_col') or 'Reported_Cases'
+    weight = table.values(weight_col)
+
+    keys = ([province_col] if region_list else []) + ([disease_col] if disease_col else [])
+    mask = None
+    if region_list:
+        mask = table.isin(province_col, {_region_key(r) for r in region_list}, key=_region_key)
+
+    def split(key_vals):
+        i = 0
+        region = disease = None
+        if region_list:
+            region, i = key_vals[0], 1
+        if disease_col:
+            disease, i = key_vals[i], i + 1
+        return region, disease, key_vals[i:]
+
+    sums, counts = {}, {}
+    for name, (kind, col, values) in _region_measure_specs(chosen, fields).items():
+        if kind == 'flag':
+            sums[name] = np.where(table.flag(col, values), weight, 0.0)
+        elif kind == 'count':
+            counts[name] = ~np.isnan(table.values(col))
+        else:
+            sums[name] = table.values(col)
+    measures = []
+    if sums or counts:
+        for key_vals, vals in table.group_reduce(keys, sums, counts, mask=mask):
+            region, disease, _ = split(key_vals)
+            measures.append((region, disease, vals))
+
+    dims = {}
+    for dim, expr in _region_dimension_exprs(chosen, fields).items():
+        if table.resolve(expr) is None:
+            # 非简单列的表达式（例如 MONTH(date)）在快照中不支持，与 SQL 失败时的处理一致
+            dims[dim] = []
+            continue
+        rows = []
+        for key_vals, vals in table.group_reduce(keys + [expr], {'c': weight}, mask=mask):
+            region, disease, rest = split(key_vals)
+            rows.append((region, disease, rest[0], vals['c']))
+        dims[dim] = rows
+    return {'measures': measures, 'dims': dims}
+
+
+def _bucket_sort_key(k):
+    try:
+        return (0, int(k), '')
+    except (TypeError, ValueError):
+        return (1, 0, str(k))
+
+
+def _sorted_buckets(d: dict) -> dict:
+    return {k: d[k] for k in sorted(d, key=_bucket_sort_key)}
+
+
+def _pivot_region_analysis(rollups: dict, chosen: dict, region_list: Optional[List[str]] = None,
+                           fields: Optional[RegionFields] = None) -> list:
+    """把 _fetch_region_rollups 的 (省, 病种[, 维度]) 粒度结果转置为 /api/region_analysis 的响应结构；
+    给出 fields 时只输出（也只计算）其中的字段。"""
+    has_disease = bool(chosen.get('disease_col'))
+    derive_season = not chosen.get('season_col')
+
+    def disease_key(d):
+        return str(d) if d is not None else 'Unknown'
+
+    # region_key -> disease_key -> {'m': {名称: 值}, 'd': {维度: {原始取值: 计数}}}
+    index = {}
+
+    def cell(region, disease):
+        per = index.setdefault(_region_key(region), {})
+        return per.setdefault(disease_key(disease), {'m': {}, 'd': {}})
+
+    for region, disease, vals in rollups['measures']:
+        c = cell(region, disease)
+        for name, v in vals.items():
+            c['m'][name] = c['m'].get(name, 0) + int(v or 0)
+    for dim, rows in rollups['dims'].items():
+        for region, disease, v, cnt in rows:
+            b = cell(region, disease)['d'].setdefault(dim, {})
+            b[v] = b.get(v, 0) + int(cnt or 0)
+    if derive_season:
+        # 没有 Season 列时由月份分布推导季节分布，无需额外查询
+        for per in index.values():
+            for c in per.values():
+                seasons = {}
+                for m, cnt in c['d'].get('month', {}).items():
+                    try:
+                        season = MONTH_TO_SEASON.get(int(m), 'Unknown') if m else 'Unknown'
+                    except (TypeError, ValueError):
+                        season = 'Unknown'
+                    seasons[season] = seasons.get(season, 0) + cnt
+                c['d']['season'] = seasons
+
+    def buckets(raw: dict, null_key: str) -> dict:
+        out = {}
+        for k, v in raw.items():
+            key = str(k) if k is not None else null_key
+            out[key] = out.get(key, 0) + v
+        return _sorted_buckets(out)
+
+    def days(m: dict) -> dict:
+        cnt = m.get('days_count', 0)
+        return {'sum': m.get('days_sum', 0), 'avg': float(m.get('days_sum', 0)) / cnt if cnt else 0.0, 'count': cnt}
+
+    def symptoms(m: dict) -> dict:
+        return {k: m.get(k, 0) for k in ('fever', 'cough', 'rash') if chosen.get(k + '_col')}
+
+    def with_yes(raw: dict, m: dict, name: str, null_key: str) -> dict:
+        out = buckets(raw, null_key)
+        out['Yes'] = m.get(name, 0)
+        return out
+
+    disease_fields = fields.disease_fields() if fields is not None else DISEASE_FIELDS
+    region_fields = fields.region_fields() if fields is not None else REGION_FIELDS
+    # 病种级字段只在对应列存在时输出（与历史行为一致）
+    disease_field_present = {
+        'travel_history': bool(chosen.get('travel_col')),
+        'quarantined': bool(chosen.get('quarant_col')),
+        # 仅在存在隔离列时输出按病种的城乡分布，并叠加标准化的 Urban/Rural 计数
+        'urban_rural': bool(chosen.get('quarant_col') and chosen.get('urbanr_col')),
+        'symptoms': any(chosen.get(k + '_col') for k in ('fever', 'cough', 'rash')),
+        'days_hospitalized': bool(chosen.get('days_col')),
+        'monthly': bool(chosen.get('month_col')),
+    }
+
+    def disease_urban(m: dict, d: dict) -> dict:
+        urb = buckets(d.get('urban', {}), 'None')
+        if m.get('urban_sum', 0) > 0:
+            urb['Urban'] = urb.get('Urban', 0) + m['urban_sum']
+        if m.get('rural_sum', 0) > 0:
+            urb['Rural'] = urb.get('Rural', 0) + m['rural_sum']
+        return urb
+
+    def disease_entry(c: dict) -> dict:
+        m, d = c['m'], c['d']
+        # 各字段按需计算：未请求的字段不做转置
+        sections = {
+            'total': lambda: m.get('total', 0),
+            'age_distribution': lambda: buckets(d.get('age', {}), 'None'),
+            'gender': lambda: buckets(d.get('gender', {}), 'None'),
+            'season': lambda: buckets(d.get('season', {}), 'None'),
+            'clinical': lambda: buckets(d.get('clinical', {}), 'None'),
+            'social': lambda: buckets(d.get('social', {}), 'None'),
+            'travel_history': lambda: with_yes(d.get('travel', {}), m, 'travel_yes', 'None'),
+            'quarantined': lambda: with_yes(d.get('quarantine', {}), m, 'quarantined_yes', 'None'),
+            'urban_rural': lambda: disease_urban(m, d),
+            'symptoms': lambda: symptoms(m),
+            'days_hospitalized': lambda: days(m),
+            'monthly': lambda: buckets(d.get('month', {}), 'None'),
+        }
+        entry = {}
+        for name in disease_fields:
+            if name in ('deaths', 'recovered', 'hospitalized', 'vaccinated'):
+                if name in m:
+                    entry[name] = m[name]
+            elif disease_field_present.get(name, True):
+                entry[name] = sections[name]()
+        return entry
+
+    out = []
+    for reg in (region_list or [None]):
+        per = index.get(_region_key(reg), {})
+        # 地区级数值 = 各病种之和
+        m_total, d_total = {}, {}
+        for c in per.values():
+            for name, v in c['m'].items():
+                m_total[name] = m_total.get(name, 0) + v
+            for dim, raw in c['d'].items():
+                acc = d_total.setdefault(dim, {})
+                for k, v in raw.items():
+                    acc[k] = acc.get(k, 0) + v
+        sections = {
+            'total': lambda: m_total.get('total', 0),
+            'age_distribution': lambda: buckets(d_total.get('age', {}), 'null'),
+            'gender': lambda: buckets(d_total.get('gender', {}), 'null'),
+            'disease_status': lambda: buckets(d_total.get('status', {}), 'null'),
+            'season': lambda: buckets(d_total.get('season', {}), 'null'),
+            'clinical': lambda: buckets(d_total.get('clinical', {}), 'null'),
+            'social': lambda: buckets(d_total.get('social', {}), 'null'),
+            # 额外字段
+            'deaths': lambda: m_total.get('deaths', 0),
+            'recovered': lambda: m_total.get('recovered', 0),
+            'hospitalized': lambda: m_total.get('hospitalized', 0),
+            'vaccinated': lambda: m_total.get('vaccinated', 0),
+            'travel_history': lambda: with_yes(d_total.get('travel', {}), m_total, 'travel_yes', 'null') if chosen.get('travel_col') else {},
+            'quarantined': lambda: with_yes(d_total.get('quarantine', {}), m_total, 'quarantined_yes', 'null') if chosen.get('quarant_col') else {},
+            'symptoms': lambda: symptoms(m_total),
+            'days_hospitalized': lambda: days(m_total),
+            'urban_rural': lambda: buckets(d_total.get('urban', {}), 'null'),
+            'monthly': lambda: buckets(d_total.get('month', {}), 'null'),
+            # by_disease: per-disease breakdown for each dimension
+            'by_disease': lambda: {k: disease_entry(per[k]) for k in sorted(per)} if has_disease else {},
+        }
+        item = {'region': reg or 'ALL'}
+        for name in region_fields:
+            if name != 'disease_list':
+                item[name] = sections[name]()
+        if has_disease and 'disease_list' in region_fields:
+            item['disease_list'] = list(item['by_disease']) if 'by_disease' in item else sorted(per)
+        out.append(item)
+    return out
+
+
 @app.get('/api/region_analysis')
-def region_analysis(regions: Optional[str] = None, debug: Optional[bool] = False):
+async def region_analysis(request: Request, regions: Optional[str] = None, debug: Optional[bool] = False,
+                          fields: Optional[str] = None, include: Optional[str] = None):
     """
     返回一个或多个省/地区的分析汇总：年龄分布、性别分布、是否患病/确诊情况、季节分布、临床结果、社会活动因素等。
     请求参数：regions（可选，逗号分隔的中文或英文省名），若不提供则返回所有数据的汇总。
+    fields / include（可选，同义）：逗号分隔的字段列表，例如 total,gender,by_disease.monthly，
+    只计算并返回这些字段（region 总是返回），见 RegionFields。
     返回格式：[{ region: '四川', total: 123, age_distribution: {...}, gender: {...}, disease_status: {...}, season: {...}, clinical: {...}, social: {...} }, ...]
+    所有地区共用同一组聚合查询（见 _fetch_region_rollups），地区数增加不会增加数据库往返次数。
     """
     try:
-        with engine.connect() as conn:
-            db_name = engine.url.database
-            cols_q = text("SELECT COLUMN_NAME FROM information_schema.columns WHERE table_schema=:db AND table_name='china_disease_data'")
-            cols_res = conn.execute(cols_q, {'db': db_name})
-            cols = [r[0] for r in cols_res.fetchall()]
-            lowcols = {c.lower(): c for c in cols}
-            # debug 信息：列检测与选择
-            debug_info = {'detected_columns': cols, 'lowcols_keys': list(lowcols.keys()), 'chosen': {}}
-
-            # candidate columns - prefer the actual CSV headers we saw in your file
-            # province column (support both English and Chinese header)
-            province_col = lowcols.get('province') or lowcols.get('province_name') or lowcols.get('区域') or lowcols.get('地区') or 'Province'
-
-            # age: your CSV uses Age_Group (strings like '0-14','15-24','65+')
-            age_col = lowcols.get('age_group') or lowcols.get('age') or lowcols.get('年龄')
-
-            # gender
-            gender_col = lowcols.get('gender') or lowcols.get('sex') or lowcols.get('性别')
-
-            # status / confirmed flags: Lab_Confirmed, Reported_Cases, Reported (we'll use Lab_Confirmed if exists)
-            status_col = lowcols.get('lab_confirmed') or lowcols.get('lab_confirm') or lowcols.get('lab_confirmed_flag') or None
-
-            # date/month/season: CSV has Month, Year, Season columns
-            date_col = lowcols.get('month') or lowcols.get('report_date') or lowcols.get('date') or None
-            season_col = lowcols.get('season') or lowcols.get('季节') or None
-
-            # clinical outcome / recovered / deaths columns
-            clinical_col = lowcols.get('recovered') or lowcols.get('clinical_result') or lowcols.get('outcome') or lowcols.get('结果')
-
-            # social / exposure-like columns (Contact_Tracing, Travel_History, Comorbidity)
-            social_col = lowcols.get('contact_tracing') or lowcols.get('travel_history') or lowcols.get('exposure') or lowcols.get('social_activity')
-
-            # reported cases column (counts)
-            reported_col = lowcols.get('reported_cases') or lowcols.get('cases') or lowcols.get('count') or None
-
-            # 将选择的列记录到 debug_info
-            debug_info['chosen']['province_col'] = province_col
-            debug_info['chosen']['age_col'] = age_col
-            debug_info['chosen']['gender_col'] = gender_col
-            debug_info['chosen']['status_col'] = status_col
-            debug_info['chosen']['date_col'] = date_col
-            debug_info['chosen']['season_col'] = season_col
-            debug_info['chosen']['clinical_col'] = clinical_col
-            debug_info['chosen']['social_col'] = social_col
-            debug_info['chosen']['reported_col'] = reported_col
-
-            # parse regions (support Chinese names passed from frontend). Provide a small mapping
-            cn_to_en = {
-                '北京':'Beijing','上海':'Shanghai','天津':'Tianjin','重庆':'Chongqing',
-                '四川':'Sichuan','河南':'Henan','广东':'Guangdong','北京':'Beijing',
-                '上海':'Shanghai','江苏':'Jiangsu','浙江':'Zhejiang','山东':'Shandong',
-                '湖南':'Hunan','湖北':'Hubei','云南':'Yunnan','贵州':'Guizhou',
-                '陕西':'Shaanxi','广西':'Guangxi','内蒙古':'Inner Mongolia','黑龙江':'Heilongjiang',
-                '吉林':'Jilin','辽宁':'Liaoning','河北':'Hebei','山西':'Shanxi',
-                '安徽':'Anhui','福建':'Fujian','江西':'Jiangxi','海南':'Hainan',
-                '天津':'Tianjin','新疆':'Xinjiang','西藏':'Tibet','宁夏':'Ningxia',
-                '香港':'Hong Kong','澳门':'Macau','台湾':'Taiwan'
-            }
-
-            region_list = None
-            if regions:
-                parsed = [r.strip() for r in regions.split(',') if r.strip()]
-                # map Chinese names to English where possible, but allow either
-                region_list = [cn_to_en.get(r, r) for r in parsed]
-            # helper to run simple group queries
-            def run_group(query, params=None):
-                params = params or {}
-                rows = conn.execute(text(query), params)
-                res = {}
-                for r in rows.mappings():
-                    k = list(r.values())[0]
-                    v = list(r.values())[1]
-                    res[str(k) if k is not None else 'null'] = int(v or 0)
-                return res
-
-            # build where clause for region
-            def region_where(col_name, region):
-                return f"{col_name} = :region"
-
-            targets = region_list if region_list else [None]
-            out = []
-            for reg in targets:
-                where_clause = ''
-                params = {}
-                if reg:
-                    where_clause = f"WHERE {province_col} = :region"
-                    params['region'] = reg
-
-                # total count: prefer summing the reported/cases column when available to match /api/disease_locations
-                count_col_expr = (debug_info['chosen'].get('reported_col') or reported_col) or 'Reported_Cases'
-                total_q = text(f"SELECT SUM({count_col_expr}) as cnt FROM china_disease_data {where_clause}")
-                total = int(conn.execute(total_q, params).fetchone()[0] or 0)
-
-                # age distribution buckets
-                age_dist = {}
-                if age_col:
-                    # Your CSV uses Age_Group values like '0-14','15-24', '65+'; sum by bucket value
-                    q = f"SELECT {age_col} AS bucket, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {age_col}"
-                    rows = conn.execute(text(q), params)
-                    for r in rows.mappings():
-                        k = r.get('bucket')
-                        c = int(r.get('c') or 0)
-                        age_dist[str(k)] = c
-
-                # gender
-                gender_counts = {}
-                if gender_col:
-                    q = f"SELECT {gender_col} AS g, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {gender_col}"
-                    gender_counts = run_group(q, params)
-
-                # disease/status
-                status_counts = {}
-                if status_col:
-                    q = f"SELECT {status_col} AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {status_col}"
-                    status_counts = run_group(q, params)
-
-                # season: prefer explicit Season column; fallback to Month mapping
-                season_counts = {}
-                # detect disease column to allow per-disease breakdown
-                disease_col = lowcols.get('disease') or lowcols.get('disease_type') or lowcols.get('disease_name') or lowcols.get('diseasename') or lowcols.get('type') or None
-                debug_info['chosen']['disease_col'] = disease_col
-                if season_col:
-                    q = f"SELECT {season_col} AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {season_col}"
-                    season_counts = run_group(q, params)
-                elif date_col:
-                    # if date_col is numeric month, use it; if it's Year/Month string this may not apply
-                    # try Month() if column is a date; otherwise if it's numeric month name 'Month' just group by it
-                    try:
-                        q = f"SELECT MONTH({date_col}) AS m, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY MONTH({date_col})"
-                        rows = conn.execute(text(q), params)
-                        month_map = {1:'Winter',2:'Winter',12:'Winter',3:'Spring',4:'Spring',5:'Spring',6:'Summer',7:'Summer',8:'Summer',9:'Autumn',10:'Autumn',11:'Autumn'}
-                        seasons = {}
-                        for r in rows.mappings():
-                            m = r.get('m')
-                            c = int(r.get('c') or 0)
-                            season = month_map.get(int(m), 'Unknown') if m else 'Unknown'
-                            seasons[season] = seasons.get(season, 0) + c
-                        season_counts = seasons
-                    except Exception:
-                        # fallback: try treating the column as integer month or direct grouping
-                        q = f"SELECT {date_col} AS m, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {date_col}"
-                        season_counts = run_group(q, params)
-
-                # clinical result
-                clinical_counts = {}
-                if clinical_col:
-                    q = f"SELECT {clinical_col} AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {clinical_col}"
-                    clinical_counts = run_group(q, params)
-                else:
-                    # fallback: use Recovered / Deaths if present
-                    if 'recovered' in lowcols:
-                        q = f"SELECT Recovered AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY Recovered"
-                        clinical_counts = run_group(q, params)
-                    elif 'deaths' in lowcols:
-                        q = f"SELECT Deaths AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY Deaths"
-                        clinical_counts = run_group(q, params)
-
-                # social activity / exposure
-                social_counts = {}
-                if social_col:
-                    q = f"SELECT {social_col} AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {social_col}"
-                    social_counts = run_group(q, params)
-                else:
-                    # try Contact_Tracing, Travel_History, Comorbidity
-                    for fallback in ['contact_tracing','travel_history','comorbidity']:
-                        if fallback in lowcols:
-                            q = f"SELECT {lowcols[fallback]} AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {lowcols[fallback]}"
-                            social_counts = run_group(q, params)
-                            break
-
-                # --- 额外的区域级别聚合（增强前端所需的维度） ---
-                # 检测可能存在的列并在可能时计算汇总值。所有操作仅使用 SELECT。
-                extra = {}
-                try:
-                    # 简单列候选检测
-                    deaths_col = lowcols.get('deaths') or lowcols.get('death')
-                    recovered_col = lowcols.get('recovered') or lowcols.get('recovery')
-                    hosp_col = lowcols.get('hospitalized') or lowcols.get('hospital') or lowcols.get('icu_admission')
-                    vacc_col = lowcols.get('vaccinated') or lowcols.get('vaccine')
-                    travel_col = lowcols.get('travel_history') or lowcols.get('travel')
-                    quarant_col = lowcols.get('quarantined') or lowcols.get('quarantine')
-                    urbanr_col = lowcols.get('urban_rural') or lowcols.get('urban')
-
-                    # 症状类列（根据 COLUMN_SYNONYMS 建议的标准列名）
-                    fever_col = lowcols.get('symptom_fever') or lowcols.get('symptom_fever')
-                    cough_col = lowcols.get('symptom_cough') or lowcols.get('symptom_cough')
-                    rash_col = lowcols.get('symptom_rash') or lowcols.get('symptom_rash')
-
-                    # 住院天数
-                    days_col = lowcols.get('days_hospitalized') or lowcols.get('days_hospital')
-
-                    # region-level simple sums (如果存在相应列则直接汇总)
-                    def safe_sum(colname, is_flag=False):
-                        """
-                        安全求和：
-                        - 如果 is_flag 为 False，则直接对列做 SUM(col)
-                        - 如果 is_flag 为 True，则把该列视为文本型的布尔标志（例如 'Yes'/'No'），
-                          使用 CASE WHEN LOWER(TRIM(col)) IN (...) THEN count_col_expr ELSE 0 END 进行条件聚合
-                        """
-                        try:
-                            if not colname:
-                                return 0
-                            if not is_flag:
-                                q = text(f"SELECT SUM({colname}) FROM china_disease_data {where_clause}")
-                            else:
-                                # 标准真值集合（兼容中文/大小写/空白）
-                                truth_vals_local = ("yes", "y", "1", "true", "是")
-                                truth_list_local = ",".join([f"'{v}'" for v in truth_vals_local])
-                                # 使用 count_col_expr 作为计数或权重表达式
-                                q = text(f"SELECT SUM(CASE WHEN LOWER(TRIM({colname})) IN ({truth_list_local}) THEN {count_col_expr} ELSE 0 END) FROM china_disease_data {where_clause}")
-                            r = conn.execute(q, params).fetchone()
-                            return int(r[0] or 0)
-                        except Exception:
-                            return 0
-
-                    extra['deaths'] = safe_sum(deaths_col)
-                    # recovered/hospitalized/vaccinated 在你的 CSV 中是 Yes/No 标志，
-                    # 因此使用基于真值的条件聚合（is_flag=True）来统计实际的病例数
-                    extra['recovered'] = safe_sum(recovered_col, is_flag=True)
-                    extra['hospitalized'] = safe_sum(hosp_col, is_flag=True)
-                    extra['vaccinated'] = safe_sum(vacc_col, is_flag=True)
-
-                    # travel / quarantine: 分组汇总，以便前端展示分布（如有）
-                    travel_summary = {}
-                    # 1) 原始分布（若存在列），2) 同时计算标准化的 Yes 计数（大小写/空白无关，接受常见真值）
-                    truth_vals = ("yes","y","1","true","是")
-                    if travel_col:
-                        q = f"SELECT {travel_col} AS v, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {travel_col}"
-                        travel_summary = run_group(q, params)
-                        # 计算标准化的 "Yes" 计数
-                        truth_list = ",".join([f"'{v}'" for v in truth_vals])
-                        q_yes = f"SELECT SUM(CASE WHEN LOWER(TRIM({travel_col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS yes_sum FROM china_disease_data {where_clause}"
-                        try:
-                            r = conn.execute(text(q_yes), params).fetchone()
-                            travel_summary['Yes'] = int(r[0] or 0)
-                        except Exception:
-                            travel_summary['Yes'] = travel_summary.get('Yes', 0)
-                    elif 'travel_history' in lowcols:
-                        col = lowcols['travel_history']
-                        q = f"SELECT {col} AS v, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {col}"
-                        travel_summary = run_group(q, params)
-                        truth_list = ",".join([f"'{v}'" for v in truth_vals])
-                        q_yes = f"SELECT SUM(CASE WHEN LOWER(TRIM({col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS yes_sum FROM china_disease_data {where_clause}"
-                        try:
-                            r = conn.execute(text(q_yes), params).fetchone()
-                            travel_summary['Yes'] = int(r[0] or 0)
-                        except Exception:
-                            travel_summary['Yes'] = travel_summary.get('Yes', 0)
-                    extra['travel_history'] = travel_summary
-
-                    quarantine_summary = {}
-                    if quarant_col:
-                        q = f"SELECT {quarant_col} AS v, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {quarant_col}"
-                        quarantine_summary = run_group(q, params)
-                        truth_list = ",".join([f"'{v}'" for v in truth_vals])
-                        q_yes = f"SELECT SUM(CASE WHEN LOWER(TRIM({quarant_col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS yes_sum FROM china_disease_data {where_clause}"
-                        try:
-                            r = conn.execute(text(q_yes), params).fetchone()
-                            quarantine_summary['Yes'] = int(r[0] or 0)
-                        except Exception:
-                            quarantine_summary['Yes'] = quarantine_summary.get('Yes', 0)
-                    extra['quarantined'] = quarantine_summary
-
-                    # symptoms 汇总（针对存在的症状列，按 count_col_expr 做求和）
-                    # 使用更严格且鲁棒的判定：仅当症状列标准化后等于 yes/真值集合时才计入。
-                    symptoms = {}
-                    truth_vals = ("yes", "y", "1", "true", "是")
-                    truth_list = ",".join([f"'{v}'" for v in truth_vals])
-                    if fever_col and fever_col in lowcols.values():
-                        col = fever_col
-                        q = f"SELECT SUM(CASE WHEN LOWER(TRIM({col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS c FROM china_disease_data {where_clause}"
-                        try:
-                            r = conn.execute(text(q), params).fetchone()
-                            symptoms['fever'] = int(r[0] or 0)
-                        except Exception:
-                            symptoms['fever'] = 0
-                    if cough_col and cough_col in lowcols.values():
-                        col = cough_col
-                        q = f"SELECT SUM(CASE WHEN LOWER(TRIM({col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS c FROM china_disease_data {where_clause}"
-                        try:
-                            r = conn.execute(text(q), params).fetchone()
-                            symptoms['cough'] = int(r[0] or 0)
-                        except Exception:
-                            symptoms['cough'] = 0
-                    if rash_col and rash_col in lowcols.values():
-                        col = rash_col
-                        q = f"SELECT SUM(CASE WHEN LOWER(TRIM({col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS c FROM china_disease_data {where_clause}"
-                        try:
-                            r = conn.execute(text(q), params).fetchone()
-                            symptoms['rash'] = int(r[0] or 0)
-                        except Exception:
-                            symptoms['rash'] = 0
-                    extra['symptoms'] = symptoms
-
-                    # days hospitalized: sum/avg/count
-                    dh = {'sum': 0, 'avg': 0.0, 'count': 0}
-                    if days_col:
-                        try:
-                            q = text(f"SELECT SUM({days_col}) AS s, AVG({days_col}) AS a, COUNT({days_col}) AS c FROM china_disease_data {where_clause}")
-                            r = conn.execute(q, params).fetchone()
-                            dh['sum'] = int(r['s'] or 0) if r['s'] is not None else 0
-                            try:
-                                dh['avg'] = float(r['a']) if r['a'] is not None else 0.0
-                            except Exception:
-                                dh['avg'] = 0.0
-                            dh['count'] = int(r['c'] or 0)
-                        except Exception:
-                            pass
-                    extra['days_hospitalized'] = dh
-
-                    # urban/rural breakdown
-                    urb = {}
-                    if urbanr_col:
-                        q = f"SELECT {urbanr_col} AS v, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {urbanr_col}"
-                        urb = run_group(q, params)
-                    extra['urban_rural'] = urb
-
-                    # monthly / timeseries: 若有 Month 或 date_col，则按月汇总
-                    monthly = {}
-                    month_col = None
-                    if 'month' in lowcols:
-                        month_col = lowcols['month']
-                    elif date_col:
-                        month_col = None
-                    if month_col:
-                        q = f"SELECT {month_col} AS m, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {month_col} ORDER BY {month_col}"
-                        monthly = run_group(q, params)
-                    elif date_col:
-                        try:
-                            q = f"SELECT MONTH({date_col}) AS m, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY MONTH({date_col}) ORDER BY MONTH({date_col})"
-                            rows = conn.execute(text(q), params)
-                            for r in rows.mappings():
-                                m = r.get('m')
-                                c = int(r.get('c') or 0)
-                                monthly[str(int(m))] = c
-                        except Exception:
-                            monthly = {}
-                    extra['monthly'] = monthly
-                except Exception:
-                    # 任何额外聚合失败都不要阻断主流程；记录为空
-                    extra = {k: 0 for k in ['deaths','recovered','hospitalized','vaccinated']}
-
-                # 把结果 append 到输出中
-                out.append({
-                    'region': reg or 'ALL',
-                    'total': total,
-                    'age_distribution': age_dist,
-                    'gender': gender_counts,
-                    'disease_status': status_counts,
-                    'season': season_counts,
-                    'clinical': clinical_counts,
-                    'social': social_counts,
-                    # 额外字段
-                    'deaths': extra.get('deaths', 0),
-                    'recovered': extra.get('recovered', 0),
-                    'hospitalized': extra.get('hospitalized', 0),
-                    'vaccinated': extra.get('vaccinated', 0),
-                    'travel_history': extra.get('travel_history', {}),
-                    'quarantined': extra.get('quarantined', {}),
-                    'symptoms': extra.get('symptoms', {}),
-                    'days_hospitalized': extra.get('days_hospitalized', {}),
-                    'urban_rural': extra.get('urban_rural', {}),
-                    'monthly': extra.get('monthly', {}),
-                    # by_disease: per-disease breakdown for each dimension (filled below if possible)
-                    'by_disease': {}
-                })
-                # If we have a disease column, compute per-disease breakdowns for this region
-                if disease_col:
-                    # build initial disease totals
-                    per_idx = { }
-                    qd = f"SELECT {disease_col} AS disease, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                    rowsd = conn.execute(text(qd), params)
-                    for r2 in rowsd.mappings():
-                        dname = r2.get('disease')
-                        key = str(dname) if dname is not None else 'Unknown'
-                        per_idx[key] = {'total': int(r2.get('c') or 0), 'age_distribution': {}, 'gender': {}, 'season': {}, 'clinical': {}, 'social': {}}
-
-                    # age buckets per disease
-                    if age_col:
-                        q = f"SELECT {disease_col} AS disease, {age_col} AS bucket, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, {age_col}"
-                        for r3 in conn.execute(text(q), params).mappings():
-                            dn = r3.get('disease')
-                            key = str(dn) if dn is not None else 'Unknown'
-                            b = r3.get('bucket')
-                            c = int(r3.get('c') or 0)
-                            if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                            per_idx[key]['age_distribution'][str(b)] = per_idx[key]['age_distribution'].get(str(b),0) + c
-
-                    # gender per disease
-                    if gender_col:
-                        q = f"SELECT {disease_col} AS disease, {gender_col} AS g, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, {gender_col}"
-                        for r3 in conn.execute(text(q), params).mappings():
-                            dn = r3.get('disease')
-                            key = str(dn) if dn is not None else 'Unknown'
-                            g = r3.get('g')
-                            c = int(r3.get('c') or 0)
-                            if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                            per_idx[key]['gender'][str(g)] = per_idx[key]['gender'].get(str(g),0) + c
-
-                    # season per disease (handle date_col->month->season mapping similarly)
-                    if season_col:
-                        q = f"SELECT {disease_col} AS disease, {season_col} AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, {season_col}"
-                        for r3 in conn.execute(text(q), params).mappings():
-                            dn = r3.get('disease')
-                            key = str(dn) if dn is not None else 'Unknown'
-                            s = r3.get('s')
-                            c = int(r3.get('c') or 0)
-                            if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                            per_idx[key]['season'][str(s)] = per_idx[key]['season'].get(str(s),0) + c
-                    elif date_col:
-                        try:
-                            q = f"SELECT {disease_col} AS disease, MONTH({date_col}) AS m, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, MONTH({date_col})"
-                            month_map = {1:'Winter',2:'Winter',12:'Winter',3:'Spring',4:'Spring',5:'Spring',6:'Summer',7:'Summer',8:'Summer',9:'Autumn',10:'Autumn',11:'Autumn'}
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                m = r3.get('m')
-                                c = int(r3.get('c') or 0)
-                                season = month_map.get(int(m), 'Unknown') if m else 'Unknown'
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                per_idx[key]['season'][season] = per_idx[key]['season'].get(season,0) + c
-                        except Exception:
-                            pass
-
-                    # clinical per disease
-                    if clinical_col:
-                        q = f"SELECT {disease_col} AS disease, {clinical_col} AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, {clinical_col}"
-                        for r3 in conn.execute(text(q), params).mappings():
-                            dn = r3.get('disease')
-                            key = str(dn) if dn is not None else 'Unknown'
-                            s = r3.get('s')
-                            c = int(r3.get('c') or 0)
-                            if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                            per_idx[key]['clinical'][str(s)] = per_idx[key]['clinical'].get(str(s),0) + c
-
-                    # social per disease
-                    if social_col:
-                        q = f"SELECT {disease_col} AS disease, {social_col} AS s, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, {social_col}"
-                        for r3 in conn.execute(text(q), params).mappings():
-                            dn = r3.get('disease')
-                            key = str(dn) if dn is not None else 'Unknown'
-                            s = r3.get('s')
-                            c = int(r3.get('c') or 0)
-                            if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                            per_idx[key]['social'][str(s)] = per_idx[key]['social'].get(str(s),0) + c
-
-                    # ----- 新增：按病种的额外聚合（deaths/recovered/hospitalized/vaccinated/symptoms/days/monthly/travel/quarantine） -----
-                    try:
-                        # 候选列（使用 lowcols 中的真实列名）
-                        deaths_col = lowcols.get('deaths') or lowcols.get('death')
-                        recovered_col = lowcols.get('recovered')
-                        hosp_col = lowcols.get('hospitalized') or lowcols.get('icu_admission')
-                        vacc_col = lowcols.get('vaccinated')
-                        travel_col = lowcols.get('travel_history')
-                        quarant_col = lowcols.get('quarantined')
-                        fever_col = lowcols.get('symptom_fever')
-                        cough_col = lowcols.get('symptom_cough')
-                        rash_col = lowcols.get('symptom_rash')
-                        days_col = lowcols.get('days_hospitalized')
-                        month_col = lowcols.get('month')
-
-                        # numeric sums per disease (if columns exist)
-                        if deaths_col:
-                            q = f"SELECT {disease_col} AS disease, SUM({deaths_col}) AS v FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                v = int(r3.get('v') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                per_idx[key]['deaths'] = v
-
-                        if recovered_col:
-                            # recovered 字段在 CSV 中通常是 Yes/No 标志，使用标准化真值集合做条件聚合
-                            truth_vals = ("yes", "y", "1", "true", "是")
-                            truth_list = ",".join([f"'{v}'" for v in truth_vals])
-                            q = f"SELECT {disease_col} AS disease, SUM(CASE WHEN LOWER(TRIM({recovered_col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS v FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                v = int(r3.get('v') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                per_idx[key]['recovered'] = v
-
-                        if hosp_col:
-                            # hosp (hospitalized) 也可能是 Yes/No 标志，按真值条件聚合
-                            truth_vals = ("yes", "y", "1", "true", "是")
-                            truth_list = ",".join([f"'{v}'" for v in truth_vals])
-                            q = f"SELECT {disease_col} AS disease, SUM(CASE WHEN LOWER(TRIM({hosp_col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS v FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                v = int(r3.get('v') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                per_idx[key]['hospitalized'] = v
-
-                        if vacc_col:
-                            # vaccinated 字段也是标志型，使用真值条件聚合统计已接种的人数/计数
-                            truth_vals = ("yes", "y", "1", "true", "是")
-                            truth_list = ",".join([f"'{v}'" for v in truth_vals])
-                            q = f"SELECT {disease_col} AS disease, SUM(CASE WHEN LOWER(TRIM({vacc_col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS v FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                v = int(r3.get('v') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                per_idx[key]['vaccinated'] = v
-
-                        # travel_history / quarantined: grouping per disease
-                        if travel_col:
-                            q = f"SELECT {disease_col} AS disease, {travel_col} AS v, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, {travel_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                val = r3.get('v')
-                                c = int(r3.get('c') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                if 'travel_history' not in per_idx[key]: per_idx[key]['travel_history'] = {}
-                                per_idx[key]['travel_history'][str(val)] = per_idx[key]['travel_history'].get(str(val),0) + c
-                            # 另外计算标准化的 Yes 计数（大小写/空白无关，接受常见真值）
-                            q_yes = f"SELECT {disease_col} AS disease, SUM(CASE WHEN LOWER(TRIM({travel_col})) IN ('yes','y','1','true','是') THEN {count_col_expr} ELSE 0 END) AS yes_sum FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                            for r3 in conn.execute(text(q_yes), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                v = int(r3.get('yes_sum') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                if 'travel_history' not in per_idx[key]: per_idx[key]['travel_history'] = {}
-                                # 将标准化结果放在键 'Yes' 下，便于前端读取
-                                per_idx[key]['travel_history']['Yes'] = v
-
-                        if quarant_col:
-                            q = f"SELECT {disease_col} AS disease, {quarant_col} AS v, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, {quarant_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                val = r3.get('v')
-                                c = int(r3.get('c') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                if 'quarantined' not in per_idx[key]: per_idx[key]['quarantined'] = {}
-                                per_idx[key]['quarantined'][str(val)] = per_idx[key]['quarantined'].get(str(val),0) + c
-                            # 标准化的 Yes 计数
-                            q_yes = f"SELECT {disease_col} AS disease, SUM(CASE WHEN LOWER(TRIM({quarant_col})) IN ('yes','y','1','true','是') THEN {count_col_expr} ELSE 0 END) AS yes_sum FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                            for r3 in conn.execute(text(q_yes), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                v = int(r3.get('yes_sum') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                if 'quarantined' not in per_idx[key]: per_idx[key]['quarantined'] = {}
-                                per_idx[key]['quarantined']['Yes'] = v
-
-                            # urban_rural per disease: group by disease and urban_rural value
-                            if urbanr_col:
-                                q = f"SELECT {disease_col} AS disease, {urbanr_col} AS v, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, {urbanr_col}"
-                                for r3 in conn.execute(text(q), params).mappings():
-                                    dn = r3.get('disease')
-                                    key = str(dn) if dn is not None else 'Unknown'
-                                    val = r3.get('v')
-                                    c = int(r3.get('c') or 0)
-                                    if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                    if 'urban_rural' not in per_idx[key]: per_idx[key]['urban_rural'] = {}
-                                    per_idx[key]['urban_rural'][str(val)] = per_idx[key]['urban_rural'].get(str(val),0) + c
-                                # also compute standardized 'Urban'/'Rural' Yes-like counts if values are non-standard
-                                try:
-                                    q_yes = f"SELECT {disease_col} AS disease, SUM(CASE WHEN LOWER(TRIM({urbanr_col})) IN ('urban','城镇','town','city') THEN {count_col_expr} ELSE 0 END) AS urban_sum, SUM(CASE WHEN LOWER(TRIM({urbanr_col})) IN ('rural','农村','village') THEN {count_col_expr} ELSE 0 END) AS rural_sum FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                                    for r3 in conn.execute(text(q_yes), params).mappings():
-                                        dn = r3.get('disease')
-                                        key = str(dn) if dn is not None else 'Unknown'
-                                        u = int(r3.get('urban_sum') or 0)
-                                        rv = int(r3.get('rural_sum') or 0)
-                                        if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                        if 'urban_rural' not in per_idx[key]: per_idx[key]['urban_rural'] = {}
-                                        # only set when positive to avoid overwriting detailed buckets above
-                                        if u > 0:
-                                            per_idx[key]['urban_rural']['Urban'] = per_idx[key]['urban_rural'].get('Urban', 0) + u
-                                        if rv > 0:
-                                            per_idx[key]['urban_rural']['Rural'] = per_idx[key]['urban_rural'].get('Rural', 0) + rv
-                                except Exception:
-                                    pass
-
-                        # symptoms: use conditional SUM of count_col_expr when symptom column is present
-                        # symptoms per-disease: 使用标准化真值测试（LOWER(TRIM(...)) IN (...))，避免将 'No' 或其他非真值计入
-                        truth_vals = ("yes", "y", "1", "true", "是")
-                        truth_list = ",".join([f"'{v}'" for v in truth_vals])
-                        if fever_col:
-                            q = f"SELECT {disease_col} AS disease, SUM(CASE WHEN LOWER(TRIM({fever_col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS fever_sum FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                v = int(r3.get('fever_sum') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                if 'symptoms' not in per_idx[key]: per_idx[key]['symptoms'] = {}
-                                per_idx[key]['symptoms']['fever'] = v
-                        if cough_col:
-                            q = f"SELECT {disease_col} AS disease, SUM(CASE WHEN LOWER(TRIM({cough_col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS cough_sum FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                v = int(r3.get('cough_sum') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                if 'symptoms' not in per_idx[key]: per_idx[key]['symptoms'] = {}
-                                per_idx[key]['symptoms']['cough'] = v
-                        if rash_col:
-                            q = f"SELECT {disease_col} AS disease, SUM(CASE WHEN LOWER(TRIM({rash_col})) IN ({truth_list}) THEN {count_col_expr} ELSE 0 END) AS rash_sum FROM china_disease_data {where_clause} GROUP BY {disease_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                v = int(r3.get('rash_sum') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                if 'symptoms' not in per_idx[key]: per_idx[key]['symptoms'] = {}
-                                per_idx[key]['symptoms']['rash'] = v
-
-                        # days_hospitalized per disease: sum/avg/count
-                        if days_col:
-                            try:
-                                q = text(f"SELECT {disease_col} AS disease, SUM({days_col}) AS s, AVG({days_col}) AS a, COUNT({days_col}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}")
-                                for r3 in conn.execute(q, params).mappings():
-                                    dn = r3.get('disease')
-                                    key = str(dn) if dn is not None else 'Unknown'
-                                    if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                    per_idx[key]['days_hospitalized'] = {'sum': int(r3.get('s') or 0), 'avg': float(r3.get('a') or 0.0), 'count': int(r3.get('c') or 0)}
-                            except Exception:
-                                pass
-
-                        # monthly per disease
-                        if month_col:
-                            q = f"SELECT {disease_col} AS disease, {month_col} AS m, SUM({count_col_expr}) AS c FROM china_disease_data {where_clause} GROUP BY {disease_col}, {month_col}"
-                            for r3 in conn.execute(text(q), params).mappings():
-                                dn = r3.get('disease')
-                                key = str(dn) if dn is not None else 'Unknown'
-                                m = r3.get('m')
-                                c = int(r3.get('c') or 0)
-                                if key not in per_idx: per_idx[key] = {'total':0,'age_distribution':{},'gender':{},'season':{},'clinical':{},'social':{}}
-                                if 'monthly' not in per_idx[key]: per_idx[key]['monthly'] = {}
-                                per_idx[key]['monthly'][str(m)] = per_idx[key]['monthly'].get(str(m),0) + c
-                    except Exception:
-                        # 如果某些按病种聚合出错，不阻塞整体流程，继续保留已有 per_idx 部分
-                        pass
-
-                    # attach per_idx into the last appended out element
-                    out[-1]['by_disease'] = per_idx
-                    out[-1]['disease_list'] = list(per_idx.keys())
-
-            if debug:
-                return {'debug': debug_info, 'data': out}
-            return out
+        projection = RegionFields.parse(fields, include)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    region_list = _parse_regions(regions)
+    # 缓存键使用排序去重后的省名，不同顺序的同一组地区共用一条缓存
+    key_regions = sorted(set(region_list)) if region_list else None
+    entry = await _cached_entry(('region_analysis', tuple(key_regions or ()), bool(debug), projection.key if projection else None),
+                                lambda: _json_bytes(_region_analysis_data(key_regions, debug, projection)),
+                                lambda: _json_bytes_async(_region_analysis_data_async(key_regions, debug, projection)))
+    if region_list and region_list != key_regions:
+        # 按请求中的顺序（含重复）重新排列
+        payload = loads_json(entry.body)
+        items = payload['data'] if debug else payload
+        by_region = {it['region']: it for it in items}
+        items = [by_region[r] for r in region_list]
+        entry = CacheEntry(_json_bytes({'debug': payload['debug'], 'data': items} if debug else items))
+    return _etag_response(request, entry)
+
+
+def _region_analysis_data(region_list: Optional[List[str]], debug: Optional[bool] = False,
+                          fields: Optional[RegionFields] = None):
+    try:
+        snap = _current_snapshot()
+        if snap is not None:
+            cmap = _get_column_map()
+            chosen = cmap.region
+            rollups = _snapshot_region_rollups(snap, chosen, region_list, fields)
+            source = 'snapshot'
+        else:
+            cube = _get_cube()
+            with engine.connect() as conn:
+                cmap = _get_column_map(conn=conn)
+                chosen = cmap.region
+                if cube is not None and not _cube_covers_region(cube, chosen, fields):
+                    cube = None
+                rollups = _fetch_region_rollups(conn, chosen, region_list, cube, fields)
+            source = cube.table if cube is not None else 'china_disease_data'
+        return _region_analysis_result(cmap, rollups, region_list, debug, source, fields)
     except SQLAlchemyError as e:
         import traceback
         traceback.print_exc()
@@ -904,13 +1499,621 @@ def region_analysis(regions: Optional[str] = None, debug: Optional[bool] = False
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def _region_analysis_data_async(region_list: Optional[List[str]], debug: Optional[bool] = False,
+                                      fields: Optional[RegionFields] = None):
+    try:
+        cmap = await _get_column_map_async()
+        snap = _current_snapshot()
+        if snap is not None:
+            rollups = _snapshot_region_rollups(snap, cmap.region, region_list, fields)
+            source = 'snapshot'
+        else:
+            cube = await _get_cube_async()
+            if cube is not None and not _cube_covers_region(cube, cmap.region, fields):
+                cube = None
+            rollups = await _fetch_region_rollups_async(cmap.region, region_list, cube, fields)
+            source = cube.table if cube is not None else 'china_disease_data'
+        return _region_analysis_result(cmap, rollups, region_list, debug, source, fields)
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _region_analysis_result(cmap: ColumnMap, rollups: dict, region_list: Optional[List[str]], debug: Optional[bool] = False,
+                            source: Optional[str] = None, fields: Optional[RegionFields] = None):
+    out = _pivot_region_analysis(rollups, cmap.region, region_list, fields)
+    if debug:
+        # debug 信息：列检测与选择，以及数据来源（原表 / 汇总表 / 内存快照）
+        debug_info = {'detected_columns': cmap.columns, 'lowcols_keys': list(cmap.lowcols.keys()), 'chosen': dict(cmap.region),
+                      'source': source}
+        return {'debug': debug_info, 'data': out}
+    return out
+
+
+# ---------- 逐月趋势（见 trend.py） ----------
+# 一次分组查询得到 省 × 病种 × 年月 的病例/死亡数，构建稠密数组并预先计算默认窗口下的统计；
+# 该数组一直复用到响应缓存被清空（快照刷新、汇总表重建、表结构刷新等）或超过缓存有效期，
+# 各种 provinces/diseases/window 组合的请求只是从中取行。
+_trend_lock = threading.Lock()
+_trend_state = {'cube': None, 'key': None, 'built_at': 0.0}
+
+
+def _trend_columns(cmap: ColumnMap) -> dict:
+    chosen = cmap.region
+    return {'province': chosen['province_col'], 'disease': chosen.get('disease_col'),
+            'year': cmap.lowcols.get('year'), 'month': chosen.get('month_col'),
+            'cases': chosen.get('reported_col') or 'Reported_Cases', 'deaths': chosen.get('deaths_col')}
+
+
+def _trend_rows_sql(cols: dict, cube: Optional[CubeInfo] = None):
+    """按 省, 病种, 年, 月 分组的病例数与死亡数；汇总表覆盖这些列时改查汇总表。"""
+    keys = [cols['province'], cols['disease'], cols['year'], cols['month']]
+    table = 'china_disease_data'
+    measures = [cols['cases'], cols['deaths']]
+    if cube is not None:
+        cube_keys = [cube.dim(k) for k in keys]
+        cube_measures = [cube.sum(m) if m else None for m in measures]
+        if all(cube_keys) and cube_measures[0] and (cube_measures[1] or not measures[1]):
+            keys, measures, table = cube_keys, cube_measures, cube.table
+    sums = ', '.join(f'SUM({m})' if m else '0' for m in measures)
+    group = ', '.join(keys)
+    return text(f'SELECT {group}, {sums} FROM {table} GROUP BY {group}')
+
+
+def _snapshot_trend_rows(table: ColumnarTable, cols: dict):
+    sums = {'cases': table.values(cols['cases'])}
+    if cols['deaths']:
+        sums['deaths'] = table.values(cols['deaths'])
+    groups = table.group_reduce([cols['province'], cols['disease'], cols['year'], cols['month']], sums)
+    return [k + (v['cases'], v.get('deaths', 0)) for k, v in groups]
+
+
+def _trend_cube() -> TrendCube:
+    snap = _current_snapshot()
+    key = (response_cache.generation, id(snap) if snap is not None else None)
+    with _trend_lock:
+        if (_trend_state['cube'] is not None and _trend_state['key'] == key
+                and time.time() - _trend_state['built_at'] < response_cache.ttl):
+            return _trend_state['cube']
+        cmap = _get_column_map()
+        cols = _trend_columns(cmap)
+        if not (cols['disease'] and cols['year'] and cols['month']):
+            raise HTTPException(status_code=400, detail='china_disease_data has no Disease/Year/Month columns')
+        if snap is not None:
+            cube = TrendCube.from_rows(_snapshot_trend_rows(snap, cols))
+        else:
+            with engine.connect() as conn:
+                cube = TrendCube.from_rows(conn.execute(_trend_rows_sql(cols, _get_cube())))
+        _trend_state.update(cube=cube, key=key, built_at=time.time())
+        return cube
+
+
+def _trend_data(provinces: Optional[List[str]], diseases: Optional[List[str]], metric: str, window: int):
+    try:
+        cube = _trend_cube()
+        return {'metric': metric, 'window': window, 'periods': cube.periods,
+                'series': cube.series(provinces, diseases, metric, window)}
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get('/api/trend')
+async def trend(request: Request, provinces: Optional[str] = None, diseases: Optional[str] = None,
+                metric: str = 'cases', window: int = TREND_DEFAULT_WINDOW):
+    """
+    逐月时间序列：periods 为连续的 'YYYY-MM'（没有数据的月份补 0），series 每项包含 values（逐月数值）、
+    rolling_sum / rolling_mean（最近 window 个月）、yoy_delta / yoy_pct（与上年同月相比）、
+    seasonal_index（1-12 月的季节指数）与 total。
+    provinces、diseases 为逗号分隔的列表（省名可用中文）：两者都给时每个 (省, 病种) 一条序列，
+    只给一个时逐个给出（另一维合计），都不给时为全国合计。metric 为 cases 或 deaths。
+    """
+    if metric not in TREND_METRICS:
+        raise HTTPException(status_code=400, detail=f'metric must be one of {", ".join(TREND_METRICS)}')
+    if not 1 <= window <= TREND_MAX_WINDOW:
+        raise HTTPException(status_code=400, detail=f'window must be between 1 and {TREND_MAX_WINDOW}')
+    province_list = _parse_regions(provinces)
+    disease_list = [d.strip() for d in diseases.split(',') if d.strip()] if diseases else None
+    entry = await _cached_entry(('trend', tuple(province_list or ()), tuple(disease_list or ()), metric, window),
+                                lambda: _json_bytes(_trend_data(province_list, disease_list, metric, window)))
+    return _etag_response(request, entry)
+
+
+# ---------- 桑基图：省 → 中间维度 → 病种（见 sankey.py） ----------
+# 前端原先下载全部省份的 region_analysis 后在浏览器里挑 Top-K 并拼接连线；
+# 现在一次 GROUP BY (省, 中间维度, 病种) 查询后在服务端选 Top-K，只返回 ECharts 需要的节点与连线。
+SANKEY_MAX_K = int(os.environ.get('SANKEY_MAX_K') or 100)
+
+
+def _sankey_middle_columns(cmap: ColumnMap) -> dict:
+    """可作为中间一层的维度：region_analysis 的分布维度中直接对应表中某一列的那些（month 可能是 MONTH(日期) 表达式）。"""
+    columns = set(cmap.columns)
+    return {name: expr for name, expr in _region_dimension_exprs(cmap.region).items() if expr in columns}
+
+
+def _sankey_rows_sql(cols: dict, cube: Optional[CubeInfo] = None):
+    keys = [cols['province'], cols['middle'], cols['disease']]
+    weight, table = cols['cases'], 'china_disease_data'
+    if cube is not None:
+        cube_keys = [cube.dim(k) for k in keys]
+        if all(cube_keys) and cube.sum(weight):
+            keys, weight, table = cube_keys, cube.sum(weight), cube.table
+    group = ', '.join(keys)
+    return text(f'SELECT {group}, SUM({weight}) FROM {table} GROUP BY {group}')
+
+
+def _sankey_data(top_provinces: int, top_diseases: int, middle: str):
+    try:
+        snap = _current_snapshot()
+        cmap = _get_column_map()
+        middles = _sankey_middle_columns(cmap)
+        if middle not in middles:
+            raise HTTPException(status_code=400, detail=f'middle must be one of {", ".join(middles) or "(none)"}')
+        chosen = cmap.region
+        if not chosen.get('disease_col'):
+            raise HTTPException(status_code=400, detail='china_disease_data has no Disease column')
+        cols = {'province': chosen['province_col'], 'middle': middles[middle], 'disease': chosen['disease_col'],
+                'cases': chosen.get('reported_col') or 'Reported_Cases'}
+        if snap is not None:
+            groups = snap.group_reduce([cols['province'], cols['middle'], cols['disease']],
+                                       {'cases': snap.values(cols['cases'])})
+            rows = [k + (v['cases'],) for k, v in groups]
+        else:
+            with engine.connect() as conn:
+                rows = conn.execute(_sankey_rows_sql(cols, _get_cube())).fetchall()
+        graph = SankeyCube.from_rows(rows, middle_order=_bucket_sort_key).graph(top_provinces, top_diseases)
+        return {'middle': middle, 'top_provinces': top_provinces, 'top_diseases': top_diseases, **graph}
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get('/api/sankey')
+async def sankey(request: Request, top_provinces: int = 10, top_diseases: int = 15, middle: str = 'season'):
+    """
+    桑基图数据：病例数最多的 top_provinces 个省 → 中间维度（middle：season、age 等）→ 这些省内病例数最多的
+    top_diseases 个病种。返回 { nodes: [{name, depth}], links: [{source, target, value}], total }，
+    links 的 source / target 为 nodes 的下标，可直接作为 ECharts series-sankey 的 data / links。
+    """
+    for name, k in (('top_provinces', top_provinces), ('top_diseases', top_diseases)):
+        if not 1 <= k <= SANKEY_MAX_K:
+            raise HTTPException(status_code=400, detail=f'{name} must be between 1 and {SANKEY_MAX_K}')
+    entry = await _cached_entry(('sankey', top_provinces, top_diseases, middle),
+                                lambda: _json_bytes(_sankey_data(top_provinces, top_diseases, middle)))
+    return _etag_response(request, entry)
+
+
+# ---------- 住院天数层级汇总：病种 → 年龄段 → 天数分组（见 hospitalization.py） ----------
+# 按住院天数的原始取值分组（取值种类很少），分桶在 Python 中完成，所以改变分组边界不需要不同的 SQL。
+# 汇总表只保存住院天数的和与计数，不能按天数分组，因此这里总是查原表（或内存快照）。
+
+def _hospitalization_rows_sql(cols: dict, region_list: Optional[List[str]] = None):
+    where = [f"{cols['days']} IS NOT NULL"]
+    params = {}
+    if region_list:
+        names = list(dict.fromkeys(region_list))
+        params = {f'r{i}': n for i, n in enumerate(names)}
+        where.append(f"{cols['province']} IN ({', '.join(':' + k for k in params)})")
+    group = f"{cols['disease']}, {cols['age']}, {cols['days']}"
+    return text(f"SELECT {group}, COUNT(*), SUM({cols['cases']}) FROM china_disease_data "
+                f"WHERE {' AND '.join(where)} GROUP BY {group}"), params
+
+
+def _snapshot_hospitalization_rows(table: ColumnarTable, cols: dict, region_list: Optional[List[str]] = None):
+    mask = ~np.isnan(table.values(cols['days']))
+    if region_list:
+        mask &= table.isin(cols['province'], {_region_key(r) for r in region_list}, key=_region_key)
+    groups = table.group_reduce([cols['disease'], cols['age'], cols['days']],
+                                {'cases': table.values(cols['cases'])}, {'records': mask}, mask=mask)
+    return [k + (v['records'], v['cases']) for k, v in groups]
+
+
+def _hospitalization_data(region_list: Optional[List[str]], edges: tuple):
+    try:
+        snap = _current_snapshot()
+        chosen = _get_column_map().region
+        if not (chosen.get('disease_col') and chosen.get('age_col') and chosen.get('days_col')):
+            raise HTTPException(status_code=400, detail='china_disease_data has no Disease/Age_Group/Days_Hospitalized columns')
+        cols = {'province': chosen['province_col'], 'disease': chosen['disease_col'], 'age': chosen['age_col'],
+                'days': chosen['days_col'], 'cases': chosen.get('reported_col') or 'Reported_Cases'}
+        if snap is not None:
+            rows = _snapshot_hospitalization_rows(snap, cols, region_list)
+        else:
+            sql, params = _hospitalization_rows_sql(cols, region_list)
+            with engine.connect() as conn:
+                rows = conn.execute(sql, params).fetchall()
+        return build_hospitalization_tree(rows, edges, age_order=_bucket_sort_key)
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get('/api/hospitalization_tree')
+async def hospitalization_tree(request: Request, regions: Optional[str] = None, bins: Optional[str] = None):
+    """
+    住院天数的层级汇总：病种 → 年龄段 → 住院天数分组，可直接作为 ECharts treemap / sunburst 的 data。
+    请求参数：regions（可选，逗号分隔的省名，可用中文）；bins（可选，逗号分隔的分组边界，默认 0,3,7,14,30）。
+    每个节点为 { name, value（记录数）, cases, days_sum, avg_days, children }；返回
+    { edges, bins（分组名称）, total（全部记录的合计）, data（病种节点列表） }。
+    """
+    try:
+        edges = parse_hospitalization_edges(bins)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    region_list = _parse_regions(regions)
+    key_regions = sorted(set(region_list)) if region_list else None
+    entry = await _cached_entry(('hospitalization_tree', tuple(key_regions or ()), edges),
+                                lambda: _json_bytes(_hospitalization_data(key_regions, edges)))
+    return _etag_response(request, entry)
+
+
+# ---------- 水质得分（第一主成分，见 water_pca.py） ----------
+# 地图的水质热力图层原先在浏览器里下载整份 CSV 后计算 PCA；现在由后端用 NumPy 计算并缓存，
+# 直到数据源变化：WATER_SOURCE=csv 时比较 WATER_CSV_PATH 的修改时间与大小，
+# WATER_SOURCE=db 时比较 china_water_pollution_data 的行数与最大日期（最多每 WATER_CHECK_SECONDS 秒查一次）。
+# 数据变化时优先增量更新（WaterStats）：CSV 只读取上次位置之后追加的行，数据库只读取 Date 晚于上次最大日期的行；
+# 不是单纯追加（文件被改写、补录了旧日期的数据等）时全量重算。
+# GET /api/admin/water_scores/verify 用全量计算核对增量结果，POST /api/admin/water_scores/recompute 强制全量重算。
+WATER_SOURCE = (os.environ.get('WATER_SOURCE') or 'csv').strip().lower()
+WATER_CSV_PATH = os.environ.get('WATER_CSV_PATH') or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'public', 'china_water_pollution_data.csv')
+WATER_TABLE = 'china_water_pollution_data'
+WATER_CHECK_SECONDS = float(os.environ.get('WATER_CHECK_SECONDS') or 30)
+
+_water_lock = threading.Lock()
+_water_state = {'signature': None, 'checked_at': 0.0, 'entry': None, 'stats': None, 'cursor': None}
+
+
+def _water_signature():
+    if DATA_BACKEND == 'shared':
+        _attach_shared_snapshot()
+        if _shared_state['water'] is not None:
+            return ('shared', _shared_state['generation'])
+    if WATER_SOURCE == 'db':
+        with engine.connect() as conn:
+            count, latest = conn.execute(text(f'SELECT COUNT(*), MAX(Date) FROM {WATER_TABLE}')).fetchone()
+        return ('db', int(count or 0), latest)
+    st = os.stat(WATER_CSV_PATH)
+    return ('csv', WATER_CSV_PATH, st.st_mtime_ns, st.st_size)
+
+
+def _load_water_matrix() -> WaterMatrix:
+    """全量读取（核对用）；shared 模式下为共享快照中的数据。"""
+    if DATA_BACKEND == 'shared' and _shared_state['water'] is not None:
+        return _shared_state['water']
+    return _read_water_source()
+
+
+def _read_water_source() -> WaterMatrix:
+    if WATER_SOURCE == 'db':
+        with engine.connect() as conn:
+            return WaterMatrix.from_result(conn.execution_options(stream_results=True).execute(text(f'SELECT * FROM {WATER_TABLE}')))
+    return WaterMatrix.from_csv(WATER_CSV_PATH)
+
+
+def _water_full_load(signature):
+    """全量读取并建立增量统计量，返回 (stats, cursor)。"""
+    if signature[0] == 'shared':
+        return WaterStats.from_matrix(_load_water_matrix()), None
+    if WATER_SOURCE == 'db':
+        data = _load_water_matrix()
+        return WaterStats.from_matrix(data), {'count': signature[1], 'watermark': signature[2]}
+    data, cursor = read_water_csv(WATER_CSV_PATH)
+    return WaterStats.from_matrix(data), cursor
+
+
+def _water_append(stats: WaterStats, cursor, signature):
+    """把上次之后追加的数据并入 stats，返回 (追加行数, 新 cursor)；无法增量时返回 (None, None)。"""
+    if signature[0] == 'shared' or cursor is None:
+        # 共享快照每一代都是完整数据
+        return None, None
+    if WATER_SOURCE == 'db':
+        count, watermark = signature[1], signature[2]
+        if cursor['watermark'] is None or count < cursor['count']:
+            return None, None
+        with engine.connect() as conn:
+            newer = conn.execute(text(f'SELECT COUNT(*) FROM {WATER_TABLE} WHERE Date > :wm'),
+                                 {'wm': cursor['watermark']}).scalar()
+            # 新增的行必须全部晚于上次的最大日期，否则说明有补录或删除
+            if cursor['count'] + int(newer or 0) != count:
+                return None, None
+            data = WaterMatrix.from_result(conn.execution_options(stream_results=True).execute(
+                text(f'SELECT * FROM {WATER_TABLE} WHERE Date > :wm'), {'wm': cursor['watermark']}), features=stats.features)
+        stats.append(data)
+        return data.nrows, {'count': count, 'watermark': watermark}
+    data, new_cursor = read_water_csv(WATER_CSV_PATH, cursor, stats.features)
+    if data is None:
+        return None, None
+    stats.append(data)
+    return data.nrows, new_cursor
+
+
+def _water_scores_entry(force_full: bool = False) -> CacheEntry:
+    """返回缓存的得分；数据源签名变化（或首次调用）时增量更新或全量重算。"""
+    now = time.time()
+    with _water_lock:
+        entry = _water_state['entry']
+        if not force_full and entry is not None and now - _water_state['checked_at'] < (WATER_CHECK_SECONDS if WATER_SOURCE == 'db' else 0):
+            return entry
+        signature = _water_signature()
+        _water_state['checked_at'] = now
+        if not force_full and entry is not None and signature == _water_state['signature']:
+            return entry
+        started = time.time()
+        stats, appended, cursor = _water_state['stats'], None, None
+        if stats is not None and not force_full:
+            appended, cursor = _water_append(stats, _water_state['cursor'], signature)
+        if appended is None:
+            stats, cursor = _water_full_load(signature)
+        result = stats.result()
+        result.update(source='shared' if signature[0] == 'shared' else WATER_SOURCE, mode='full' if appended is None else 'incremental',
+                      appended_rows=appended, seconds=round(time.time() - started, 3))
+        entry = CacheEntry(_json_bytes(result))
+        _water_state.update(signature=signature, entry=entry, stats=stats, cursor=cursor)
+        return entry
+
+
+@app.get('/api/water_quality_scores')
+async def water_quality_scores(request: Request):
+    """各省水质得分：scores 为缩放到 [45, 53] 的值（地图热力图层直接使用），raw 为缩放前的省级均值。"""
+    try:
+        entry = await run_in_threadpool(_water_scores_entry)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f'water data not found: {e.filename}')
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+    return _etag_response(request, entry)
+
+
+@app.post('/api/admin/water_scores/recompute', dependencies=[Depends(_require_admin)])
+def recompute_water_scores():
+    """丢弃增量统计量，从数据源全量重算。"""
+    try:
+        return json.loads(_water_scores_entry(force_full=True).body)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f'water data not found: {e.filename}')
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get('/api/admin/water_scores/verify', dependencies=[Depends(_require_admin)])
+def verify_water_scores():
+    """在完整数据上重新计算（compute_scores），与当前的增量结果逐项比较。"""
+    try:
+        current = json.loads(_water_scores_entry().body)
+        full = compute_scores(_load_water_matrix())
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f'water data not found: {e.filename}')
+    except SQLAlchemyError as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    def max_diff(a: dict, b: dict):
+        if set(a) != set(b):
+            return None
+        return max((abs(a[k] - b[k]) for k in a), default=0.0)
+
+    diffs = {'loadings': max_diff(current['loadings'], full['loadings']),
+             'raw': max_diff(current['raw'], full['raw']),
+             'scores': max_diff(current['scores'], full['scores'])}
+    ok = (current['rows'] == full['rows'] and current['features'] == full['features']
+          and all(d is not None and d <= 1e-6 for d in diffs.values()))
+    return {'ok': ok, 'rows': {'incremental': current['rows'], 'full': full['rows']},
+            'features_match': current['features'] == full['features'], 'max_abs_diff': diffs}
+
+
+# ---------- 上游 LLM 客户端 ----------
+# 三个 AI 端点共用同一个 httpx 连接池（keep-alive），不再每次请求都重新做 DNS/TCP/TLS 握手；
+# LLM_TIMEOUT_CHAT / LLM_TIMEOUT_GENERATE_SQL / LLM_TIMEOUT_FINALIZE 可分别覆盖各端点超时，
+# LLM_MAX_CONCURRENCY 限制同时进行的上游请求数。
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT') or 30)
+
+upstream = UpstreamClient(
+    timeouts={
+        'chat': float(os.environ.get('LLM_TIMEOUT_CHAT') or LLM_TIMEOUT),
+        'generate_sql': float(os.environ.get('LLM_TIMEOUT_GENERATE_SQL') or LLM_TIMEOUT),
+        'finalize': float(os.environ.get('LLM_TIMEOUT_FINALIZE') or LLM_TIMEOUT),
+    },
+    default_timeout=LLM_TIMEOUT,
+    max_connections=int(os.environ.get('LLM_MAX_CONNECTIONS') or 20),
+    max_keepalive=int(os.environ.get('LLM_MAX_KEEPALIVE') or 10),
+    max_concurrency=int(os.environ.get('LLM_MAX_CONCURRENCY') or 8),
+    dns_ttl=float(os.environ.get('LLM_DNS_TTL') or 300),
+)
+
+
+@app.on_event('shutdown')
+async def _close_upstream():
+    await upstream.aclose()
+
+
+async def _upstream_post(endpoint: str, api_url: str, headers: dict, body: dict):
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        resp = await upstream.post(endpoint, api_url, headers=headers, json=body)
+        status = resp.status_code
+        return resp
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f'proxy request failed: {e}')
+    finally:
+        _observe_upstream(endpoint, status, time.perf_counter() - started)
+
+
+def _raise_upstream_error(resp):
+    try:
+        errj = resp.json()
+    except Exception:
+        errj = resp.text
+    raise HTTPException(status_code=502, detail={'upstream_status': resp.status_code, 'upstream': errj})
+
+
+def _chat_upstream_error(resp, debug: Optional[bool] = False):
+    # 如果上游返回错误状态，尽量把状态码与响应体（截断）带回以便排查
+    # 试着解析 json 以获得更有用的信息
+    try:
+        errj = resp.json()
+    except Exception:
+        errj = None
+    if debug:
+        # debug 模式下返回上游全部可用信息（注意：不要返回 API key）
+        return {'upstream_status': resp.status_code, 'upstream_json': errj, 'upstream_text': resp.text}
+    detail_msg = f'upstream status {resp.status_code}'
+    if errj:
+        detail_msg += f' json={errj}'
+    elif resp.text:
+        txt = resp.text
+        if len(txt) > 1000:
+            txt = txt[:1000] + '...'
+        detail_msg += f' text={txt}'
+    raise HTTPException(status_code=502, detail=detail_msg)
+
+
+def _chat_reply(j):
+    """deepseek_chat 的回复提取规则；提取不到时返回 None（调用方把整个 JSON 放在 raw 下返回）。"""
+    if isinstance(j, dict):
+        # common shapes
+        if 'reply' in j:
+            return j['reply']
+        elif j.get('choices') and isinstance(j.get('choices'), list) and j['choices'][0].get('message'):
+            return j['choices'][0]['message'].get('content')
+        elif j.get('result'):
+            return j.get('result')
+    return None
+
+
+def _finalize_reply(j):
+    """ai_sql_finalize 的回复提取规则（优先 choices[0].message.content）。"""
+    if isinstance(j, dict):
+        if j.get('choices') and isinstance(j.get('choices'), list) and j['choices'][0].get('message'):
+            return j['choices'][0]['message'].get('content')
+        elif 'reply' in j:
+            return j['reply']
+        elif 'result' in j:
+            return j['result']
+    return None
+
+
+# ---------- 流式回复 ----------
+# 请求体带 "stream": true（或 "sse" / "ndjson"）时，上游以 stream=true 调用，
+# 收到的 token 立即转发给浏览器：默认 SSE（text/event-stream），
+# "stream": "ndjson" 或 Accept: application/x-ndjson 时为逐行 JSON。
+# 每个事件是一个 JSON 对象：
+#   {"type": "delta", "content": "..."}        增量文本
+#   {"type": "done", "reply": "..."}           结束，reply 为完整回复（提取不到时为 {"type": "done", "raw": {...}}）
+#   {"type": "error", "detail": "..."}         开始转发后才出现的错误
+# 上游在开始转发前返回的错误仍按非流式的方式以 HTTP 状态码返回。
+STREAM_MEDIA_TYPES = {'sse': 'text/event-stream', 'ndjson': 'application/x-ndjson'}
+
+
+def _stream_format(request: Request, payload: dict) -> Optional[str]:
+    mode = payload.get('stream') if isinstance(payload, dict) else None
+    if not mode:
+        return None
+    if isinstance(mode, str) and mode.lower() in STREAM_MEDIA_TYPES:
+        return mode.lower()
+    return 'ndjson' if 'application/x-ndjson' in (request.headers.get('accept') or '') else 'sse'
+
+
+def _stream_event(fmt: str, event: dict) -> bytes:
+    data = json.dumps(event, ensure_ascii=False)
+    return (f'data: {data}\n\n' if fmt == 'sse' else data + '\n').encode('utf-8')
+
+
+def _delta_text(j) -> Optional[str]:
+    """OpenAI 兼容流式片段中的增量文本：choices[0].delta.content（个别实现直接给 message）。"""
+    if isinstance(j, dict) and j.get('choices') and isinstance(j.get('choices'), list) and isinstance(j['choices'][0], dict):
+        part = j['choices'][0].get('delta') or j['choices'][0].get('message') or {}
+        if isinstance(part, dict):
+            return part.get('content')
+    return None
+
+
+async def _upstream_chunks(resp):
+    """把上游响应解析为 JSON 片段序列。SSE 响应逐条 data: 解析；
+    上游不支持流式而直接返回整个 JSON 时，整体作为一个片段。"""
+    if 'text/event-stream' not in (resp.headers.get('content-type') or ''):
+        yield json.loads(await resp.aread())
+        return
+    async for line in resp.aiter_lines():
+        line = line.strip()
+        if not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            break
+        yield json.loads(data)
+
+
+async def _stream_upstream(endpoint: str, api_url: str, headers: dict, body: dict, fmt: str, on_error, extract_reply):
+    """发起流式上游请求并返回 StreamingResponse。上游状态码 >= 400 时交给 on_error 处理
+    （与非流式路径相同）；提取不到增量文本时按 extract_reply 从最后一个片段中提取完整回复。"""
+    stack = AsyncExitStack()
+    started = time.perf_counter()
+    try:
+        resp = await stack.enter_async_context(upstream.stream(endpoint, 'POST', api_url, headers=headers, json=dict(body, stream=True)))
+    except Exception as e:
+        await stack.aclose()
+        _observe_upstream(endpoint, 'error', time.perf_counter() - started)
+        raise HTTPException(status_code=502, detail=f'proxy request failed: {e}')
+    _observe_upstream(endpoint, resp.status_code, time.perf_counter() - started)
+    if resp.status_code >= 400:
+        try:
+            await resp.aread()
+            return on_error(resp)
+        finally:
+            await stack.aclose()
+
+    async def events():
+        parts = []
+        last = None
+        try:
+            async for chunk in _upstream_chunks(resp):
+                last = chunk
+                piece = _delta_text(chunk)
+                if piece:
+                    parts.append(piece)
+                    yield _stream_event(fmt, {'type': 'delta', 'content': piece})
+            if parts:
+                yield _stream_event(fmt, {'type': 'done', 'reply': ''.join(parts)})
+            else:
+                reply = extract_reply(last)
+                if reply is None:
+                    yield _stream_event(fmt, {'type': 'done', 'raw': last})
+                else:
+                    yield _stream_event(fmt, {'type': 'delta', 'content': reply})
+                    yield _stream_event(fmt, {'type': 'done', 'reply': reply})
+        except Exception as e:
+            yield _stream_event(fmt, {'type': 'error', 'detail': f'upstream stream failed: {e}'})
+        finally:
+            await stack.aclose()
+
+    # X-Accel-Buffering: 关闭 nginx 等反向代理的响应缓冲，否则 token 会被攒到最后才下发
+    return StreamingResponse(events(), media_type=STREAM_MEDIA_TYPES[fmt],
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.post('/api/deepseek_chat')
-def deepseek_chat(payload: dict, debug: Optional[bool] = False):
+async def deepseek_chat(request: Request, payload: dict, debug: Optional[bool] = False):
     """Proxy endpoint to call Deepseek-like API.
     SECURITY: The server reads the API key from environment variable DEEPSEEK_API_KEY.
     Do NOT hardcode keys in frontend. This function assumes the remote API accepts a POST
     with JSON { messages: [...] } or { message: '...' } and returns JSON. Adjust as needed to match
     the actual Deepseek API.
+    Send "stream": true to receive the reply incrementally (see the streaming section above).
     """
     key = os.environ.get('DEEPSEEK_API_KEY')
     if not key:
@@ -926,15 +2129,16 @@ def deepseek_chat(payload: dict, debug: Optional[bool] = False):
     # Here we assume a generic endpoint; change to match provider documentation.
     api_url = os.environ.get('DEEPSEEK_API_URL') or 'https://api.deepseek.com/v1/chat'
     # simple DNS pre-check: ensure host resolves before making the request to give clearer errors
+    # 解析结果由 upstream 缓存 LLM_DNS_TTL 秒（连接池建立新连接时也用这份缓存），不会每次请求都阻塞在 getaddrinfo 上
     try:
         host = None
         try:
-            host = (api_url and api_url.startswith('http')) and __import__('urllib.parse').urlparse(api_url).hostname
+            host = (api_url and api_url.startswith('http')) and urlparse(api_url).hostname
         except Exception:
             host = None
         if host:
             try:
-                socket.getaddrinfo(host, None)
+                await upstream.resolve(host)
             except Exception:
                 raise HTTPException(status_code=502, detail=f'无法解析上游主机 {host}，请检查 DEEPSEEK_API_URL 是否正确且可达')
     except HTTPException:
@@ -975,29 +2179,13 @@ def deepseek_chat(payload: dict, debug: Optional[bool] = False):
     messages.append({'role': 'user', 'content': msg})
 
     body = {'model': model, 'messages': messages}
-    try:
-        resp = requests.post(api_url, headers=headers, json=body, timeout=30)
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f'proxy request failed: {e}')
-    # 如果上游返回错误状态，尽量把状态码与响应体（截断）带回以便排查
+    fmt = _stream_format(request, payload)
+    if fmt:
+        return await _stream_upstream('chat', api_url, headers, body, fmt,
+                                      lambda r: _chat_upstream_error(r, debug), _chat_reply)
+    resp = await _upstream_post('chat', api_url, headers, body)
     if resp.status_code >= 400:
-        # 试着解析 json 以获得更有用的信息
-        try:
-            errj = resp.json()
-        except Exception:
-            errj = None
-        if debug:
-            # debug 模式下返回上游全部可用信息（注意：不要返回 API key）
-            return {'upstream_status': resp.status_code, 'upstream_json': errj, 'upstream_text': resp.text}
-        detail_msg = f'upstream status {resp.status_code}'
-        if errj:
-            detail_msg += f' json={errj}'
-        elif resp.text:
-            txt = resp.text
-            if len(txt) > 1000:
-                txt = txt[:1000] + '...'
-            detail_msg += f' text={txt}'
-        raise HTTPException(status_code=502, detail=detail_msg)
+        return _chat_upstream_error(resp, debug)
 
     try:
         j = resp.json()
@@ -1009,15 +2197,7 @@ def deepseek_chat(payload: dict, debug: Optional[bool] = False):
         raise HTTPException(status_code=502, detail=f'bad response from remote (status {resp.status_code}): {txt}')
 
     # try to extract a reasonable reply; leave full JSON as fallback
-    reply = None
-    if isinstance(j, dict):
-        # common shapes
-        if 'reply' in j:
-            reply = j['reply']
-        elif j.get('choices') and isinstance(j.get('choices'), list) and j['choices'][0].get('message'):
-            reply = j['choices'][0]['message'].get('content')
-        elif j.get('result'):
-            reply = j.get('result')
+    reply = _chat_reply(j)
     if reply is None:
         # fallback: return entire json under 'raw'
         return { 'raw': j }
@@ -1025,13 +2205,9 @@ def deepseek_chat(payload: dict, debug: Optional[bool] = False):
 
 
 def _get_table_columns(table_name: str):
-    """返回指定表的列名列表（小写）。用于把表结构传给 LLM 作为上下文说明。"""
+    """返回指定表的列名列表。用于把表结构传给 LLM 作为上下文说明（共用表结构缓存）。"""
     try:
-        with engine.connect() as conn:
-            db_name = engine.url.database
-            q = text("SELECT COLUMN_NAME FROM information_schema.columns WHERE table_schema=:db AND table_name=:tbl")
-            rows = conn.execute(q, {'db': db_name, 'tbl': table_name}).fetchall()
-            return [r[0] for r in rows]
+        return _get_column_map(table_name).columns
     except Exception:
         return []
 
@@ -1175,12 +2351,65 @@ def _map_param_keys_and_values(params: dict):
     return out
 
 
+# ---------- 自然语言 → SQL 翻译缓存 ----------
+# 相同（或仅措辞、标点、中英文名称不同）的问题直接复用已校验的翻译结果，不再调用上游模型。
+# 问题先做规范化：NFKC + 小写，按 COLUMN_SYNONYMS / PROVINCE_NAME_MAP / DISEASE_SYNONYMS
+# 把别名统一为数据库取值，再去掉空白与标点；键还包含模型名与系统提示词哈希
+# （提示词里含表结构与映射表，表结构或映射变化后旧条目自然失效）。
+# NL_SQL_CACHE_PATH 为空字符串时只使用进程内缓存。
+NL_SQL_CACHE_PATH = os.environ.get('NL_SQL_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nl_sql_cache.sqlite3'))
+NL_SQL_CACHE_SIZE = int(os.environ.get('NL_SQL_CACHE_SIZE') or 1024)
+NL_SQL_CACHE_TTL = float(os.environ.get('NL_SQL_CACHE_TTL') or 7 * 86400)
+
+nl_sql_cache = TranslationCache(NL_SQL_CACHE_PATH or None, max_entries=NL_SQL_CACHE_SIZE, ttl=NL_SQL_CACHE_TTL)
+
+
+def _build_question_synonyms():
+    mapping = {}
+    for table in (COLUMN_SYNONYMS, PROVINCE_NAME_MAP, DISEASE_SYNONYMS):
+        for k, v in table.items():
+            mapping[k.lower()] = v.lower()
+    # 长词优先（'肺结核' 先于 '结核'）；英文别名只按整词匹配，避免把 'age' 换进 'average'
+    alts = []
+    for k in sorted(mapping, key=len, reverse=True):
+        pat = re.escape(k)
+        if k.isascii():
+            pat = r'(?<![a-z0-9_])' + pat + r'(?![a-z0-9_])'
+        alts.append(pat)
+    return mapping, re.compile('|'.join(alts))
+
+
+_QUESTION_SYNONYMS, _QUESTION_SYNONYM_RE = _build_question_synonyms()
+# 比较符号、连字符与数字中的小数点保留，否则 "> 100" 与 "< 100" 会被视为同一个问题
+_QUESTION_NOISE_RE = re.compile(r"[\s,，。、;；:：!！?？\"“”'‘’`()（）\[\]【】{}《》~…]|(?<!\d)\.|\.(?!\d)")
+
+
+def _normalize_question(question: str) -> str:
+    q = unicodedata.normalize('NFKC', str(question)).lower()
+    q = _QUESTION_SYNONYM_RE.sub(lambda m: _QUESTION_SYNONYMS[m.group(0)], q)
+    return _QUESTION_NOISE_RE.sub('', q)
+
+
+def _nl_sql_cache_key(model: str, table: str, system_msg: str, normalized: str) -> str:
+    schema_hash = hashlib.sha256(system_msg.encode('utf-8')).hexdigest()[:16]
+    raw = json.dumps([model, table, schema_hash, normalized], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+@app.post('/api/admin/nl_sql_cache/clear', dependencies=[Depends(_require_admin)])
+def clear_nl_sql_cache():
+    """清空自然语言 → SQL 翻译缓存（内存与磁盘两级）。"""
+    nl_sql_cache.clear()
+    return nl_sql_cache.stats()
+
+
 @app.post('/api/ai_generate_sql')
-def ai_generate_sql(payload: dict):
+async def ai_generate_sql(response: Response, payload: dict):
     """第一步：让 AI 生成参数化的只读 SQL 查询。
 
     请求体示例: { "question": "...", "table": "china_disease_data", "model": "deepseek-chat" }
     返回: { "sql": "SELECT ... WHERE province = :region", "params": {"region": "Sichuan"}, "explain": "可选解释文本" }
+    结果按规范化后的问题缓存（响应头 X-NL-SQL-Cache: hit/miss）；请求体带 "no_cache": true 时跳过缓存重新生成。
     """
     if not isinstance(payload, dict):
         raise HTTPException(status_code=400, detail='invalid payload')
@@ -1190,7 +2419,7 @@ def ai_generate_sql(payload: dict):
         raise HTTPException(status_code=400, detail='missing question')
 
     # 读取表结构并构造 system prompt，要求模型只返回 JSON 且不要执行任何 destructive 操作
-    cols = _get_table_columns(table)
+    cols = await run_in_threadpool(_get_table_columns, table)
     cols_text = ', '.join(cols) if cols else 'unknown'
     # 在 system prompt 中加入同义词映射提示，帮助模型生成与数据库值一致的参数
     mapping_hints = []
@@ -1240,21 +2469,26 @@ def ai_generate_sql(payload: dict):
         raise HTTPException(status_code=500, detail='DEEPSEEK_API_KEY not configured on server')
     headers = {'Authorization': f'Bearer {key}', 'Content-Type': 'application/json'}
 
+    cache_key = None
+    normalized = None
+    if nl_sql_cache.enabled:
+        normalized = _normalize_question(question)
+        cache_key = _nl_sql_cache_key(model, table, system_msg, normalized)
+        if not payload.get('no_cache'):
+            cached = await run_in_threadpool(nl_sql_cache.get, cache_key)
+            if cached is not None:
+                response.headers['X-NL-SQL-Cache'] = 'hit'
+                return cached
+        response.headers['X-NL-SQL-Cache'] = 'miss'
+
     messages = [
         {'role': 'system', 'content': system_msg},
         {'role': 'user', 'content': question}
     ]
     body = {'model': model, 'messages': messages}
-    try:
-        resp = requests.post(api_url, headers=headers, json=body, timeout=30)
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f'proxy request failed: {e}')
+    resp = await _upstream_post('generate_sql', api_url, headers, body)
     if resp.status_code >= 400:
-        try:
-            errj = resp.json()
-        except Exception:
-            errj = resp.text
-        raise HTTPException(status_code=502, detail={'upstream_status': resp.status_code, 'upstream': errj})
+        _raise_upstream_error(resp)
     try:
         j = resp.json()
     except Exception:
@@ -1302,22 +2536,215 @@ def ai_generate_sql(payload: dict):
         # mapping 失败不应阻塞主流程
         pass
 
+    if cache_key:
+        await run_in_threadpool(nl_sql_cache.put, cache_key, parsed, normalized)
+
     # 返回解析后对象，前端或下一步执行端点将进一步校验与执行
     return parsed
 
 
+# ---------- execute_sql 的行数限制与分页 ----------
+# 行数上限直接写进 SQL（LIMIT），数据库只计算需要的那一页；结果通过服务端游标
+# （stream_results）分批读取，API 进程内存只与批大小有关。任意 SELECT 没有可靠的唯一排序键，
+# 因此 next_token 是不透明的偏移量令牌，并绑定到 SQL 与参数（换了查询不能复用）。
+EXECUTE_SQL_MAX_ROWS = int(os.environ.get('EXECUTE_SQL_MAX_ROWS') or 10000)
+EXECUTE_SQL_BATCH = int(os.environ.get('EXECUTE_SQL_BATCH') or 500)
+EXECUTE_SQL_FORMATS = {'json': 'application/json', 'ndjson': 'application/x-ndjson', 'csv': 'text/csv',
+                       'msgpack': MEDIA_TYPES['msgpack'], 'arrow': MEDIA_TYPES['arrow']}
+# 边读边发送的格式；其余格式读完当前页后一次编码
+EXECUTE_SQL_STREAM_FORMATS = ('ndjson', 'csv')
+
+# 执行预算（见 sql_guard.py）：EXPLAIN 估计的扫描行数 / 连接产生的行数超过上限时拒绝（0 表示不限制），
+# 每条语句的执行时间上限（毫秒，0 表示不限制）。模型生成的查询使用单独的小连接池，
+# 最多 EXECUTE_SQL_CONCURRENCY 条同时执行（流式响应读完才归还连接），排队超过 EXECUTE_SQL_QUEUE_SECONDS 秒返回 503，
+# 不会占满聚合端点使用的主连接池。
+EXECUTE_SQL_MAX_SCAN_ROWS = int(os.environ.get('EXECUTE_SQL_MAX_SCAN_ROWS') or 5000000)
+EXECUTE_SQL_MAX_JOIN_ROWS = int(os.environ.get('EXECUTE_SQL_MAX_JOIN_ROWS') or 1000000)
+EXECUTE_SQL_TIMEOUT_MS = int(os.environ.get('EXECUTE_SQL_TIMEOUT_MS') or 10000)
+EXECUTE_SQL_CONCURRENCY = int(os.environ.get('EXECUTE_SQL_CONCURRENCY') or 4)
+EXECUTE_SQL_QUEUE_SECONDS = float(os.environ.get('EXECUTE_SQL_QUEUE_SECONDS') or 5)
+
+_analyst_kwargs = {}
+if DB_URL.startswith('sqlite'):
+    # SQLite 文件库默认使用 NullPool（不限连接数），显式改用 QueuePool 才能限制并发
+    _analyst_kwargs = {'poolclass': QueuePool, 'connect_args': {'check_same_thread': False}}
+analyst_engine = create_engine(DB_URL, pool_pre_ping=True, pool_size=EXECUTE_SQL_CONCURRENCY, max_overflow=0,
+                               pool_timeout=EXECUTE_SQL_QUEUE_SECONDS, **_analyst_kwargs)
+install_statement_timeout(analyst_engine, EXECUTE_SQL_TIMEOUT_MS)
+metrics.instrument_engine(analyst_engine)
+
+# 结果缓存（见 result_cache.py）：重试、重复提问时同一条语句与参数直接返回上次读到的那一页，
+# 不再占用专用连接池。键为规范化 SQL（含下推的 LIMIT/OFFSET）与参数值；data_versions 中任一表的数据版本
+# （loader.py 导入后递增）变化即作废，版本每 RESULT_CACHE_VERSION_CHECK_SECONDS 秒读取一次。单页序列化后超过 RESULT_CACHE_MAX_ENTRY_KB 的结果不缓存；
+# 流式格式（ndjson / csv）不经过缓存。RESULT_CACHE_SIZE=0 关闭。
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('RESULT_CACHE_SIZE') or 256),
+    max_bytes=int(float(os.environ.get('RESULT_CACHE_MAX_MB') or 32) * 1024 * 1024),
+    max_entry_bytes=int(float(os.environ.get('RESULT_CACHE_MAX_ENTRY_KB') or 1024) * 1024),
+    ttl=float(os.environ.get('RESULT_CACHE_TTL') or 300),
+)
+RESULT_CACHE_VERSION_CHECK_SECONDS = float(os.environ.get('RESULT_CACHE_VERSION_CHECK_SECONDS') or 5)
+_data_version_state = {'version': (), 'checked_at': 0.0, 'cleared': 0}
+
+
+def _data_version_due() -> bool:
+    return time.time() - _data_version_state['checked_at'] >= RESULT_CACHE_VERSION_CHECK_SECONDS
+
+
+def _data_version():
+    """(手动清空次数, data_versions 中所有表的版本)；数据库中的版本最多每 RESULT_CACHE_VERSION_CHECK_SECONDS 秒读取一次。
+    汇总表也据此判断是否过期（见 _get_cube）。"""
+    now = time.time()
+    if _data_version_due():
+        with engine.connect() as conn:
+            _data_version_state['version'] = read_data_versions(conn)
+        _data_version_state['checked_at'] = now
+    return _data_version_state['cleared'], _data_version_state['version']
+
+_TRAILING_LIMIT_RE = re.compile(r'\blimit\s+(\d+)(?:\s*,\s*(\d+)|\s+offset\s+(\d+))?\s*$', re.IGNORECASE)
+
+
+def _limit_sql(sql: str, limit: int, offset: int = 0) -> str:
+    """在 SQL 层加上 LIMIT/OFFSET。末尾已有字面量 LIMIT 时与之取交集；
+    其它位置出现 LIMIT（子查询、参数化 LIMIT）时包一层派生表；否则直接追加。"""
+    body = sql.strip()
+    m = _TRAILING_LIMIT_RE.search(body)
+    if m:
+        if m.group(2) is not None:
+            # MySQL 的 LIMIT offset, count 写法
+            user_offset, user_limit = int(m.group(1)), int(m.group(2))
+        else:
+            user_limit, user_offset = int(m.group(1)), int(m.group(3) or 0)
+        count = max(0, min(limit, user_limit - offset))
+        return f'{body[:m.start()]}LIMIT {count} OFFSET {user_offset + offset}'
+    # 换行后再追加，避免被 SQL 末尾的 -- 注释吞掉
+    if re.search(r'\blimit\b', body, re.IGNORECASE):
+        return f'SELECT * FROM (\n{body}\n) AS _limited LIMIT {limit} OFFSET {offset}'
+    return f'{body}\nLIMIT {limit} OFFSET {offset}'
+
+
+def _query_fingerprint(sql: str, params: dict) -> str:
+    raw = json.dumps([sql.strip(), params], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]
+
+
+def _encode_next_token(fingerprint: str, offset: int) -> str:
+    raw = json.dumps({'q': fingerprint, 'o': offset}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode_next_token(token: Optional[str], fingerprint: str) -> int:
+    if not token:
+        return 0
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        data = json.loads(raw)
+        offset = int(data['o'])
+    except Exception:
+        raise HTTPException(status_code=400, detail='invalid next_token')
+    if data.get('q') != fingerprint or offset < 0:
+        raise HTTPException(status_code=400, detail='next_token does not match this query')
+    return offset
+
+
+def _execute_sql_error(status_code: int, code: str, message: str, headers: Optional[dict] = None, **extra):
+    """execute_sql 的结构化错误：detail 为 {code, message, ...}，ChatPanel 直接显示 message 与 hint。"""
+    return HTTPException(status_code=status_code, detail={'code': code, 'message': message, **extra}, headers=headers)
+
+
+def _timeout_error():
+    return _execute_sql_error(504, 'query_timeout', f'查询执行超过 {EXECUTE_SQL_TIMEOUT_MS} 毫秒，已被中止',
+                              hint='请增加过滤条件或缩小查询范围', timeout_ms=EXECUTE_SQL_TIMEOUT_MS)
+
+
+def _row_value(v):
+    return v if not isinstance(v, bytes) else v.decode('utf-8', errors='ignore')
+
+
+def _ndjson_default(o):
+    if isinstance(o, Decimal):
+        return float(o)
+    if hasattr(o, 'isoformat'):
+        return o.isoformat()
+    return str(o)
+
+
+def _stream_rows(conn, res, cols: List[str], max_rows: int, fmt: str, next_token: str):
+    """逐批读取服务端游标并编码为 NDJSON 或 CSV；结束（或客户端断开）时关闭连接。"""
+    count = 0
+    more = False
+    try:
+        if fmt == 'ndjson':
+            yield (json.dumps({'type': 'columns', 'columns': cols}, ensure_ascii=False) + '\n').encode('utf-8')
+        else:
+            buf = io.StringIO()
+            csv.writer(buf).writerow(cols)
+            yield buf.getvalue().encode('utf-8')
+        for batch in res.partitions(EXECUTE_SQL_BATCH):
+            if count + len(batch) > max_rows:
+                batch = batch[:max_rows - count]
+                more = True
+            count += len(batch)
+            if fmt == 'ndjson':
+                lines = [json.dumps({'type': 'row', 'row': {c: _row_value(v) for c, v in zip(cols, r)}},
+                                    ensure_ascii=False, default=_ndjson_default) for r in batch]
+                chunk = '\n'.join(lines) + '\n' if lines else ''
+            else:
+                buf = io.StringIO()
+                csv.writer(buf).writerows([[_row_value(v) for v in r] for r in batch])
+                chunk = buf.getvalue()
+            if chunk:
+                yield chunk.encode('utf-8')
+            if more:
+                break
+        if fmt == 'ndjson':
+            end = {'type': 'end', 'row_count': count, 'next_token': next_token if more else None}
+            yield (json.dumps(end) + '\n').encode('utf-8')
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        if fmt == 'ndjson':
+            event = {'type': 'error', 'detail': str(e)}
+            if is_timeout(e):
+                event.update(_timeout_error().detail)
+            yield (json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8')
+    finally:
+        res.close()
+        conn.close()
+
+
 @app.post('/api/execute_sql')
-def execute_sql(payload: dict):
+def execute_sql(request: Request, payload: dict):
     """第二步：安全执行参数化只读 SQL。
 
     请求体示例: { "sql": "SELECT ...", "params": { ... }, "max_rows": 200 }
     限制: 仅允许 SELECT，禁止分号和 DDL/DML 关键字；仅允许访问白名单表（当前默认 china_disease_data）。
+    max_rows 以 LIMIT 的形式下推到数据库（不超过 EXECUTE_SQL_MAX_ROWS）；还有下一页时返回 next_token，
+    把它放进下一次请求体即可取下一页。"format": "ndjson" / "csv" 时边读边流式返回：
+    NDJSON 依次为 columns、row…、end（含 next_token）事件；CSV 在读完之前无法确定是否还有下一页，
+    因此总是在响应头 X-Next-Token 中给出下一页令牌，返回行数少于 max_rows 即为最后一页。
+    "format": "msgpack" 返回与 JSON 结构相同的 MessagePack；"arrow" 返回 Arrow IPC 流（列式，
+    next_token 与行数在响应头 X-Next-Token / X-Row-Count 及 schema 元数据中）。
+    请求体没有 format 时按 Accept 头在 json / msgpack / arrow 中协商。
+    执行前按 EXPLAIN 的估计检查代价，并限制执行时间与并发（见 sql_guard.py）；超出预算、超时与排队超时
+    分别返回 400 / 504 / 503，detail 为 {code, message, hint, ...}。
+    非流式格式的结果按规范化 SQL 与参数缓存（响应头 X-Result-Cache: hit/miss，见 result_cache.py）；
+    请求体带 "no_cache": true 时跳过缓存。
     """
     if not isinstance(payload, dict):
         raise HTTPException(status_code=400, detail='invalid payload')
     sql = payload.get('sql')
     params = payload.get('params') or {}
     max_rows = int(payload.get('max_rows') or 200)
+    if max_rows < 1:
+        raise HTTPException(status_code=400, detail='max_rows must be positive')
+    max_rows = min(max_rows, EXECUTE_SQL_MAX_ROWS)
+    fmt = payload.get('format')
+    fmt = str(fmt).lower() if fmt else negotiate_format(request.headers.get('accept'), ('json', 'msgpack', 'arrow'))
+    if fmt not in EXECUTE_SQL_FORMATS:
+        raise HTTPException(status_code=400, detail=f'unsupported format: {fmt}')
+    if fmt not in EXECUTE_SQL_STREAM_FORMATS and not format_available(fmt):
+        raise HTTPException(status_code=400, detail=f'format {fmt} is not available on this server')
     if not sql:
         raise HTTPException(status_code=400, detail='missing sql')
 
@@ -1371,19 +2798,36 @@ def execute_sql(payload: dict):
         else:
             params_for_exec = params or {}
 
-        with engine.connect() as conn:
-            res = conn.execute(text(sql), params_for_exec)
-            cols = list(res.keys())
-            rows = []
-            # fetch many but avoid unbounded fetch
-            count = 0
-            for r in res:
-                if count >= max_rows:
-                    break
-                # 将 Row 转为普通 dict
-                rows.append({c: (v if not isinstance(v, bytes) else v.decode('utf-8', errors='ignore')) for c,v in zip(cols, r)})
-                count += 1
+        fingerprint = _query_fingerprint(sql, params_for_exec)
+        offset = _decode_next_token(payload.get('next_token'), fingerprint)
+        # 多取一行用来判断是否还有下一页
+        limited_sql = _limit_sql(sql, max_rows + 1, offset)
+        cache_key = cached = None
+        if result_cache.enabled and fmt not in EXECUTE_SQL_STREAM_FORMATS and not payload.get('no_cache'):
+            cache_key, data_version = result_cache_key(limited_sql, params_for_exec), _data_version()
+            cached = result_cache.get(cache_key, data_version)
+        if cached is None:
+            conn = analyst_engine.connect()
+            try:
+                violation = check_budget(explain_cost(conn, limited_sql, params_for_exec),
+                                         EXECUTE_SQL_MAX_SCAN_ROWS, EXECUTE_SQL_MAX_JOIN_ROWS)
+                if violation:
+                    raise _execute_sql_error(400, **violation)
+                timed_sql = add_execution_time_hint(limited_sql, EXECUTE_SQL_TIMEOUT_MS, conn.dialect.name)
+                # 服务端游标：驱动不会一次性把整个结果集缓冲到内存
+                res = conn.execution_options(stream_results=True).execute(text(timed_sql), params_for_exec)
+                cols = list(res.keys())
+            except Exception:
+                conn.close()
+                raise
+    except HTTPException:
+        raise
+    except PoolTimeoutError:
+        raise _execute_sql_error(503, 'analyst_pool_busy', '查询繁忙，请稍后重试', headers={'Retry-After': '1'},
+                                 hint=f'最多同时执行 {EXECUTE_SQL_CONCURRENCY} 条查询')
     except SQLAlchemyError as e:
+        if is_timeout(e):
+            raise _timeout_error()
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
@@ -1392,15 +2836,55 @@ def execute_sql(payload: dict):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
-    return {'columns': cols, 'rows': rows, 'row_count': len(rows)}
+    next_token = _encode_next_token(fingerprint, offset + max_rows)
+    if fmt in EXECUTE_SQL_STREAM_FORMATS:
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        if fmt == 'csv':
+            headers['X-Next-Token'] = next_token
+        return StreamingResponse(_stream_rows(conn, res, cols, max_rows, fmt, next_token),
+                                 media_type=EXECUTE_SQL_FORMATS[fmt], headers=headers)
+
+    if cached is not None:
+        cols, rows = cached
+    else:
+        rows = []
+        try:
+            for batch in res.partitions(EXECUTE_SQL_BATCH):
+                rows.extend([_row_value(v) for v in r] for r in batch)
+        except SQLAlchemyError as e:
+            if is_timeout(e):
+                raise _timeout_error()
+            import traceback
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            res.close()
+            conn.close()
+        if cache_key is not None:
+            result_cache.put(cache_key, data_version, (cols, rows), len(dumps_json(rows)))
+    cache_headers = {'X-Result-Cache': 'hit' if cached is not None else 'miss'} if cache_key is not None else {}
+    more = len(rows) > max_rows
+    rows = rows[:max_rows]
+    token = next_token if more else None
+
+    if fmt == 'arrow':
+        headers = {'X-Row-Count': str(len(rows)), **cache_headers}
+        if token:
+            headers['X-Next-Token'] = token
+        body = arrow_stream(cols, rows, {'row_count': len(rows), 'next_token': token})
+        return Response(content=body, media_type=EXECUTE_SQL_FORMATS[fmt], headers=headers)
+    # 将行转为普通 dict；直接序列化，不经过 FastAPI 的 jsonable_encoder
+    result = {'columns': cols, 'rows': [dict(zip(cols, r)) for r in rows], 'row_count': len(rows), 'next_token': token}
+    body = dumps_msgpack(result) if fmt == 'msgpack' else _json_bytes(result)
+    return Response(content=body, media_type=EXECUTE_SQL_FORMATS[fmt], headers=cache_headers)
 
 
 @app.post('/api/ai_sql_finalize')
-def ai_sql_finalize(payload: dict):
+async def ai_sql_finalize(request: Request, payload: dict):
     """可选：把 SQL 执行结果发回模型，让模型基于结果生成可读的最终回答。
 
     请求体示例: { "question": "...", "sql": "...", "params": {...}, "result": {columns:[..],rows:[...]}, "model": "deepseek-chat" }
-    返回: { "reply": "..." }
+    返回: { "reply": "..." }；请求体带 "stream": true 时以 SSE / NDJSON 逐步返回（见流式回复一节）
     """
     if not isinstance(payload, dict):
         raise HTTPException(status_code=400, detail='invalid payload')
@@ -1440,28 +2924,17 @@ def ai_sql_finalize(payload: dict):
         {'role': 'user', 'content': f'请基于上面的结果回答: {question}'}
     ]
     body = {'model': model, 'messages': messages}
-    try:
-        resp = requests.post(api_url, headers=headers, json=body, timeout=30)
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f'proxy request failed: {e}')
+    fmt = _stream_format(request, payload)
+    if fmt:
+        return await _stream_upstream('finalize', api_url, headers, body, fmt, _raise_upstream_error, _finalize_reply)
+    resp = await _upstream_post('finalize', api_url, headers, body)
     if resp.status_code >= 400:
-        try:
-            errj = resp.json()
-        except Exception:
-            errj = resp.text
-        raise HTTPException(status_code=502, detail={'upstream_status': resp.status_code, 'upstream': errj})
+        _raise_upstream_error(resp)
     try:
         j = resp.json()
     except Exception:
         raise HTTPException(status_code=502, detail='bad response from remote')
-    reply = None
-    if isinstance(j, dict):
-        if j.get('choices') and isinstance(j.get('choices'), list) and j['choices'][0].get('message'):
-            reply = j['choices'][0]['message'].get('content')
-        elif 'reply' in j:
-            reply = j['reply']
-        elif 'result' in j:
-            reply = j['result']
+    reply = _finalize_reply(j)
     if reply is None:
         return {'raw': j}
     return {'reply': reply}
@@ -0,0 +1,250 @@
+"""
+聚合端点与 execute_sql 的基准测试。
+
+对每个数据规模（--rows，默认 10k / 1M / 10M 行）：用 synth.py 按 public/china_disease_data.csv 的分布
+生成数据、经 loader.py 导入本地 SQLite（缓存在 .bench/ 下，同样的行数与种子只构建一次），
+然后在独立的子进程里以该库启动 app（DB_URL 指向它），逐个端点测量：
+
+- p50 / p95 延迟（进程内 TestClient，默认每次请求前清空响应缓存，--warm 则保留）；
+- 每次请求的数据库查询次数（SQLAlchemy before_cursor_execute 事件计数）；
+- 峰值 RSS（Linux 上通过 /proc/self/clear_refs 重置 VmHWM 后读取，否则为进程的 ru_maxrss）。
+
+结果为 JSON（--output），附带 git 提交、Python 版本、种子与相关环境变量；--compare 与之前的结果比较，
+p50/p95 超过基线 --threshold 倍或查询次数增加时视为回退，退出码为 1。
+
+用法：
+    python benchmark.py --rows 10000,1000000 --output bench.json
+    python benchmark.py --rows 10000 --compare bench.json --threshold 1.2
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(HERE, '.bench')
+DEFAULT_ROWS = (10_000, 1_000_000, 10_000_000)
+TABLE = 'china_disease_data'
+# 记录到结果中的配置（影响端点走哪条路径）
+CONFIG_ENV = ('DATA_BACKEND', 'DB_ASYNC', 'DB_ASYNC_URL', 'RESPONSE_CACHE_TTL', 'RESPONSE_CACHE_STALE',
+              'CUBE_ROUTING', 'SNAPSHOT_REFRESH_SECONDS', 'EXECUTE_SQL_BATCH', 'RESULT_CACHE_SIZE',
+              'RESULT_CACHE_MAX_ENTRY_KB', 'RESULT_CACHE_TTL')
+
+EXECUTE_SQL = {
+    'sql': 'SELECT Province, Disease, SUM(Reported_Cases) AS cases FROM china_disease_data '
+           'WHERE Year = :year GROUP BY Province, Disease',
+    'params': {'year': 2022},
+}
+# (名称, 方法, 路径, JSON 请求体)
+ENDPOINTS = [
+    ('china_disease', 'GET', '/api/china_disease', None),
+    ('disease_locations', 'GET', '/api/disease_locations', None),
+    ('region_analysis?regions=1', 'GET', '/api/region_analysis?regions=Sichuan', None),
+    ('region_analysis?regions=3', 'GET', '/api/region_analysis?regions=Sichuan,Beijing,Guangdong', None),
+    ('execute_sql', 'POST', '/api/execute_sql', EXECUTE_SQL),
+]
+
+
+def bench_db(rows: int, seed: int, jobs: Optional[int] = None) -> str:
+    """rows 行合成数据的 SQLite 库路径（不存在时生成并导入）。"""
+    path = os.path.join(BENCH_DIR, f'disease-{rows}-s{seed}.db')
+    if os.path.exists(path):
+        return path
+    from sqlalchemy import create_engine
+
+    import synth
+    from loader import load_csv
+    work = os.path.join(BENCH_DIR, f'synth-{rows}-s{seed}')
+    started = time.time()
+    result = synth.generate(TABLE, rows, work, seed, jobs)
+    building = path + '.tmp'
+    if os.path.exists(building):
+        os.remove(building)
+    engine = create_engine(f'sqlite:///{building}')
+    for part in result['files']:
+        load_csv(engine, TABLE, part, 'append', chunk_size=50000)
+    engine.dispose()
+    os.replace(building, path)
+    shutil.rmtree(work, ignore_errors=True)
+    print(f'built {path}: {rows} rows in {time.time() - started:.1f}s', file=sys.stderr)
+    return path
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 的单位是字节，Linux 是 KB
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def run_endpoints(iterations: int, warmup: int, warm: bool) -> Dict[str, dict]:
+    """在当前进程中对 app 逐个端点计时（DB_URL 需在调用前设置好）。"""
+    from fastapi.testclient import TestClient
+    from sqlalchemy import event
+
+    import app as webapp
+    queries = [0]
+
+    def count(*_):
+        queries[0] += 1
+
+    # execute_sql 走独立的 analyst_engine
+    engines = [webapp.engine, webapp.analyst_engine] + (
+        [webapp.async_engine.sync_engine] if webapp.async_engine is not None else [])
+    for eng in engines:
+        event.listen(eng, 'before_cursor_execute', count)
+
+    results = {}
+    with TestClient(webapp.app) as client:
+        for name, method, path, body in ENDPOINTS:
+            for _ in range(warmup):
+                client.request(method, path, json=body)
+            rss_reset = _reset_peak_rss()
+            samples, counts = [], []
+            status = None
+            for _ in range(iterations):
+                if not warm:
+                    webapp.response_cache.clear()
+                    webapp.result_cache.clear()
+                queries[0] = 0
+                started = time.perf_counter()
+                resp = client.request(method, path, json=body)
+                samples.append((time.perf_counter() - started) * 1000)
+                counts.append(queries[0])
+                status = resp.status_code
+                if status != 200:
+                    break
+            entry = {'status': status, 'iterations': len(samples),
+                     'p50_ms': round(_percentile(samples, 0.5), 3), 'p95_ms': round(_percentile(samples, 0.95), 3),
+                     'mean_ms': round(statistics.mean(samples), 3),
+                     'queries': max(counts), 'peak_rss_mb': _peak_rss_mb(), 'rss_reset': rss_reset}
+            if status != 200:
+                entry['error'] = resp.text[:500]
+            results[name] = entry
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=HERE,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[dict]:
+    """current 相对 baseline 的回退列表：p50/p95 超过 threshold 倍，或查询次数增加。"""
+    regressions = []
+    for rows, endpoints in current['results'].items():
+        base_endpoints = baseline.get('results', {}).get(rows, {})
+        for name, entry in endpoints.items():
+            base = base_endpoints.get(name)
+            if not base or base.get('status') != 200:
+                continue
+            if entry.get('status') != 200:
+                regressions.append({'rows': rows, 'endpoint': name, 'metric': 'status',
+                                    'baseline': base.get('status'), 'current': entry.get('status')})
+                continue
+            for metric in ('p50_ms', 'p95_ms'):
+                if base[metric] > 0 and entry[metric] / base[metric] > threshold:
+                    regressions.append({'rows': rows, 'endpoint': name, 'metric': metric, 'baseline': base[metric],
+                                        'current': entry[metric], 'ratio': round(entry[metric] / base[metric], 2)})
+            if entry['queries'] > base['queries']:
+                regressions.append({'rows': rows, 'endpoint': name, 'metric': 'queries',
+                                    'baseline': base['queries'], 'current': entry['queries']})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the aggregate endpoints against local SQLite data.')
+    parser.add_argument('--rows', default=','.join(str(r) for r in DEFAULT_ROWS),
+                        help='comma-separated dataset sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--warm', action='store_true', help='keep the response and execute_sql result caches between requests')
+    parser.add_argument('--jobs', type=int, help='generator worker processes')
+    parser.add_argument('--output', help='write the results JSON here')
+    parser.add_argument('--compare', help='baseline results JSON; exit 1 on regression')
+    parser.add_argument('--threshold', type=float, default=1.2, help='allowed p50/p95 ratio against the baseline')
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.db:
+        # 子进程：对一个库计时，结果写到 stdout
+        os.environ['DB_URL'] = f'sqlite:///{args.db}'
+        sys.path.insert(0, HERE)
+        print(json.dumps(run_endpoints(args.iterations, args.warmup, args.warm)))
+        return
+
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    results = {}
+    for rows in (int(r) for r in args.rows.split(',') if r.strip()):
+        db = bench_db(rows, args.seed, args.jobs)
+        cmd = [sys.executable, os.path.abspath(__file__), '--db', db, '--iterations', str(args.iterations),
+               '--warmup', str(args.warmup)] + (['--warm'] if args.warm else [])
+        out = subprocess.run(cmd, cwd=HERE, capture_output=True, text=True)
+        if out.returncode != 0:
+            parser.exit(1, f'benchmark for {rows} rows failed:\n{out.stderr}')
+        results[str(rows)] = json.loads(out.stdout.strip().splitlines()[-1])
+        for name, entry in results[str(rows)].items():
+            print(f"{rows:>10} {name:<28} p50 {entry['p50_ms']:>9.2f} ms  p95 {entry['p95_ms']:>9.2f} ms  "
+                  f"queries {entry['queries']:>2}  rss {entry['peak_rss_mb']:>7.1f} MB  status {entry['status']}",
+                  file=sys.stderr)
+
+    report = {
+        'meta': {'git_commit': _git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+                 'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                 'seed': args.seed, 'iterations': args.iterations, 'warmup': args.warmup, 'warm': args.warm,
+                 'config': {k: os.environ[k] for k in CONFIG_ENV if k in os.environ}},
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        report['baseline'] = baseline.get('meta', {}).get('git_commit')
+        report['regressions'] = compare(report, baseline, args.threshold)
+    text_out = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text_out + '\n')
+    print(text_out)
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
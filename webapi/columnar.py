@@ -0,0 +1,187 @@
+"""
+china_disease_data 的内存列式快照（NumPy）。
+
+每一列都做字典编码：codes 为 int32 数组，categories 为原始取值列表（None 也是一个取值，
+与 SQL GROUP BY 中 NULL 自成一组的语义一致）；数值列额外保留 float64 数组（NULL 记为 NaN）。
+分组聚合通过把若干列的 codes 组合成一个分组下标后调用 np.bincount 完成，
+不需要逐行的 Python 循环。
+"""
+import time
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+
+class _Column:
+    __slots__ = ('name', 'codes', 'categories', 'numeric')
+
+    def __init__(self, name: str, codes: np.ndarray, categories: list, numeric: Optional[np.ndarray]):
+        self.name = name
+        self.codes = codes
+        self.categories = categories
+        self.numeric = numeric
+
+
+class ColumnarTable:
+    """只读的列式表。通过 from_result / from_rows 构建，构建后不再修改。"""
+
+    def __init__(self, columns: Dict[str, _Column], nrows: int):
+        self._columns = columns
+        self.nrows = nrows
+        self.loaded_at = time.time()
+        self._lowcols = {c.lower(): c for c in columns}
+        self._flag_cache = {}
+
+    # ---------- 构建 ----------
+    @classmethod
+    def from_rows(cls, names: Sequence[str], rows: Iterable[Sequence]):
+        """按行读入并逐列字典编码。rows 可以是任意可迭代对象（例如分批 fetchmany 的结果）。"""
+        names = list(names)
+        lookups = [dict() for _ in names]
+        cats = [[] for _ in names]
+        codes = [[] for _ in names]
+        nrows = 0
+        for row in rows:
+            nrows += 1
+            for i, v in enumerate(row):
+                if isinstance(v, bytes):
+                    v = v.decode('utf-8', errors='ignore')
+                lk = lookups[i]
+                c = lk.get(v)
+                if c is None:
+                    c = len(cats[i])
+                    lk[v] = c
+                    cats[i].append(v)
+                codes[i].append(c)
+
+        columns = {}
+        for i, name in enumerate(names):
+            code_arr = np.asarray(codes[i], dtype=np.int32)
+            numeric = None
+            non_null = [v for v in cats[i] if v is not None]
+            if non_null and all(isinstance(v, (int, float, Decimal)) and not isinstance(v, bool) for v in non_null):
+                lut = np.array([float(v) if v is not None else np.nan for v in cats[i]], dtype=np.float64)
+                numeric = lut[code_arr]
+            columns[name] = _Column(name, code_arr, cats[i], numeric)
+        return cls(columns, nrows)
+
+    @classmethod
+    def from_result(cls, result, batch_size: int = 50000):
+        """从 SQLAlchemy 查询结果流式构建（分批 fetchmany，避免一次性物化所有 Row 对象）。"""
+        names = list(result.keys())
+
+        def batches():
+            while True:
+                chunk = result.fetchmany(batch_size)
+                if not chunk:
+                    break
+                for r in chunk:
+                    yield tuple(r)
+
+        return cls.from_rows(names, batches())
+
+    # ---------- 导出（共享快照，见 shared_snapshot.py） ----------
+    def to_arrays(self):
+        """返回 (arrays, meta)：arrays 为各列的 codes / numeric 以及已计算过的标志列布尔数组，
+        meta 为可 JSON 序列化的列名、字典与标志列信息。from_arrays 按原样还原（数组不复制）。"""
+        arrays, columns, flags = {}, [], []
+        for i, (name, col) in enumerate(self._columns.items()):
+            arrays[f'{i}.codes'] = col.codes
+            if col.numeric is not None:
+                arrays[f'{i}.numeric'] = col.numeric
+            columns.append({'name': name, 'categories': col.categories})
+        for j, ((name, truth_values), mask) in enumerate(self._flag_cache.items()):
+            arrays[f'flag.{j}'] = mask
+            flags.append({'column': name, 'truth_values': list(truth_values)})
+        return arrays, {'nrows': self.nrows, 'columns': columns, 'flags': flags}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], meta: dict):
+        columns = {}
+        for i, c in enumerate(meta['columns']):
+            columns[c['name']] = _Column(c['name'], arrays[f'{i}.codes'], c['categories'], arrays.get(f'{i}.numeric'))
+        table = cls(columns, meta['nrows'])
+        for j, f in enumerate(meta.get('flags', ())):
+            table._flag_cache[(f['column'], tuple(f['truth_values']))] = arrays[f'flag.{j}']
+        return table
+
+    # ---------- 列访问 ----------
+    @property
+    def columns(self) -> List[str]:
+        return list(self._columns.keys())
+
+    def resolve(self, name: Optional[str]) -> Optional[str]:
+        """大小写不敏感地把列名解析为表中的实际列名，不存在时返回 None。"""
+        if not name:
+            return None
+        return self._lowcols.get(str(name).lower())
+
+    def column(self, name: str) -> _Column:
+        actual = self.resolve(name)
+        if actual is None:
+            raise KeyError(name)
+        return self._columns[actual]
+
+    def values(self, name: str) -> np.ndarray:
+        """数值列的 float64 数组（NULL 为 NaN）；非数值列抛出 TypeError。"""
+        col = self.column(name)
+        if col.numeric is None:
+            raise TypeError(f'column {name} is not numeric')
+        return col.numeric
+
+    def flag(self, name: str, truth_values: Sequence[str]) -> np.ndarray:
+        """Yes/No 标志列的布尔数组：取值 LOWER(TRIM(v)) 属于 truth_values 时为 True。"""
+        key = (self.column(name).name, tuple(truth_values))
+        cached = self._flag_cache.get(key)
+        if cached is None:
+            col = self.column(name)
+            truth = set(truth_values)
+            lut = np.array([v is not None and str(v).strip().lower() in truth for v in col.categories], dtype=bool)
+            cached = lut[col.codes]
+            self._flag_cache[key] = cached
+        return cached
+
+    def isin(self, name: str, keys: set, key=lambda v: v) -> np.ndarray:
+        """行掩码：key(取值) 属于 keys 的行为 True（按字典而非按行比较）。"""
+        col = self.column(name)
+        lut = np.array([key(v) in keys for v in col.categories], dtype=bool)
+        return lut[col.codes]
+
+    # ---------- 分组聚合 ----------
+    def group_reduce(self, keys: Sequence[str], sums: Dict[str, np.ndarray],
+                     counts: Optional[Dict[str, np.ndarray]] = None, mask: Optional[np.ndarray] = None):
+        """按 keys 列分组，对 sums 中每个权重数组求和（NaN 视为 0），对 counts 中每个布尔数组计数。
+        返回 [(分组取值元组, {名称: 值})]，只包含至少有一行的分组。keys 为空时整表为一组。"""
+        counts = counts or {}
+        cols = [self.column(k) for k in keys]
+        if cols:
+            dims = tuple(max(len(c.categories), 1) for c in cols)
+            gid = np.ravel_multi_index(tuple(c.codes.astype(np.int64) for c in cols), dims)
+            size = int(np.prod(dims, dtype=np.int64))
+        else:
+            dims = ()
+            gid = np.zeros(self.nrows, dtype=np.int64)
+            size = 1
+        if mask is not None:
+            gid = gid[mask]
+        present = np.bincount(gid, minlength=size)
+
+        results = {}
+        for name, w in sums.items():
+            w = np.nan_to_num(w, nan=0.0)
+            if mask is not None:
+                w = w[mask]
+            results[name] = np.bincount(gid, weights=w, minlength=size)
+        for name, m in counts.items():
+            m = m if mask is None else m[mask]
+            results[name] = np.bincount(gid, weights=m.astype(np.float64), minlength=size)
+
+        out = []
+        idx = np.nonzero(present)[0]
+        if cols:
+            unravelled = np.unravel_index(idx, dims)
+        for j, g in enumerate(idx):
+            key_vals = tuple(cols[k].categories[unravelled[k][j]] for k in range(len(cols))) if cols else ()
+            out.append((key_vals, {name: arr[g] for name, arr in results.items()}))
+        return out
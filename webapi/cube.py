@@ -0,0 +1,237 @@
+"""
+china_disease_data 的预聚合汇总表（rollup cube）。
+
+按 Province × Disease × Age_Group × Gender × Season × Year × Month × Urban_Rural 分组，
+保存 Reported_Cases / Deaths / Days_Hospitalized 的和、Days_Hospitalized 的非空计数、行数，
+以及每个 Yes/No 标志列的“是”病例数（<列>_yes，按 Reported_Cases 加权）与“是”行数（<列>_yes_n）。
+维度列与求和列沿用原表列名，因此原有的 GROUP BY / SUM 查询换个表名即可在汇总表上执行。
+
+列的角色写在 china_disease_cube_meta 中，地图相关端点据此判断所需维度是否都被覆盖
+（见 app.py 的 _get_cube）。构建时先写入 *_new 表再整体改名替换，读者不会看到半成品。
+
+meta 中同时记录构建时 china_disease_data 的数据版本（loader.py 每次导入递增，见 result_cache.py）；
+版本变化后汇总表已过期，app.py 改查原表，直到重新构建。
+
+命令行构建：python cube.py（读取与服务相同的 DB_URL）。
+"""
+import time
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import inspect, text
+
+from flags import normalized_flags
+from result_cache import read_data_versions
+
+SOURCE_TABLE = 'china_disease_data'
+CUBE_TABLE = 'china_disease_cube'
+CUBE_META_TABLE = 'china_disease_cube_meta'
+
+CUBE_DIMENSIONS = ('Province', 'Disease', 'Age_Group', 'Gender', 'Season', 'Year', 'Month', 'Urban_Rural')
+CUBE_SUMS = ('Reported_Cases', 'Deaths', 'Days_Hospitalized')
+CUBE_COUNTS = ('Days_Hospitalized',)
+CUBE_WEIGHT = 'Reported_Cases'
+ROW_COUNT_COLUMN = 'row_count'
+
+FALSE_VALUES = ('no', 'n', '0', 'false', '否')
+# 取值种类超过该数目的列不可能是 Yes/No 标志列，探测时不必读完所有取值
+_FLAG_PROBE_LIMIT = 12
+
+
+class CubeFlag:
+    __slots__ = ('source', 'yes_column', 'count_column', 'yes_value', 'no_value', 'binary')
+
+    def __init__(self, source: str, yes_column: str, count_column: str,
+                 yes_value: Optional[str], no_value: Optional[str], binary: bool):
+        self.source = source
+        self.yes_column = yes_column
+        self.count_column = count_column
+        # binary：原列只有一种“是”写法、一种“否”写法且没有 NULL，此时按取值的分布可以由
+        # <列>_yes 与总数精确还原（yes_value / no_value 为原始写法，某一侧不存在时为 None）
+        self.yes_value = yes_value
+        self.no_value = no_value
+        self.binary = binary
+
+
+class CubeInfo:
+    """汇总表的列角色。各查找方法按原表列名（大小写不敏感）返回汇总表列名，未覆盖时返回 None。"""
+
+    def __init__(self, meta_rows: Iterable, table: str = CUBE_TABLE):
+        self.table = table
+        self.built_at = None
+        self.data_version = None
+        self._dims: Dict[str, str] = {}
+        self._sums: Dict[str, str] = {}
+        self._counts: Dict[str, str] = {}
+        self._flags: Dict[str, CubeFlag] = {}
+        self.row_count = ROW_COUNT_COLUMN
+        for column, role, source, count_column, yes_value, no_value, binary, built_at, data_version in meta_rows:
+            key = (source or '').lower()
+            if role == 'dim':
+                self._dims[key] = column
+            elif role == 'sum':
+                self._sums[key] = column
+            elif role == 'count':
+                self._counts[key] = column
+            elif role == 'rows':
+                self.row_count = column
+            elif role == 'flag':
+                self._flags[key] = CubeFlag(source, column, count_column, yes_value, no_value, bool(binary))
+            self.built_at = built_at
+            self.data_version = data_version
+
+    def dim(self, col: Optional[str]) -> Optional[str]:
+        return self._dims.get(str(col).lower()) if col else None
+
+    def sum(self, col: Optional[str]) -> Optional[str]:
+        return self._sums.get(str(col).lower()) if col else None
+
+    def count(self, col: Optional[str]) -> Optional[str]:
+        return self._counts.get(str(col).lower()) if col else None
+
+    def flag(self, col: Optional[str]) -> Optional[CubeFlag]:
+        return self._flags.get(str(col).lower()) if col else None
+
+    @property
+    def dimensions(self) -> List[str]:
+        return list(self._dims.values())
+
+
+def source_data_version(conn) -> int:
+    """china_disease_data 当前的数据版本；从未用 loader.py 导入过时为 0。"""
+    return dict(read_data_versions(conn)).get(SOURCE_TABLE, 0)
+
+
+def load_cube_info(conn) -> Optional[CubeInfo]:
+    """读取汇总表的列角色；汇总表尚未构建（或由不记录数据版本的旧版本构建）时调用方会收到数据库异常。"""
+    rows = conn.execute(text(
+        f'SELECT column_name, role, source_column, count_column, yes_value, no_value, is_binary, built_at, data_version '
+        f'FROM {CUBE_META_TABLE}'
+    )).fetchall()
+    return CubeInfo(rows) if rows else None
+
+
+def _probe_flag(conn, col: str, truth_values) -> Optional[tuple]:
+    """判断列是否为 Yes/No 标志列；是则返回 (yes_value, no_value, binary)，否则返回 None。"""
+    values = [r[0] for r in conn.execute(text(f'SELECT DISTINCT {col} FROM {SOURCE_TABLE} LIMIT {_FLAG_PROBE_LIMIT + 1}'))]
+    if not values or len(values) > _FLAG_PROBE_LIMIT:
+        return None
+    truthy, falsy, has_null = [], [], False
+    for v in values:
+        if v is None:
+            has_null = True
+            continue
+        norm = str(v).strip().lower()
+        if norm in truth_values:
+            truthy.append(v)
+        elif norm in FALSE_VALUES:
+            falsy.append(v)
+        else:
+            return None
+    if not truthy and not falsy:
+        return None
+    binary = (not has_null and len(truthy) <= 1 and len(falsy) <= 1
+              and all(isinstance(v, str) for v in truthy + falsy))
+    return (truthy[0] if binary and truthy else None, falsy[0] if binary and falsy else None, binary)
+
+
+def build_cube(conn, truth_values) -> dict:
+    """从 china_disease_data 重建汇总表与列角色表。conn 需处于事务中（engine.begin()）。"""
+    started = time.time()
+    # 先于扫描读取：构建期间有新的导入时，记录的版本偏旧，只会让汇总表被判为过期
+    data_version = source_data_version(conn)
+    source_cols = list(conn.execute(text(f'SELECT * FROM {SOURCE_TABLE} LIMIT 0')).keys())
+    lowcols = {c.lower(): c for c in source_cols}
+    weight = lowcols.get(CUBE_WEIGHT.lower())
+    if not weight:
+        raise ValueError(f'{SOURCE_TABLE} has no {CUBE_WEIGHT} column')
+
+    dims = [lowcols[d.lower()] for d in CUBE_DIMENSIONS if d.lower() in lowcols]
+    sums = [lowcols[s.lower()] for s in CUBE_SUMS if s.lower() in lowcols]
+    counts = [lowcols[c.lower()] for c in CUBE_COUNTS if c.lower() in lowcols]
+    truth_list = ','.join(f"'{v}'" for v in truth_values)
+
+    # (汇总表列名, 角色, 原列名, 计数列, yes_value, no_value, is_binary)
+    meta = [(d, 'dim', d, None, None, None, 0) for d in dims]
+    selects = list(dims)
+    for s in sums:
+        selects.append(f'SUM({s}) AS {s}')
+        meta.append((s, 'sum', s, None, None, None, 0))
+    for c in counts:
+        selects.append(f'COUNT({c}) AS {c}_n')
+        meta.append((f'{c}_n', 'count', c, None, None, None, 0))
+    selects.append(f'COUNT(*) AS {ROW_COUNT_COLUMN}')
+    meta.append((ROW_COUNT_COLUMN, 'rows', None, None, None, None, 0))
+
+    # 已整数化的标志列（flags.py）直接按整数判断，<列>_flag 本身不再作为标志列探测
+    normalized = normalized_flags(lowcols)
+    skip = {c.lower() for c in dims + sums + counts} | {c.lower() for c in normalized.values()}
+    flags = []
+    for col in source_cols:
+        if col.lower() in skip:
+            continue
+        probed = _probe_flag(conn, col, truth_values)
+        if probed is None:
+            continue
+        flags.append(col)
+        truthy = f'{normalized[col.lower()]} = 1' if col.lower() in normalized else f'LOWER(TRIM({col})) IN ({truth_list})'
+        selects.append(f'SUM(CASE WHEN {truthy} THEN {weight} ELSE 0 END) AS {col}_yes')
+        selects.append(f'SUM(CASE WHEN {truthy} THEN 1 ELSE 0 END) AS {col}_yes_n')
+        yes_value, no_value, binary = probed
+        meta.append((f'{col}_yes', 'flag', col, f'{col}_yes_n', yes_value, no_value, int(binary)))
+
+    new_cube, new_meta = f'{CUBE_TABLE}_new', f'{CUBE_META_TABLE}_new'
+    old_cube, old_meta = f'{CUBE_TABLE}_old', f'{CUBE_META_TABLE}_old'
+    for t in (new_cube, new_meta, old_cube, old_meta):
+        conn.execute(text(f'DROP TABLE IF EXISTS {t}'))
+    group_by = f"GROUP BY {', '.join(dims)}" if dims else ''
+    conn.execute(text(f"CREATE TABLE {new_cube} AS SELECT {', '.join(selects)} FROM {SOURCE_TABLE} {group_by}"))
+    index_cols = [c for c in dims if c.lower() in ('province', 'disease')]
+    if index_cols:
+        # SQLite 的索引名在库内全局唯一，带上时间戳避免与旧表的索引重名
+        conn.execute(text(f"CREATE INDEX ix_{CUBE_TABLE}_{int(started * 1000)} ON {new_cube} ({', '.join(index_cols)})"))
+
+    built_at = time.strftime('%Y-%m-%d %H:%M:%S')
+    conn.execute(text(
+        f'CREATE TABLE {new_meta} (column_name VARCHAR(128), role VARCHAR(16), source_column VARCHAR(128), '
+        f'count_column VARCHAR(128), yes_value VARCHAR(64), no_value VARCHAR(64), is_binary INTEGER, built_at VARCHAR(32), '
+        f'data_version BIGINT)'
+    ))
+    conn.execute(text(
+        f'INSERT INTO {new_meta} (column_name, role, source_column, count_column, yes_value, no_value, is_binary, built_at, '
+        f'data_version) VALUES (:c, :r, :s, :n, :y, :no, :b, :t, :v)'
+    ), [{'c': c, 'r': r, 's': s, 'n': n, 'y': y, 'no': no, 'b': b, 't': built_at, 'v': data_version}
+        for c, r, s, n, y, no, b in meta])
+
+    _swap_tables(conn, [(CUBE_TABLE, new_cube, old_cube), (CUBE_META_TABLE, new_meta, old_meta)])
+    cells = conn.execute(text(f'SELECT COUNT(*) FROM {CUBE_TABLE}')).scalar()
+    return {'table': CUBE_TABLE, 'cells': cells, 'dimensions': dims, 'sums': sums, 'flags': flags,
+            'built_at': built_at, 'data_version': data_version, 'seconds': round(time.time() - started, 3)}
+
+
+def _swap_tables(conn, swaps):
+    """把 *_new 表换成正式表。MySQL 用一条 RENAME TABLE 原子完成；其它数据库在同一事务内依次改名。"""
+    inspector = inspect(conn)
+    existing = {table for table, _, _ in swaps if inspector.has_table(table)}
+    if conn.dialect.name == 'mysql':
+        parts = []
+        for table, new, old in swaps:
+            if table in existing:
+                parts.append(f'{table} TO {old}')
+            parts.append(f'{new} TO {table}')
+        conn.execute(text('RENAME TABLE ' + ', '.join(parts)))
+    else:
+        for table, new, old in swaps:
+            if table in existing:
+                conn.execute(text(f'ALTER TABLE {table} RENAME TO {old}'))
+            conn.execute(text(f'ALTER TABLE {new} RENAME TO {table}'))
+    for table, _, old in swaps:
+        if table in existing:
+            conn.execute(text(f'DROP TABLE {old}'))
+
+
+if __name__ == '__main__':
+    import json
+
+    import app
+
+    print(json.dumps(app._rebuild_cube(), ensure_ascii=False, indent=2))
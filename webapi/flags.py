@@ -0,0 +1,188 @@
+"""
+china_disease_data 中 Yes/No 标志列的整数化。
+
+原表的 13 个标志列是文本（Yes/No/是/否...），region_analysis 等汇总查询需要对每一行做
+LOWER(TRIM(col)) IN (...) 的字符串比较。这里为每个标志列增加一个整数列 <列>_flag（1 = 是，0 = 其它，
+与字符串判断的结果逐行一致），汇总时只需比较整数（CASE WHEN <列>_flag = 1）。整数列有两种来源：
+
+- 建表时声明：loader.py 新建 china_disease_data（含 replace 模式的临时表）时把它们声明为 STORED 生成列
+  （CREATE TABLE 中 MySQL 与 SQLite 都支持），由数据库在每次写入时计算；
+- 生成列：对已有的表执行 python flags.py，以 generated column 的形式补上（MySQL 为 STORED，
+  SQLite 只能追加 VIRTUAL 列），之后任何写入都由数据库自动维护。旧版 loader.py 导入的表中
+  <列>_flag 是普通列，flags.py 会把它们改为由数据库维护（见 add_flag_columns）；
+- --materialize：要求整数值实际存储在表中。MySQL 的 STORED 生成列本来就是存储的，与默认相同；
+  SQLite 不能用 ALTER TABLE 追加 STORED 列，改为普通列一次性回填，并建 INSERT / UPDATE 触发器
+  按同样的规则维护。
+
+因此不论哪种来源，不经过 loader.py 的写入（直接 UPDATE 原字符串列等）都不会让整数列与原列不一致。
+
+每个 <列>_flag 都建单列索引（add_flag_columns 与 loader.py 导入结束时补建；生成列同样可以建索引），
+按标志筛选的查询（WHERE ICU_Admission_flag = 1）可以走索引。
+
+flag_sum_sql 是查询构造器：表中存在对应的整数列时生成整数求和，否则（旧表）退回字符串判断。
+"""
+from typing import Dict, Iterable, Optional, Sequence
+
+from sqlalchemy import inspect, text
+
+SOURCE_TABLE = 'china_disease_data'
+FLAG_COLUMNS = ('Hospitalized', 'Recovered', 'Vaccinated', 'Travel_History', 'Comorbidity', 'Quarantined',
+                'ICU_Admission', 'Symptom_Fever', 'Symptom_Cough', 'Symptom_Rash', 'Contact_Tracing',
+                'Lab_Confirmed', 'Follow_Up')
+FLAG_SUFFIX = '_flag'
+# Yes/No 标志列的标准真值集合（兼容中文/大小写/空白）
+TRUTH_VALUES = ('yes', 'y', '1', 'true', '是')
+
+
+def flag_column(col: str) -> str:
+    return f'{col}{FLAG_SUFFIX}'
+
+
+def flag_value(value, truth_values: Sequence[str]) -> int:
+    """Python 端的判断，与 truth_case_sql 一致（导入时使用）。"""
+    if value is None:
+        return 0
+    # SQL 的 TRIM 只去掉空格
+    return 1 if str(value).strip(' ').lower() in truth_values else 0
+
+
+def truth_case_sql(col: str, truth_values: Sequence[str]) -> str:
+    value_list = ','.join(f"'{v}'" for v in truth_values)
+    return f'CASE WHEN LOWER(TRIM({col})) IN ({value_list}) THEN 1 ELSE 0 END'
+
+
+def normalized_flags(lowcols: Dict[str, str]) -> Dict[str, str]:
+    """按表的实际列（小写 -> 原始列名）找出已整数化的标志列：小写原列名 -> 整数列名。"""
+    out = {}
+    for low, col in lowcols.items():
+        if low.endswith(FLAG_SUFFIX):
+            source = low[:-len(FLAG_SUFFIX)]
+            if source in lowcols:
+                out[source] = col
+    return out
+
+
+def flag_sum_sql(col: str, weight: str, truth_values: Sequence[str], flags: Optional[Dict[str, str]] = None) -> str:
+    """标志列为“是”时累加 weight 的 SQL 表达式。flags 为 normalized_flags 的结果；
+    其中有 col 时生成整数求和，否则退回逐行字符串判断。"""
+    normalized = (flags or {}).get(str(col).lower())
+    if normalized:
+        return f'SUM(CASE WHEN {normalized} = 1 THEN {weight} ELSE 0 END)'
+    value_list = ','.join(f"'{v}'" for v in truth_values)
+    return f"SUM(CASE WHEN LOWER(TRIM({col})) IN ({value_list}) THEN {weight} ELSE 0 END)"
+
+
+def generated_columns(conn, table: str) -> set:
+    """表中由数据库计算的列（导入时不能写入）。"""
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        rows = conn.execute(text(
+            "SELECT COLUMN_NAME FROM information_schema.columns WHERE table_schema = DATABASE() "
+            "AND table_name = :t AND EXTRA LIKE '%GENERATED%'"), {'t': table})
+        return {r[0] for r in rows}
+    if dialect == 'sqlite':
+        # table_xinfo 的 hidden：2 = VIRTUAL 生成列，3 = STORED 生成列
+        return {r[1] for r in conn.execute(text(f'PRAGMA table_xinfo({table})')) if r[6] in (2, 3)}
+    return set()
+
+
+def flag_index_name(table: str, col: str, suffix: str = '') -> str:
+    """与 loader.py 的索引命名规则一致（ix_<表>_<列>，MySQL 标识符最长 64 个字符）。"""
+    name = f'ix_{table}_{col}'.lower()
+    return (name[:64 - len(suffix) - 1] + '_' + suffix) if suffix else name[:64]
+
+
+def ensure_flag_indexes(conn, table: str = SOURCE_TABLE, index_table: Optional[str] = None, suffix: str = '') -> list:
+    """为表中已有、但还没有单列索引的 <列>_flag 建索引，返回新建的索引名。
+    index_table / suffix 用于 loader.py 的 replace 模式：在临时表上建索引，名字按正式表命名。"""
+    columns = conn.execute(text(f'SELECT * FROM {table} LIMIT 0')).keys()
+    indexed = {tuple(c.lower() for c in ix['column_names']) for ix in inspect(conn).get_indexes(table)}
+    created = []
+    for col in columns:
+        if not col.lower().endswith(FLAG_SUFFIX.lower()) or (col.lower(),) in indexed:
+            continue
+        name = flag_index_name(index_table or table, col, suffix)
+        conn.execute(text(f'CREATE INDEX {name} ON {table} ({col})'))
+        created.append(name)
+    return created
+
+
+def _sqlite_flag_trigger_names(table: str, name: str) -> tuple:
+    return f'{table}_{name}_ins', f'{table}_{name}_upd'
+
+
+def _sqlite_has_flag_triggers(conn, table: str, name: str) -> bool:
+    names = _sqlite_flag_trigger_names(table, name)
+    found = conn.execute(text("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (:a, :b)"),
+                         {'a': names[0], 'b': names[1]}).scalar()
+    return found == len(names)
+
+
+def _sqlite_flag_triggers(conn, table: str, name: str, source: str, truth_values: Sequence[str]):
+    """SQLite 的物化标志列：插入或更新原列时按 truth_case_sql 重新计算。"""
+    expr = truth_case_sql(f'NEW.{source}', truth_values)
+    for event, trigger in zip(('INSERT', f'UPDATE OF {source}'), _sqlite_flag_trigger_names(table, name)):
+        conn.execute(text(f'CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON {table} '
+                          f'BEGIN UPDATE {table} SET {name} = {expr} WHERE rowid = NEW.rowid; END'))
+
+
+def add_flag_columns(conn, truth_values: Sequence[str] = TRUTH_VALUES, columns: Iterable[str] = FLAG_COLUMNS,
+                     materialize: bool = False, table: str = SOURCE_TABLE) -> dict:
+    """为已有的表补上 <列>_flag 整数列并建索引。conn 需处于事务中（engine.begin()）。
+    已存在、但只是普通列的 <列>_flag（旧版 loader.py 导入的表）改为由数据库维护：MySQL 改为 STORED 生成列，
+    SQLite 重新回填并建触发器；已是生成列或已有触发器的跳过。"""
+    existing = {c.lower(): c for c in conn.execute(text(f'SELECT * FROM {table} LIMIT 0')).keys()}
+    generated = {c.lower() for c in generated_columns(conn, table)}
+    dialect = conn.dialect.name
+    added, converted, skipped = [], [], []
+    for col in columns:
+        source = existing.get(col.lower())
+        current = existing.get(flag_column(col).lower())
+        if source is None or (current is not None and (
+                current.lower() in generated or (dialect == 'sqlite' and _sqlite_has_flag_triggers(conn, table, current)))):
+            skipped.append(col)
+            continue
+        name = current or flag_column(source)
+        expr = truth_case_sql(source, truth_values)
+        if current is not None:
+            if dialect == 'mysql':
+                conn.execute(text(f'ALTER TABLE {table} MODIFY COLUMN {name} TINYINT AS ({expr}) STORED'))
+            else:
+                conn.execute(text(f'UPDATE {table} SET {name} = {expr}'))
+                if dialect == 'sqlite':
+                    _sqlite_flag_triggers(conn, table, name, source, truth_values)
+            converted.append(name)
+            continue
+        if dialect == 'mysql':
+            # STORED 生成列本身就是物化的，--materialize 与默认相同
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} TINYINT AS ({expr}) STORED'))
+        elif not materialize:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} TINYINT GENERATED ALWAYS AS ({expr}) VIRTUAL'))
+        else:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} TINYINT NOT NULL DEFAULT 0'))
+            conn.execute(text(f'UPDATE {table} SET {name} = {expr}'))
+            if dialect == 'sqlite':
+                _sqlite_flag_triggers(conn, table, name, source, truth_values)
+        added.append(name)
+    indexes = ensure_flag_indexes(conn, table)
+    return {'table': table, 'added': added, 'converted': converted, 'skipped': skipped,
+            'indexes_created': indexes, 'materialized': materialize}
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    parser = argparse.ArgumentParser(description='Add integer <flag>_flag columns to china_disease_data.')
+    parser.add_argument('--materialize', action='store_true',
+                        help='store the values in the table (SQLite: plain columns kept in sync by triggers; '
+                             'MySQL columns are STORED either way)')
+    parser.add_argument('--db-url', help='defaults to DB_URL from the environment / .env')
+    args = parser.parse_args()
+    load_dotenv()
+    engine = create_engine(args.db_url or os.environ['DB_URL'])
+    with engine.begin() as conn:
+        print(json.dumps(add_flag_columns(conn, TRUTH_VALUES, materialize=args.materialize), ensure_ascii=False, indent=2))
@@ -0,0 +1,99 @@
+"""
+病种 → 年龄段 → 住院天数分组 的层级汇总（/api/hospitalization_tree）。
+
+一次分组查询得到 (病种, 年龄段, 住院天数) 的记录数与病例数之和；住院天数按给定的分组边界在这里分桶
+（np.searchsorted），之后用 np.add.at 累加成 [病种, 年龄段, 分组] 的数组，各层节点的合计都是数组求和。
+分组边界 edges = (e0, e1, ..., en) 表示 [e0, e1)、[e1, e2)、…、[en, +∞)；小于 e0 的天数单独归入 "<e0"
+（只在确实出现时列入 bins）。
+
+返回 ECharts treemap / sunburst 共用的树：每个节点为 {name, value, cases, days_sum, avg_days, children}，
+value 为记录数（可加，适合作为面积），其余字段已在服务端算好，前端切换图表类型时不需要重新请求。
+"""
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_EDGES = (0, 3, 7, 14, 30)
+MAX_BINS = 50
+UNKNOWN = 'Unknown'
+
+
+def parse_edges(raw: Optional[str]) -> Tuple[float, ...]:
+    """逗号分隔的分组边界；必须严格递增。不合法时抛出 ValueError。"""
+    if not raw:
+        return DEFAULT_EDGES
+    try:
+        edges = tuple(float(x) for x in raw.split(',') if x.strip())
+    except ValueError:
+        raise ValueError('bins must be comma-separated numbers')
+    if not edges or len(edges) > MAX_BINS:
+        raise ValueError(f'bins must list between 1 and {MAX_BINS} edges')
+    if any(not np.isfinite(e) for e in edges) or any(b <= a for a, b in zip(edges, edges[1:])):
+        raise ValueError('bins must be finite and strictly increasing')
+    return tuple(int(e) if e.is_integer() else e for e in edges)
+
+
+def bin_labels(edges: Sequence[float]) -> List[str]:
+    labels = [f'[{lo}, {hi})' for lo, hi in zip(edges, edges[1:])]
+    return labels + [f'{edges[-1]}+']
+
+
+def _name(value) -> str:
+    return UNKNOWN if value is None else str(value).strip() or UNKNOWN
+
+
+def _node(name: str, records: float, cases: float, days: float, children: Optional[list] = None) -> dict:
+    node = {'name': name, 'value': int(round(records)), 'cases': int(round(cases)),
+            'days_sum': round(float(days), 4), 'avg_days': round(float(days) / records, 4) if records else 0.0}
+    if children is not None:
+        node['children'] = children
+    return node
+
+
+def build_tree(rows: Iterable[Sequence], edges: Sequence[float] = DEFAULT_EDGES, age_order=None) -> dict:
+    """rows 为 (病种, 年龄段, 住院天数, 记录数, 病例数)；住院天数为空或不是数值的行忽略。
+    病种按记录数降序，年龄段按 age_order（默认出现顺序），分组按边界顺序；没有记录的节点省略。"""
+    dis_ix, age_ix = {}, {}
+    d_codes, a_codes, days, records, cases = [], [], [], [], []
+    for disease, age, day, n, c in rows:
+        try:
+            day = float(day)
+        except (TypeError, ValueError):
+            continue
+        d_codes.append(dis_ix.setdefault(_name(disease), len(dis_ix)))
+        a_codes.append(age_ix.setdefault(_name(age), len(age_ix)))
+        days.append(day)
+        records.append(float(n or 0))
+        cases.append(float(c or 0))
+
+    labels = bin_labels(edges)
+    days = np.asarray(days, dtype=np.float64)
+    # searchsorted 后 0 表示小于 e0，i 表示落在第 i 个区间
+    b_codes = np.searchsorted(np.asarray(edges, dtype=np.float64), days, side='right')
+    shape = (len(dis_ix), len(age_ix), len(labels) + 1)
+    idx = (np.asarray(d_codes, dtype=np.int64), np.asarray(a_codes, dtype=np.int64), b_codes)
+    n = np.zeros(shape)
+    c = np.zeros(shape)
+    s = np.zeros(shape)
+    np.add.at(n, idx, np.asarray(records))
+    np.add.at(c, idx, np.asarray(cases))
+    np.add.at(s, idx, days * np.asarray(records))
+    labels = [f'<{edges[0]}'] + labels
+
+    diseases, ages = list(dis_ix), list(age_ix)
+    age_seq = sorted(range(len(ages)), key=(lambda i: age_order(ages[i])) if age_order else None)
+    n_d, c_d, s_d = n.sum(axis=(1, 2)), c.sum(axis=(1, 2)), s.sum(axis=(1, 2))
+    n_a, c_a, s_a = n.sum(axis=2), c.sum(axis=2), s.sum(axis=2)
+    data = []
+    for d in sorted(range(len(diseases)), key=lambda i: (-n_d[i], i)):
+        children = []
+        for a in age_seq:
+            if not n_a[d, a]:
+                continue
+            leaves = [_node(labels[b], n[d, a, b], c[d, a, b], s[d, a, b]) for b in range(len(labels)) if n[d, a, b]]
+            children.append(_node(ages[a], n_a[d, a], c_a[d, a], s_a[d, a], leaves))
+        if children:
+            data.append(_node(diseases[d], n_d[d], c_d[d], s_d[d], children))
+    total = _node('total', n.sum(), c.sum(), s.sum())
+    bins = labels if n[..., 0].any() else labels[1:]
+    return {'edges': list(edges), 'bins': bins, 'total': total, 'data': data}
@@ -0,0 +1,239 @@
+"""
+聚合端点的索引建议（可选自动创建）。
+
+取出 /api/china_disease、/api/disease_locations、/api/region_analysis（不带与带 regions 两种形态）
+实际执行的 SQL（直接调用 app.py 中构造查询的函数，汇总表路由关闭，针对原表），对每条查询：
+
+- 执行 EXPLAIN（MySQL 为 EXPLAIN，SQLite 为 EXPLAIN QUERY PLAN），记录是否全表扫描、是否只读索引；
+- 按查询的访问模式推导候选索引：WHERE 中的等值/IN 列在前，GROUP BY 列随后，再附上查询引用的
+  其余列使其成为覆盖索引（列数超过 --max-columns 时只保留键列；没有 WHERE 的查询此时不给建议，
+  因为它总要读完整张表，非覆盖索引只会增加回表）；
+- 已有索引以候选列为前缀时视为已满足；候选之间互为前缀、或列集合相同只是顺序不同时只保留一个
+  （保留最慢查询的列顺序）；没有 WHERE 的查询总要读完整张表，列集合被已有索引或另一候选包含时，
+  那个索引即可作为覆盖索引整体扫描，不再单独建议。
+--apply 创建建议的索引（必须指定 --top N 只创建最慢的 N 条查询对应的索引，或 --all 全部创建），
+并重新计时、重新 EXPLAIN，输出前后对比。loader.py 的 replace 模式会把正式表上的二级索引复制到新表，
+因此这里创建的索引在重新导入后仍然保留。
+
+用法：
+    python index_advisor.py                 # 只给出建议
+    python index_advisor.py --apply --top 3
+"""
+import argparse
+import hashlib
+import json
+import re
+import statistics
+import time
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy import inspect, text
+
+TABLE = 'china_disease_data'
+MAX_INDEX_COLUMNS = 8
+_IDENT_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+def endpoint_queries(app, region: Optional[str] = None) -> List[tuple]:
+    """[(名称, SQL, 绑定参数)]：各聚合端点在原表上执行的查询。"""
+    cmap = app._get_column_map()
+    queries = [('china_disease', app.PROVINCE_CASES_SQL, {})]
+    loc = app._location_query(cmap.location)
+    if loc is not None:
+        queries.append(('disease_locations', loc, {}))
+    for label, regions in (('region_analysis', None), ('region_analysis?regions', [region] if region else None)):
+        if label.endswith('regions') and not regions:
+            continue
+        _, measure_q, dim_qs, params = app._region_rollup_queries(cmap.region, regions)
+        queries.append((f'{label} measures', measure_q, params))
+        for dim, q in dim_qs.items():
+            queries.append((f'{label} {dim}', q, params))
+    return queries
+
+
+def _clause(sql: str, start: str, stops: Sequence[str]) -> str:
+    m = re.search(rf'\b{start}\b(.*?)(?=\b(?:{"|".join(stops)})\b|$)', sql, re.I | re.S)
+    return m.group(1) if m else ''
+
+
+def access_pattern(sql: str, columns: Dict[str, str]) -> dict:
+    """从 SQL 文本中取出对 TABLE 的访问模式：filter（WHERE 的列）、group（GROUP BY 的列）、
+    other（其余引用到的列），均为原始列名，按出现顺序。只识别直接出现的列名（MONTH(col) 之类的表达式不参与键）。"""
+    def cols(fragment: str) -> List[str]:
+        out = []
+        for tok in _IDENT_RE.findall(fragment):
+            col = columns.get(tok.lower())
+            if col and col not in out:
+                out.append(col)
+        return out
+
+    def plain_cols(fragment: str) -> List[str]:
+        out = []
+        for part in fragment.split(','):
+            col = columns.get(part.strip().lower())
+            if col and col not in out:
+                out.append(col)
+        return out
+
+    where = _clause(sql, 'WHERE', ['GROUP', 'HAVING', 'ORDER', 'LIMIT', 'UNION'])
+    group = _clause(sql, 'GROUP BY', ['HAVING', 'ORDER', 'LIMIT', 'UNION'])
+    filter_cols = [c for c in cols(where) if re.search(rf'\b{c}\s*(=|IN\b)', where, re.I)]
+    group_cols = [c for c in plain_cols(group) if c not in filter_cols]
+    used = cols(sql)
+    return {'filter': filter_cols, 'group': group_cols,
+            'other': [c for c in used if c not in filter_cols and c not in group_cols]}
+
+
+def candidate_index(pattern: dict, max_columns: int = MAX_INDEX_COLUMNS) -> Optional[dict]:
+    key = pattern['filter'] + pattern['group']
+    if not key:
+        return None
+    full = key + pattern['other']
+    filtered = bool(pattern['filter'])
+    if len(full) <= max_columns:
+        return {'columns': full, 'covering': True, 'filtered': filtered}
+    # 只有 GROUP BY 的查询无论如何都要读完整张表，非覆盖索引只会增加回表，不值得建
+    if not filtered:
+        return None
+    return {'columns': key[:max_columns], 'covering': False, 'filtered': filtered}
+
+
+def index_name(table: str, columns: Sequence[str]) -> str:
+    name = f"ix_{table}_{'_'.join(columns)}".lower()
+    if len(name) <= 64:
+        return name
+    # MySQL 标识符最长 64 个字符：过长时截断并附上列清单的哈希
+    digest = hashlib.sha1(','.join(columns).encode()).hexdigest()[:8]
+    return f'{name[:55]}_{digest}'
+
+
+def explain(conn, sql, params: dict) -> dict:
+    """返回 {'plan': [...], 'full_scan': bool, 'index_only': bool}；不支持的数据库返回 plan=None。"""
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        rows = [dict(r) for r in conn.execute(text(f'EXPLAIN {sql}'), params).mappings()]
+        mine = [r for r in rows if r.get('table') == TABLE] or rows
+        return {'plan': [f"{r.get('table')}: type={r.get('type')} key={r.get('key')} rows={r.get('rows')} {r.get('Extra') or ''}".strip()
+                         for r in rows],
+                'full_scan': any(r.get('type') == 'ALL' for r in mine),
+                'index_only': all('Using index' in (r.get('Extra') or '') for r in mine)}
+    if dialect == 'sqlite':
+        details = [r[-1] for r in conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'), params)]
+        scans = [d for d in details if re.search(rf'\b{TABLE}\b', d)]
+        return {'plan': details,
+                'full_scan': any(d.startswith('SCAN') and 'INDEX' not in d for d in scans),
+                'index_only': bool(scans) and all('COVERING INDEX' in d for d in scans)}
+    return {'plan': None, 'full_scan': None, 'index_only': None}
+
+
+def time_query(conn, sql, params: dict, repeat: int) -> float:
+    """执行 repeat 次取中位数（毫秒）。"""
+    samples = []
+    for _ in range(max(repeat, 1)):
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(samples), 3)
+
+
+def _covered(columns: Sequence[str], existing: List[List[str]], any_order: bool = False) -> Optional[List[str]]:
+    """existing 中以 columns 为前缀的索引；any_order 时包含 columns 全部列即可（整体扫描的覆盖索引）。"""
+    want = [c.lower() for c in columns]
+    for ix in existing:
+        have = [c.lower() for c in ix]
+        if have[:len(want)] == want or (any_order and set(want) <= set(have)):
+            return ix
+    return None
+
+
+def advise(engine, queries: List[tuple], apply: bool = False, top: Optional[int] = None, repeat: int = 3,
+           max_columns: int = MAX_INDEX_COLUMNS) -> dict:
+    with engine.connect() as conn:
+        columns = {c.lower(): c for c in conn.execute(text(f'SELECT * FROM {TABLE} LIMIT 0')).keys()}
+        existing = [ix['column_names'] for ix in inspect(conn).get_indexes(TABLE)]
+        report = []
+        for name, sql, params in queries:
+            sql_text = str(sql)
+            pattern = access_pattern(sql_text, columns)
+            report.append({'query': name, 'pattern': pattern, 'candidate': candidate_index(pattern, max_columns),
+                           'before': {'ms': time_query(conn, sql, params, repeat), **explain(conn, sql_text, params)}})
+
+    # 汇总候选：去掉已被现有索引满足的；列集合相同的合并为一个（按慢到快处理，保留最慢查询的列顺序）
+    proposals = {}
+    for entry in sorted(report, key=lambda e: e['before']['ms'], reverse=True):
+        cand = entry['candidate']
+        if cand is None:
+            continue
+        satisfied = _covered(cand['columns'], existing, any_order=not cand['filtered'])
+        if satisfied is not None:
+            entry['satisfied_by'] = satisfied
+            continue
+        key = tuple(c.lower() for c in cand['columns'])
+        key = next((other for other in proposals if set(other) == set(key)), key)
+        proposal = proposals.setdefault(key, {'name': index_name(TABLE, cand['columns']), 'columns': cand['columns'],
+                                              'covering': cand['covering'], 'filtered': False, 'queries': [],
+                                              'slowest_ms': entry['before']['ms']})
+        proposal['filtered'] = proposal['filtered'] or cand['filtered']
+        proposal['queries'].append(entry['query'])
+    # 再合并是另一候选前缀的，以及没有 WHERE、列集合被另一候选包含的
+    for key in sorted(proposals, key=len):
+        longer = next((other for other in proposals if other != key and (
+            other[:len(key)] == key or (not proposals[key]['filtered'] and set(key) <= set(other)))), None)
+        if longer is not None:
+            merged = proposals.pop(key)
+            proposals[longer]['queries'].extend(merged['queries'])
+            proposals[longer]['slowest_ms'] = max(proposals[longer]['slowest_ms'], merged['slowest_ms'])
+    ordered = sorted(proposals.values(), key=lambda p: p['slowest_ms'], reverse=True)
+    for p in ordered:
+        p['ddl'] = f"CREATE INDEX {p['name']} ON {TABLE} ({', '.join(p['columns'])})"
+
+    result = {'table': TABLE, 'existing_indexes': existing, 'proposals': ordered, 'queries': report}
+    if not apply:
+        return result
+
+    chosen = ordered[:top] if top else ordered
+    created, failed = [], []
+    started = time.time()
+    for p in chosen:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(p['ddl']))
+            created.append(p['name'])
+        except Exception as e:
+            # 例如 TEXT 列在 MySQL 上不能直接建索引；记录后继续其它索引
+            failed.append({'name': p['name'], 'error': str(e).splitlines()[0]})
+    result.update(created=created, failed=failed, create_seconds=round(time.time() - started, 3))
+    with engine.connect() as conn:
+        for entry, (name, sql, params) in zip(report, queries):
+            entry['after'] = {'ms': time_query(conn, sql, params, repeat), **explain(conn, str(sql), params)}
+            before = entry['before']['ms']
+            entry['speedup'] = round(before / entry['after']['ms'], 2) if entry['after']['ms'] else None
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Propose (and optionally create) indexes for the aggregate endpoints.')
+    parser.add_argument('--apply', action='store_true',
+                        help='create the proposed indexes and re-time the queries (needs --top or --all)')
+    parser.add_argument('--top', type=int, help='with --apply, only create the indexes for the N slowest queries')
+    parser.add_argument('--all', action='store_true', help='with --apply, create every proposed index')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per query (median is reported)')
+    parser.add_argument('--max-columns', type=int, default=MAX_INDEX_COLUMNS,
+                        help='largest index to propose; wider covering candidates keep only their key columns')
+    parser.add_argument('--region', help='province used for the regions= form of /api/region_analysis '
+                                         '(default: the first one in the table)')
+    args = parser.parse_args(argv)
+    if args.apply and not (args.top or args.all):
+        parser.error('--apply creates indexes that slow every write; pass --top N or --all')
+
+    import app
+    region = args.region
+    if region is None:
+        with app.engine.connect() as conn:
+            region = conn.execute(text(f'SELECT {app._get_column_map().region["province_col"]} FROM {TABLE} LIMIT 1')).scalar()
+    result = advise(app.engine, endpoint_queries(app, region), args.apply, args.top, args.repeat, args.max_columns)
+    print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+"""
+把 public/ 下的 CSV 批量导入数据库（china_disease_data 与 china_water_pollution_data）。
+
+- 按块流式读取 CSV（--chunk-size 行一块），内存占用与文件大小无关；
+- 按下面 TABLES 中声明的列类型做类型转换，无法转换的行报错（或 --skip-bad-rows 跳过并计数）；
+- 写入方式：executemany 批量插入（默认，任何数据库可用），或 MySQL 的 LOAD DATA LOCAL INFILE
+  （--method infile，需要服务端开启 local_infile）；
+- 模式：append 追加；upsert 按声明的键（或 --key）插入或更新；
+  replace 先写入 <表>_load 临时表、建好索引后整体替换正式表，导入过程中读者始终看到旧数据；
+- china_disease_data 的 13 个 Yes/No 标志列各有一个整数列 <列>_flag（见 flags.py）：新建的表中是 STORED 生成列，
+  由数据库计算与维护；写入已有的、<列>_flag 仍是普通列的旧表时按同样的规则计算后写入。导入结束后为其建单列索引；
+- 二级索引在数据写完之后再建（replace 模式在临时表上建好再替换），不在逐行写入时维护；
+  replace 模式还会把正式表上已有、声明中没有的二级索引（例如 index_advisor.py --apply 创建的）复制到临时表，
+  重新导入不会丢掉它们；
+- 每块打印累计行数与 rows/s，结束时输出汇总；
+- 导入结束时在 data_versions 表中递增该表的数据版本，API 进程据此作废 execute_sql 的结果缓存。
+
+用法：
+    python loader.py china_disease_data --mode replace
+    python loader.py china_water_pollution_data --csv ../public/china_water_pollution_data.csv --method infile
+导入 china_disease_data 后，已构建的汇总表随之过期（API 改查原表），请重新构建（python cube.py）。
+"""
+import argparse
+import csv
+import datetime
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import (Column, Computed, Date, Float, Index, Integer, MetaData, SmallInteger, String, Table, create_engine,
+                        inspect, text)
+from sqlalchemy.dialects.mysql import TINYINT
+
+from flags import (FLAG_COLUMNS, TRUTH_VALUES, ensure_flag_indexes, flag_column, flag_value, generated_columns,
+                   truth_case_sql)
+from result_cache import bump_table_version
+
+PUBLIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'public')
+
+_TYPES = {'int': Integer, 'float': Float, 'str': String(64), 'text': String(255), 'date': Date,
+          'flag': SmallInteger().with_variant(TINYINT(), 'mysql')}
+
+
+class TableSpec:
+    def __init__(self, name: str, csv_file: str, columns: Sequence[Tuple[str, str]],
+                 key: Optional[Sequence[str]] = None, indexes: Sequence[Sequence[str]] = (),
+                 flags: Sequence[str] = ()):
+        self.name = name
+        self.csv_path = os.path.join(PUBLIC_DIR, csv_file)
+        # (列名, 类型)；类型取 _TYPES 的键
+        self.columns = list(columns)
+        self.key = tuple(key) if key else None
+        self.indexes = [tuple(ix) for ix in indexes]
+        # flags.py 的整数标志列：(<列>_flag, 原列)
+        self.flag_columns = [(flag_column(c), c) for c in flags]
+
+    def table(self, name: Optional[str] = None, metadata: Optional[MetaData] = None,
+              only: Optional[set] = None) -> Table:
+        """only 为小写列名集合时只包含这些列（写入已有的表时跳过它没有的列和数据库生成列）。"""
+        cols = [Column(col, _TYPES[kind]) for col, kind in self.columns]
+        # 生成列：不经过 loader.py 的写入同样由数据库维护
+        cols += [Column(col, _TYPES['flag'], Computed(truth_case_sql(source, TRUTH_VALUES), persisted=True))
+                 for col, source in self.flag_columns]
+        if only is not None:
+            cols = [c for c in cols if c.name.lower() in only]
+        return Table(name or self.name, metadata or MetaData(), *cols)
+
+
+_FLAG = 'str'
+TABLES: Dict[str, TableSpec] = {
+    'china_disease_data': TableSpec(
+        'china_disease_data', 'china_disease_data.csv',
+        [('Disease', 'str'), ('Province', 'str'), ('Age_Group', 'str'), ('Gender', 'str'),
+         ('Reported_Cases', 'int'), ('Deaths', 'int'), ('Hospitalized', _FLAG), ('Recovered', _FLAG),
+         ('Month', 'int'), ('Year', 'int'), ('Season', 'str'), ('Urban_Rural', 'str'),
+         ('Vaccinated', _FLAG), ('Travel_History', _FLAG), ('Comorbidity', _FLAG), ('Quarantined', _FLAG),
+         ('ICU_Admission', _FLAG), ('Symptom_Fever', _FLAG), ('Symptom_Cough', _FLAG), ('Symptom_Rash', _FLAG),
+         ('Contact_Tracing', _FLAG), ('Lab_Confirmed', _FLAG), ('Follow_Up', _FLAG),
+         ('Days_Hospitalized', 'int'), ('Region_Code', 'int')],
+        # 一条上报记录：地区编码 × 年月 × 病种 × 人群
+        key=('Province', 'Disease', 'Age_Group', 'Gender', 'Year', 'Month', 'Region_Code'),
+        indexes=[('Province', 'Disease'), ('Disease',), ('Year', 'Month')],
+        flags=FLAG_COLUMNS,
+    ),
+    'china_water_pollution_data': TableSpec(
+        'china_water_pollution_data', 'china_water_pollution_data.csv',
+        [('Province', 'str'), ('City', 'str'), ('Monitoring_Station', 'str'), ('Latitude', 'float'),
+         ('Longitude', 'float'), ('Date', 'date'), ('Water_Temperature_C', 'float'), ('pH', 'float'),
+         ('Dissolved_Oxygen_mg_L', 'float'), ('Conductivity_uS_cm', 'float'), ('Turbidity_NTU', 'float'),
+         ('Nitrate_mg_L', 'float'), ('Nitrite_mg_L', 'float'), ('Ammonia_N_mg_L', 'float'),
+         ('Total_Phosphorus_mg_L', 'float'), ('Total_Nitrogen_mg_L', 'float'), ('COD_mg_L', 'float'),
+         ('BOD_mg_L', 'float'), ('Heavy_Metals_Pb_ug_L', 'float'), ('Heavy_Metals_Cd_ug_L', 'float'),
+         ('Heavy_Metals_Hg_ug_L', 'float'), ('Coliform_Count_CFU_100mL', 'float'), ('Water_Quality_Index', 'float'),
+         ('Pollution_Level', 'str'), ('Remarks', 'text')],
+        # 同一站点同一天可能有多条读数，没有天然唯一键；upsert 需用 --key 指定
+        key=None,
+        indexes=[('Province',), ('Monitoring_Station', 'Date')],
+    ),
+}
+
+
+class BadRow(ValueError):
+    pass
+
+
+def _coerce(value: Optional[str], kind: str):
+    if value is None:
+        return None
+    v = value.strip()
+    if kind in ('str', 'text'):
+        return value
+    if v == '':
+        return None
+    if kind == 'int':
+        try:
+            return int(v)
+        except ValueError:
+            f = float(v)
+            if not f.is_integer():
+                raise
+            return int(f)
+    if kind == 'float':
+        return float(v)
+    if kind == 'date':
+        return datetime.date.fromisoformat(v[:10])
+    raise ValueError(f'unknown column type {kind}')
+
+
+def read_chunks(spec: TableSpec, path: str, chunk_size: int, skip_bad: bool, stats: dict,
+                flag_columns: Optional[Sequence[Tuple[str, str]]] = None) -> Iterator[List[dict]]:
+    """逐块产出按声明类型转换好的行（dict）。CSV 表头按列名大小写不敏感匹配，缺失的列为 NULL。
+    flag_columns 为需要计算的 (<列>_flag, 原列)，默认为 spec 声明的全部。"""
+    flag_columns = spec.flag_columns if flag_columns is None else flag_columns
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        pos = {h.strip().lower(): i for i, h in enumerate(header)}
+        layout = [(col, kind, pos.get(col.lower())) for col, kind in spec.columns]
+        missing = [col for col, _, i in layout if i is None]
+        if missing:
+            print(f'warning: {os.path.basename(path)} has no column(s) {missing}; loading them as NULL', file=sys.stderr)
+        chunk = []
+        for line_no, row in enumerate(reader, start=2):
+            if not row:
+                continue
+            try:
+                rec = {col: _coerce(row[i] if i is not None and i < len(row) else None, kind) for col, kind, i in layout}
+                for col, source in flag_columns:
+                    rec[col] = flag_value(rec[source], TRUTH_VALUES)
+                chunk.append(rec)
+            except (ValueError, IndexError) as e:
+                if not skip_bad:
+                    raise BadRow(f'{path}:{line_no}: {e}') from e
+                stats['skipped'] += 1
+                if len(stats['bad_lines']) < 20:
+                    stats['bad_lines'].append(line_no)
+                continue
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _upsert_statement(conn, table: Table, key: Sequence[str]):
+    cols = [c.name for c in table.columns if c.name not in key]
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in cols})
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(table)
+        return stmt.on_conflict_do_update(index_elements=list(key), set_={c: stmt.excluded[c] for c in cols})
+    raise ValueError(f'upsert is not supported on {dialect}')
+
+
+def _load_data_infile(conn, table: Table, rows: List[dict], replace: bool):
+    """MySQL LOAD DATA LOCAL INFILE：把这一块写成临时 CSV 后一次性导入（NULL 写作 \\N）。"""
+    cols = [c.name for c in table.columns]
+    fd, tmp = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+            w = csv.writer(f, lineterminator='\n')
+            for r in rows:
+                w.writerow(['\\N' if r[c] is None else r[c] for c in cols])
+        conn.execute(text(
+            f"LOAD DATA LOCAL INFILE :path {'REPLACE' if replace else ''} INTO TABLE {table.name} "
+            f"CHARACTER SET utf8mb4 FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+            f"LINES TERMINATED BY '\\n' ({', '.join(cols)})"
+        ), {'path': tmp.replace('\\', '/')})
+    finally:
+        os.remove(tmp)
+
+
+def _index_name(table_name: str, cols: Sequence[str], suffix: str = '') -> str:
+    name = f"ix_{table_name}_{'_'.join(cols)}".lower()
+    tail = f'_{suffix}' if suffix else ''
+    if len(name) + len(tail) > 64:
+        # MySQL 标识符最长 64 个字符：过长时截断并附上列清单的哈希，列不同的索引截断后不会重名
+        digest = hashlib.sha1(','.join(cols).lower().encode()).hexdigest()[:8]
+        name = f'{name[:64 - len(tail) - 9]}_{digest}'
+    return name + tail
+
+
+def ensure_indexes(conn, spec: TableSpec, table: Table, suffix: str = '') -> List[str]:
+    """为缺少的声明索引建索引（按列判断是否已存在，与索引名无关）。返回新建的索引名。"""
+    existing = {tuple(c.lower() for c in ix['column_names']) for ix in inspect(conn).get_indexes(table.name)}
+    created = []
+    for cols in spec.indexes:
+        if tuple(c.lower() for c in cols) in existing:
+            continue
+        name = _index_name(spec.name, cols, suffix)
+        Index(name, *[table.c[c] for c in cols]).create(conn)
+        created.append(name)
+    return created
+
+
+def copy_live_indexes(conn, live: str, staging: Table, suffix: str) -> List[str]:
+    """replace 模式：把正式表 live 上的二级索引（按列判断）补建到临时表，返回新建的索引名。
+    表达式索引与临时表没有的列上的索引跳过。"""
+    inspector = inspect(conn)
+    if not inspector.has_table(live):
+        return []
+    existing = {tuple(c.lower() for c in ix['column_names']) for ix in inspector.get_indexes(staging.name)}
+    columns = {c.name.lower(): c for c in staging.columns}
+    created = []
+    for ix in inspector.get_indexes(live):
+        cols = ix['column_names']
+        if any(c is None or c.lower() not in columns for c in cols) or tuple(c.lower() for c in cols) in existing:
+            continue
+        name = _index_name(live, cols, suffix)
+        Index(name, *[columns[c.lower()] for c in cols], unique=bool(ix.get('unique'))).create(conn)
+        existing.add(tuple(c.lower() for c in cols))
+        created.append(name)
+    return created
+
+
+def _ensure_key_index(conn, table: Table, key: Sequence[str]):
+    existing = inspect(conn).get_indexes(table.name)
+    if any(ix.get('unique') and [c.lower() for c in ix['column_names']] == [k.lower() for k in key] for ix in existing):
+        return
+    Index(_index_name(table.name, ('key',) + tuple(key)), *[table.c[c] for c in key], unique=True).create(conn)
+
+
+def _swap_in(conn, live: str, staging: str):
+    old = f'{live}_old'
+    conn.execute(text(f'DROP TABLE IF EXISTS {old}'))
+    exists = inspect(conn).has_table(live)
+    if conn.dialect.name == 'mysql':
+        conn.execute(text(f'RENAME TABLE {live} TO {old}, {staging} TO {live}' if exists else f'RENAME TABLE {staging} TO {live}'))
+    else:
+        if exists:
+            conn.execute(text(f'ALTER TABLE {live} RENAME TO {old}'))
+        conn.execute(text(f'ALTER TABLE {staging} RENAME TO {live}'))
+    if exists:
+        conn.execute(text(f'DROP TABLE {old}'))
+
+
+def load_csv(engine, table_name: str, path: Optional[str] = None, mode: str = 'append', method: str = 'executemany',
+             chunk_size: int = 10000, key: Optional[Sequence[str]] = None, skip_bad: bool = False,
+             progress=None) -> dict:
+    """导入一个 CSV，返回 {rows, skipped, seconds, rows_per_sec, ...}。progress(已导入行数, rows/s) 每块回调一次。"""
+    if table_name not in TABLES:
+        raise ValueError(f'unknown table {table_name}; known: {sorted(TABLES)}')
+    if mode not in ('append', 'upsert', 'replace'):
+        raise ValueError(f'unknown mode {mode}')
+    if method not in ('executemany', 'infile'):
+        raise ValueError(f'unknown method {method}')
+    spec = TABLES[table_name]
+    key = tuple(key) if key else spec.key
+    if mode == 'upsert' and not key:
+        raise ValueError(f'{table_name} has no declared key; pass --key for upsert')
+    if method == 'infile' and engine.dialect.name != 'mysql':
+        raise ValueError('LOAD DATA LOCAL INFILE is only available on MySQL')
+    path = path or spec.csv_path
+
+    started = time.time()
+    suffix = format(int(started), 'x')
+    target = f'{table_name}_load' if mode == 'replace' else table_name
+    table = spec.table(target)
+    with engine.begin() as conn:
+        if mode == 'replace':
+            conn.execute(text(f'DROP TABLE IF EXISTS {target}'))
+        table.create(conn, checkfirst=True)
+        # 只写入可写的列：生成列（新建的表中的 <列>_flag、flags.py 补上的列）由数据库计算；
+        # 已有的旧表可能没有 <列>_flag，或其中是普通列（此时按同样的规则计算后写入）
+        writable = ({c.lower() for c in conn.execute(text(f'SELECT * FROM {target} LIMIT 0')).keys()}
+                    - {c.lower() for c in generated_columns(conn, target)})
+        table = spec.table(target, only=writable)
+        flag_cols = [(col, source) for col, source in spec.flag_columns if col.lower() in writable]
+        if mode == 'upsert':
+            # upsert 依赖键上的唯一索引判断冲突，必须在写入前存在
+            _ensure_key_index(conn, table, key)
+        stmt = _upsert_statement(conn, table, key) if mode == 'upsert' else table.insert()
+
+    stats = {'skipped': 0, 'bad_lines': []}
+    rows = 0
+    for chunk in read_chunks(spec, path, chunk_size, skip_bad, stats, flag_cols):
+        # 每块一个事务：append/upsert 中途失败时已提交的块保留，replace 模式下旧表不受影响
+        with engine.begin() as conn:
+            if method == 'infile':
+                _load_data_infile(conn, table, chunk, replace=(mode == 'upsert'))
+            else:
+                conn.execute(stmt, chunk)
+        rows += len(chunk)
+        if progress:
+            progress(rows, rows / max(time.time() - started, 1e-9))
+
+    loaded = time.time()
+    with engine.begin() as conn:
+        created = ensure_indexes(conn, spec, table, suffix if mode == 'replace' else '')
+        if spec.flag_columns:
+            created += ensure_flag_indexes(conn, target, table_name, suffix if mode == 'replace' else '')
+        if mode == 'replace':
+            created += copy_live_indexes(conn, table_name, spec.table(target), suffix)
+            _swap_in(conn, table_name, target)
+        # API 进程据此作废 execute_sql 的结果缓存（见 result_cache.py）
+        bump_table_version(conn, table_name)
+    elapsed = time.time() - started
+    return {'table': table_name, 'csv': path, 'mode': mode, 'method': method, 'rows': rows,
+            'skipped': stats['skipped'], 'bad_lines': stats['bad_lines'], 'indexes_created': created,
+            'load_seconds': round(loaded - started, 3), 'index_seconds': round(time.time() - loaded, 3),
+            'seconds': round(elapsed, 3), 'rows_per_sec': round(rows / max(elapsed, 1e-9), 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk-load the disease / water-pollution CSVs.')
+    parser.add_argument('table', choices=sorted(TABLES))
+    parser.add_argument('--csv', help='CSV path (default: the file under public/)')
+    parser.add_argument('--mode', choices=['append', 'upsert', 'replace'], default='append')
+    parser.add_argument('--method', choices=['executemany', 'infile'], default='executemany')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--key', help='comma-separated upsert key (overrides the declared key)')
+    parser.add_argument('--skip-bad-rows', action='store_true', help='skip rows that fail type coercion instead of aborting')
+    parser.add_argument('--db-url', help='defaults to DB_URL from the environment / .env')
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    db_url = args.db_url or os.environ.get('DB_URL')
+    if not db_url:
+        parser.error('DB_URL is not set')
+    connect_args = {'local_infile': True} if args.method == 'infile' else {}
+    engine = create_engine(db_url, pool_pre_ping=True, connect_args=connect_args)
+
+    def progress(rows, rate):
+        print(f'{args.table}: {rows} rows, {rate:.0f} rows/s', file=sys.stderr)
+
+    key = [k.strip() for k in args.key.split(',') if k.strip()] if args.key else None
+    try:
+        result = load_csv(engine, args.table, args.csv, args.mode, args.method, args.chunk_size, key,
+                          args.skip_bad_rows, progress)
+    except (BadRow, ValueError) as e:
+        parser.exit(1, f'error: {e}\n')
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+按请求的数据库/上游耗时统计，Server-Timing 响应头与 Prometheus 格式的直方图。
+
+- instrument_engine 在 Engine 上挂 before/after_cursor_execute 事件，把查询次数、数据库耗时与返回行数
+  记到当前请求的 RequestStats；连接池取连接（含等待与新建连接）的耗时通过包装 pool.connect 记录；
+- 当前请求的 RequestStats 保存在 contextvar 中：中间件在请求开始时设置，线程池（run_in_threadpool）
+  与 asyncio 任务都会复制上下文，因此在其中执行的查询同样计入；请求之外（后台刷新线程等）的查询不计入；
+- 行数为实际取到的行数：返回行的语句执行后，把结果对象读取的游标换成计数代理（_CountingCursor），
+  服务端游标（stream_results）分批读取时同样按实际读到的行累计；流式响应在响应头发出之后读到的行不计入；
+- Histogram 线程安全，按标签分别累计；render() 输出 Prometheus 文本格式。
+每个进程各自统计（多 worker 部署时由 Prometheus 分别抓取或在上层汇总）。
+"""
+import contextvars
+import threading
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_seconds', 'rows', 'pool_seconds', 'upstream_seconds', '_lock')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.pool_seconds = 0.0
+        self.upstream_seconds = 0.0
+        # region_analysis 的并发查询可能在多个线程中同时记录
+        self._lock = threading.Lock()
+
+    def add(self, **amounts):
+        with self._lock:
+            for name, value in amounts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def server_timing(self, total_seconds: float) -> str:
+        parts = [f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries, {self.rows} rows"',
+                 f'pool;dur={self.pool_seconds * 1000:.1f}']
+        if self.upstream_seconds:
+            parts.append(f'llm;dur={self.upstream_seconds * 1000:.1f}')
+        parts.append(f'total;dur={total_seconds * 1000:.1f}')
+        return ', '.join(parts)
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar('request_stats', default=None)
+
+
+def start_request() -> Tuple[RequestStats, contextvars.Token]:
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end_request(token: contextvars.Token):
+    _current.reset(token)
+
+
+def current() -> Optional[RequestStats]:
+    return _current.get()
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        # 标签取值 -> [各桶计数..., 总和, 次数]
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for key, series in items:
+            labels = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{_labels(labels + [("le", _fmt(bound))])} {count}')
+            lines.append(f'{self.name}_bucket{_labels(labels + [("le", "+Inf")])} {series[-1]}')
+            suffix = _labels(labels)
+            lines.append(f'{self.name}_sum{suffix} {series[-2]}')
+            lines.append(f'{self.name}_count{suffix} {series[-1]}')
+        return '\n'.join(lines)
+
+
+def _fmt(bound: float) -> str:
+    return str(int(bound)) if float(bound).is_integer() else repr(float(bound))
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ''
+    escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(histograms: Sequence[Histogram]) -> str:
+    return '\n'.join(h.render() for h in histograms) + '\n'
+
+
+class _CountingCursor:
+    """DB-API 游标的代理：fetchone / fetchmany / fetchall 取到的行数记入 stats，其余属性转给原游标。
+    驱动的 rowcount 不能代替：SQLite 对 SELECT 为 -1，PyMySQL 的服务端游标（stream_results）为 2**64-1。"""
+
+    __slots__ = ('_cursor', '_stats')
+
+    def __init__(self, cursor, stats: RequestStats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.add(rows=1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._stats.add(rows=len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.add(rows=len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def instrument_engine(engine):
+    """在 engine 上记录每条语句的耗时与行数，以及从连接池取连接的耗时。"""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        stats = _current.get()
+        started = getattr(context, '_metrics_started', None)
+        if stats is None or started is None:
+            return
+        stats.add(queries=1, db_seconds=time.perf_counter() - started)
+        if cursor.description is not None:
+            # 返回行的语句：结果对象随后从 context.cursor 取行，换成计数的代理即可统计实际取到的行数
+            context.cursor = _CountingCursor(cursor, stats)
+
+    pool = engine.pool
+    connect = pool.connect
+
+    def timed_connect(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return connect(*args, **kwargs)
+        finally:
+            stats = _current.get()
+            if stats is not None:
+                stats.add(pool_seconds=time.perf_counter() - started)
+
+    # Engine 取连接时调用的是 pool.connect；实例属性覆盖即可，不需要替换连接池类型
+    pool.connect = timed_connect
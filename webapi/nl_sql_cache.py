@@ -0,0 +1,111 @@
+"""
+自然语言问题 → 参数化 SQL 翻译结果的两级缓存。
+
+- 第一级：进程内 LRU（OrderedDict），命中时不需要任何 IO；
+- 第二级：本地 SQLite 文件（WAL 模式），进程重启后仍然有效，多个 worker 之间共享；
+- 键由调用方构造（模型名、表结构哈希与规范化后的问题），值为已通过校验的 {sql, params, explain}。
+上游模型调用每次需要数秒且按 token 计费，而实际问题重复率很高，缓存命中即可跳过上游。
+"""
+import copy
+import json
+import sqlite3
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from typing import Optional
+
+
+class TranslationCache:
+    def __init__(self, path: Optional[str] = None, max_entries: int = 1024, ttl: float = 7 * 86400):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 or bool(self.path)
+
+    def _db(self):
+        # 调用方持有 self._lock；单个连接跨线程复用（check_same_thread=False）
+        if self._conn is None and self.path:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS nl_sql_cache ('
+                'key TEXT PRIMARY KEY, question TEXT, value TEXT NOT NULL, created REAL NOT NULL)'
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _fresh(self, created: float) -> bool:
+        return self.ttl <= 0 or time.time() - created <= self.ttl
+
+    def _remember(self, key: str, value: dict, created: float):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (value, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[dict]:
+        """返回缓存的翻译结果（副本，调用方可以随意修改），未命中或已过期返回 None。"""
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                if self._fresh(hit[1]):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(hit[0])
+                self._entries.pop(key, None)
+            try:
+                db = self._db()
+                row = db.execute('SELECT value, created FROM nl_sql_cache WHERE key = ?', (key,)).fetchone() if db else None
+            except sqlite3.Error:
+                # 磁盘层出错时退化为只用内存层，不影响翻译主流程
+                traceback.print_exc()
+                row = None
+            if row is not None and self._fresh(row[1]):
+                value = json.loads(row[0])
+                self._remember(key, value, row[1])
+                self.disk_hits += 1
+                return copy.deepcopy(value)
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: dict, question: Optional[str] = None):
+        value = copy.deepcopy(value)
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            try:
+                db = self._db()
+                if db:
+                    db.execute('INSERT OR REPLACE INTO nl_sql_cache (key, question, value, created) VALUES (?, ?, ?, ?)',
+                               (key, question, json.dumps(value, ensure_ascii=False), now))
+                    db.commit()
+            except sqlite3.Error:
+                traceback.print_exc()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            try:
+                db = self._db()
+                if db:
+                    db.execute('DELETE FROM nl_sql_cache')
+                    db.commit()
+            except sqlite3.Error:
+                traceback.print_exc()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries, 'path': self.path,
+                    'ttl': self.ttl, 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
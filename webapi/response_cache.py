@@ -0,0 +1,204 @@
+"""
+只读聚合端点的服务端响应缓存。
+
+- 以规范化后的查询为键，缓存序列化好的 JSON 字节与其强 ETag；
+- 按总字节数与条目数做 LRU 淘汰，内存占用有上限；
+- 新鲜期（ttl）内直接命中；过期后的 stale_ttl 窗口内先返回旧值，同时在后台线程重新计算
+  （stale-while-revalidate），因此过期后的第一个请求也不用等待数据库；
+- 同一个键同时未命中时只计算一次，其余请求等待该结果。
+get() 供同步调用方（线程池）使用，aget() 供异步调用方在事件循环上使用。
+"""
+import asyncio
+import hashlib
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 比较（RFC 7232 规定该头使用弱比较，因此忽略 W/ 前缀）。"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'created', '_variants')
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = make_etag(body)
+        self.created = time.time()
+        self._variants = {}
+
+    def variant(self, key: Hashable, build: Callable[[], bytes]) -> bytes:
+        """同一响应的其它表示形式（MessagePack、压缩后的字节等），首次使用时由 build() 生成并随条目保存。
+        这些字节不计入缓存的总字节数；并发的首次请求可能各自生成一次，结果相同。"""
+        body = self._variants.get(key)
+        if body is None:
+            body = self._variants[key] = build()
+        return body
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = 60, stale_ttl: float = 600, max_bytes: int = 64 * 1024 * 1024, max_entries: int = 512):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._ainflight = {}
+        self._refreshing = set()
+        self._tasks = set()
+        # 每次 clear() 递增；清空前已开始的计算结果不再写回缓存
+        self._generation = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def get(self, key: Hashable, loader: Callable[[], bytes]) -> CacheEntry:
+        """返回 key 对应的缓存条目；loader() 负责计算并序列化响应体。"""
+        if not self.enabled:
+            return CacheEntry(loader())
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry.created
+                if age <= self.ttl:
+                    self._entries.move_to_end(key)
+                    return entry
+                if age <= self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        threading.Thread(target=self._refresh, args=(key, loader, self._generation), daemon=True).start()
+                    return entry
+            waiter = self._inflight.get(key)
+            if waiter is None:
+                waiter = self._inflight[key] = threading.Event()
+                owner = True
+                generation = self._generation
+            else:
+                owner = False
+        if not owner:
+            waiter.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                return entry
+            # 计算方失败（或缓存被清空）时自行计算一次，让异常按正常路径抛给调用方
+            return CacheEntry(loader())
+        try:
+            entry = CacheEntry(loader())
+            self._put(key, entry, generation)
+            return entry
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            waiter.set()
+
+    async def aget(self, key: Hashable, aloader: Callable) -> CacheEntry:
+        """get() 的协程版本：aloader() 返回可等待对象（结果为响应体字节），
+        首次计算与后台刷新都在当前事件循环上进行，不占用线程。"""
+        if not self.enabled:
+            return CacheEntry(await aloader())
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry.created
+                if age <= self.ttl:
+                    self._entries.move_to_end(key)
+                    return entry
+                if age <= self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        task = asyncio.get_running_loop().create_task(self._arefresh(key, aloader, self._generation))
+                        self._tasks.add(task)
+                        task.add_done_callback(self._tasks.discard)
+                    return entry
+            fut = self._ainflight.get(key)
+            generation = self._generation
+        if fut is not None:
+            entry = await asyncio.shield(fut)
+            # 计算方失败时自行计算一次，让异常按正常路径抛给调用方
+            return entry if entry is not None else CacheEntry(await aloader())
+        fut = self._ainflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            entry = CacheEntry(await aloader())
+            self._put(key, entry, generation)
+            fut.set_result(entry)
+            return entry
+        finally:
+            if not fut.done():
+                fut.set_result(None)
+            self._ainflight.pop(key, None)
+
+    async def _arefresh(self, key, aloader, generation):
+        try:
+            self._put(key, CacheEntry(await aloader()), generation)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh(self, key, loader, generation):
+        try:
+            self._put(key, CacheEntry(loader()), generation)
+        except Exception:
+            # 后台刷新失败时继续提供旧值，直到超出 stale 窗口
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _put(self, key, entry: CacheEntry, generation: int):
+        size = len(entry.body)
+        with self._lock:
+            if generation != self._generation or size > self.max_bytes:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.body)
+            self._entries[key] = entry
+            self._bytes += size
+            while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._generation += 1
+
+    @property
+    def generation(self) -> int:
+        """每次 clear() 加一；由同一份数据派生的其它缓存据此判断是否需要重建。"""
+        return self._generation
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'ttl': self.ttl, 'stale_ttl': self.stale_ttl}
@@ -0,0 +1,211 @@
+"""
+/api/execute_sql 的结果缓存。
+
+- 键为规范化后的 SQL 与按占位符顺序排列的绑定参数值。规范化只做不改变语义的改写：
+  字符串字面量与引号标识符原样保留；空白压缩为一个空格（括号内侧、逗号与比较运算符两侧的空白去掉）；
+  普通注释去掉（/*! */ 与 /*+ */ 会影响执行，原样保留）；结构性关键字转为大写；
+  选择列表原样保留，因为未写别名的列名就是表达式原文，改写会让命中的结果带上另一条语句的列名；
+  占位符按首次出现的顺序改名为 :p1、:p2…，因此只是占位符名字不同的同一条语句共用一个条目；
+- 数据版本：loader.py 每次导入结束时在 data_versions 表中把该表的版本号加一（bump_table_version），
+  API 进程定期读取所有表的版本（read_data_versions）；任一版本变化时整个缓存作废。直接改动数据库之后可调用
+  POST /api/admin/cache/clear；另有 ttl 兜底；
+- 按条目数与总字节数做 LRU 淘汰；单个结果超过 max_entry_bytes 时不缓存，大结果永远不会占满缓存。
+"""
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Tuple
+
+from sqlalchemy import BigInteger, Column, Integer, MetaData, String, Table, select
+from sqlalchemy.exc import SQLAlchemyError
+
+VERSION_TABLE = 'data_versions'
+
+_versions = Table(VERSION_TABLE, MetaData(),
+                  Column('table_name', String(64), primary_key=True),
+                  Column('version', BigInteger().with_variant(Integer, 'sqlite'), nullable=False))
+
+# 只对结构性关键字做大小写统一；函数名与别名不在其中（选择列表本身原样保留，见 canonical_sql）
+KEYWORDS = frozenset('''
+    all and any as asc between by case cross desc distinct else end exists false from full group having in inner
+    interval is join left like limit not null offset on or order outer over partition regexp right select then
+    true union using when where with
+'''.split())
+# 在同一括号层级遇到这些关键字（或右括号）时选择列表结束
+_SELECT_LIST_END = frozenset('from where group having order limit union intersect except into window'.split())
+
+# 占位符的写法与 SQLAlchemy text() 一致（前面不能是冒号、字母数字或反斜杠，后面不能是冒号）；
+# MySQL 的 -- 注释要求后面跟空白（5--1 是减去负一）
+_TOKEN_RE = re.compile(r"""
+    (?P<quoted>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`]|``)*`)
+  | (?P<hint>/\*[!+].*?\*/)
+  | (?P<comment>--(?=\s|$)[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<param>(?<![:\w\\]):(?P<name>\w+)(?!:))
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<op><=>|<=|>=|<>|!=|=|<|>)
+  | (?P<space>\s+)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+# 这些符号之后 / 之前的空白不影响语义；比较运算符两侧的空白也去掉（但两个运算符之间的空白保留，< = 不是 <=）
+_TIGHT_AFTER = ('(', ',')
+_TIGHT_BEFORE = (')', ',')
+
+
+def canonical_sql(sql: str) -> Tuple[str, list]:
+    """返回 (规范化后的 SQL, 原占位符名按 :p1、:p2… 的顺序)。
+
+    每个 SELECT 的选择列表（到同一层级的 FROM 等子句或右括号为止）除首尾空白外原样保留：
+    未写别名的列，列名就是表达式的原文（例如 sum(x) 与 SUM(x)、count( * ) 是不同的列名），
+    外层的 SELECT * 也会沿用子查询的列名。其中的占位符同样保留原名，只参与编号。"""
+    out = []
+    names = []
+    renamed = {}
+    pending_space = False
+    prev_op = False
+    depth = 0
+    select_depth = None   # 正在原样保留的选择列表所在的括号层级
+    raw_gap = ''          # 选择列表内尚未输出的空白与注释
+    for m in _TOKEN_RE.finditer(sql):
+        kind = m.lastgroup if m.lastgroup != 'name' else 'param'
+        token = m.group(0)
+        if select_depth is not None:
+            ends = depth == select_depth and (token == ')' or (kind == 'word' and token.lower() in _SELECT_LIST_END))
+            if not ends:
+                if kind in ('space', 'comment'):
+                    raw_gap += token
+                    continue
+                if kind == 'param' and m.group('name') not in renamed:
+                    names.append(m.group('name'))
+                    renamed[m.group('name')] = f':p{len(names)}'
+                depth += token == '('
+                depth -= token == ')'
+                # SELECT 与列表之间统一为一个空格，列表内部的空白与注释原样保留
+                out.append((' ' if out[-1] == 'SELECT' else raw_gap) + token)
+                raw_gap = ''
+                continue
+            select_depth = None
+            pending_space = pending_space or bool(raw_gap)
+            raw_gap = ''
+        if kind in ('space', 'comment'):
+            pending_space = True
+            continue
+        if kind == 'param':
+            name = m.group('name')
+            if name not in renamed:
+                names.append(name)
+                renamed[name] = f':p{len(names)}'
+            token = renamed[name]
+        elif kind == 'word' and token.lower() in KEYWORDS:
+            token = token.upper()
+        is_op = kind == 'op'
+        if (pending_space and out and out[-1] not in _TIGHT_AFTER and token not in _TIGHT_BEFORE
+                and (is_op == prev_op)):
+            out.append(' ')
+        pending_space = False
+        prev_op = is_op
+        out.append(token)
+        depth += token == '('
+        depth -= token == ')'
+        if token == 'SELECT':
+            select_depth = depth
+    return ''.join(out), names
+
+
+def cache_key(sql: str, params: dict) -> Tuple[str, str]:
+    """(规范化 SQL, 按占位符顺序的参数值 JSON)。params 的键为 SQL 中的原占位符名。"""
+    canonical, names = canonical_sql(sql)
+    values = json.dumps([params.get(n) for n in names], ensure_ascii=False, sort_keys=True, default=str)
+    return canonical, values
+
+
+def bump_table_version(conn, table_name: str):
+    """在 conn 的事务中把 table_name 的数据版本加一（版本表不存在时创建）。"""
+    _versions.create(conn, checkfirst=True)
+    updated = conn.execute(_versions.update().where(_versions.c.table_name == table_name)
+                           .values(version=_versions.c.version + 1)).rowcount
+    if not updated:
+        conn.execute(_versions.insert().values(table_name=table_name, version=1))
+
+
+def read_data_versions(conn) -> tuple:
+    """所有表的数据版本 ((表名, 版本), ...)，按表名排序；版本表不存在（从未用 loader.py 导入过）时为空。
+    任一张表重新导入都会改变返回值，因此查询哪张表的缓存结果都会作废。"""
+    try:
+        rows = conn.execute(select(_versions.c.table_name, _versions.c.version).order_by(_versions.c.table_name))
+        return tuple((name, int(version)) for name, version in rows)
+    except SQLAlchemyError:
+        return ()
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 256, max_bytes: int = 32 * 1024 * 1024,
+                 max_entry_bytes: int = 1024 * 1024, ttl: float = 300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_entry_bytes > 0
+
+    def _check_version(self, version: Hashable):
+        # 调用方持有锁
+        if version != self._version:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+
+    def get(self, key: Hashable, version: Hashable):
+        with self._lock:
+            self._check_version(version)
+            item = self._entries.get(key)
+            if item is not None and self.ttl > 0 and time.time() - item[2] > self.ttl:
+                self._bytes -= item[1]
+                del self._entries[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, version: Hashable, value, size: int) -> bool:
+        """缓存 value（size 为其序列化后的字节数）；超过单条上限时不缓存并返回 False。
+        计算期间版本已变化（或缓存被清空）时同样不缓存，旧数据算出的结果不会写回。"""
+        with self._lock:
+            if size > self.max_entry_bytes:
+                self.rejected += 1
+                return False
+            if version != self._version:
+                return False
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size, time.time())
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses,
+                    'rejected': self.rejected, 'version': self._version}
@@ -0,0 +1,83 @@
+"""
+省 → 中间维度（季节、年龄段等）→ 病种 的桑基图（/api/sankey）。
+
+一次分组查询（省 × 中间维度取值 × 病种 的病例数之和）用 np.add.at 累加成稠密数组 counts[省, 取值, 病种]，
+之后的 Top-K 与连线权重都是数组运算：
+
+- 省按全部病例数取前 top_provinces 个，病种按这些省内的病例数取前 top_diseases 个（与前端原先的口径一致）；
+  Top-K 用 np.argpartition 做部分选择，只对选出的 K 个排序；
+- 省 → 取值 的权重只计入选中的病种，取值 → 病种 的权重只计入选中的省，因此中间节点的流入与流出相等；
+- 没有流量的取值与连线省略。
+
+返回 ECharts series-sankey 直接使用的 nodes（name 与 depth）与 links（source / target 为节点下标）。
+"""
+from typing import Iterable, List, Sequence
+
+import numpy as np
+
+UNKNOWN = 'Unknown'
+
+
+def _name(value) -> str:
+    return UNKNOWN if value is None else str(value).strip() or UNKNOWN
+
+
+def top_k(totals: np.ndarray, k: int) -> np.ndarray:
+    """totals 中最大的 k 个的下标，按数值降序（相同时按下标升序）。"""
+    n = len(totals)
+    if k <= 0 or n == 0:
+        return np.zeros(0, dtype=np.int64)
+    idx = np.arange(n) if k >= n else np.argpartition(-totals, k - 1)[:k]
+    return idx[np.lexsort((idx, -totals[idx]))]
+
+
+class SankeyCube:
+    """稠密的 省 × 中间维度取值 × 病种 病例数。"""
+
+    def __init__(self, provinces: List[str], middles: List[str], diseases: List[str], counts: np.ndarray):
+        self.provinces = provinces
+        self.middles = middles
+        self.diseases = diseases
+        self.counts = counts
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Sequence], middle_order=None) -> 'SankeyCube':
+        """rows 为 (省, 取值, 病种, 病例数)；middle_order 为中间维度取值的排序键（默认按出现顺序）。"""
+        prov_ix, mid_ix, dis_ix = {}, {}, {}
+        codes, weights = [], []
+        for province, middle, disease, cases in rows:
+            codes.append((prov_ix.setdefault(_name(province), len(prov_ix)),
+                          mid_ix.setdefault(_name(middle), len(mid_ix)),
+                          dis_ix.setdefault(_name(disease), len(dis_ix))))
+            weights.append(float(cases or 0))
+        counts = np.zeros((len(prov_ix), len(mid_ix), len(dis_ix)))
+        if codes:
+            np.add.at(counts, tuple(np.asarray(codes).T), np.asarray(weights))
+        middles = list(mid_ix)
+        if middle_order is not None:
+            order = sorted(range(len(middles)), key=lambda i: middle_order(middles[i]))
+            middles = [middles[i] for i in order]
+            counts = counts[:, order, :]
+        return cls(list(prov_ix), middles, list(dis_ix), counts)
+
+    def graph(self, top_provinces: int, top_diseases: int) -> dict:
+        p_sel = top_k(self.counts.sum(axis=(1, 2)), top_provinces)
+        sub = self.counts[p_sel]
+        d_sel = top_k(sub.sum(axis=(0, 1)), top_diseases)
+        sub = sub[:, :, d_sel]
+        p_mid = sub.sum(axis=2)   # [省, 取值]
+        mid_d = sub.sum(axis=0)   # [取值, 病种]
+        m_sel = np.nonzero(p_mid.sum(axis=0) > 0)[0]
+
+        nodes = [{'name': self.provinces[i], 'depth': 0} for i in p_sel]
+        nodes += [{'name': self.middles[i], 'depth': 1} for i in m_sel]
+        nodes += [{'name': self.diseases[i], 'depth': 2} for i in d_sel]
+        m_base, d_base = len(p_sel), len(p_sel) + len(m_sel)
+
+        links = []
+        for src_base, dst_base, weights in ((0, m_base, p_mid[:, m_sel]), (m_base, d_base, mid_d[m_sel])):
+            for i, j in zip(*np.nonzero(weights > 0)):
+                links.append({'source': src_base + int(i), 'target': dst_base + int(j),
+                              'value': int(round(float(weights[i, j])))})
+        return {'nodes': nodes, 'links': links,
+                'total': int(round(float(p_mid.sum())))}
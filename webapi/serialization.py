@@ -0,0 +1,254 @@
+"""
+响应的编码格式协商与压缩。
+
+- JSON：安装了 orjson 时用 orjson 直接序列化（不经过 jsonable_encoder），否则退回标准库 json，
+  两者输出格式相同（紧凑分隔符、不转义非 ASCII）；
+- MessagePack（需要 msgpack）：客户端 Accept: application/msgpack 时返回，结构与 JSON 相同；
+- Arrow IPC 流（需要 pyarrow）：只用于表格型结果（execute_sql、disease_locations），
+  Accept: application/vnd.apache.arrow.stream 时返回；
+- 压缩：Accept-Encoding 含 br（需要 brotli）或 gzip 且响应体不小于阈值时压缩。
+  缓存的响应由调用方按表示形式记住压缩结果（见 app.py 的 _etag_response），
+  其余响应由 CompressionMiddleware 在发送时压缩；流式响应（SSE / NDJSON / CSV 分块）不压缩，以免被缓冲。
+
+msgpack、pyarrow、brotli 都是可选依赖：没有安装时对应格式不参与协商，客户端得到 JSON / gzip。
+"""
+import datetime
+import gzip
+import json
+from decimal import Decimal
+from typing import Dict, Iterable, Optional, Sequence
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+ARROW = 'application/vnd.apache.arrow.stream'
+MEDIA_TYPES = {'json': JSON, 'msgpack': MSGPACK, 'arrow': ARROW}
+_MEDIA_ALIASES = {JSON: 'json', MSGPACK: 'msgpack', 'application/x-msgpack': 'msgpack',
+                  'application/vnd.msgpack': 'msgpack', ARROW: 'arrow'}
+
+GZIP_LEVEL = 6
+# brotli 默认的 11 级对大响应太慢；4-5 级压缩率已优于 gzip，速度相当
+BROTLI_QUALITY = 5
+COMPRESSIBLE_TYPES = ('application/json', 'application/msgpack', 'application/vnd.apache.arrow', 'text/')
+
+_pyarrow = None
+
+
+def _arrow():
+    """延迟导入 pyarrow（体积大、导入慢，只有请求 Arrow 格式时才需要）；未安装时返回 None。"""
+    global _pyarrow
+    if _pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.ipc  # noqa: F401
+        except ImportError:
+            _pyarrow = False
+        else:
+            _pyarrow = pyarrow
+    return _pyarrow or None
+
+
+def available(fmt: str) -> bool:
+    if fmt == 'msgpack':
+        return msgpack is not None
+    if fmt == 'arrow':
+        return _arrow() is not None
+    return fmt == 'json'
+
+
+def _default(o):
+    # 数据库驱动与 NumPy 返回的非 JSON 原生类型；取值规则与 jsonable_encoder 一致
+    if isinstance(o, Decimal):
+        return float(o)
+    if isinstance(o, (datetime.date, datetime.time)):
+        return o.isoformat()
+    if isinstance(o, bytes):
+        return o.decode('utf-8', errors='ignore')
+    if isinstance(o, (set, frozenset, tuple)):
+        return list(o)
+    if hasattr(o, 'dict'):
+        # pydantic 模型（按 response_model 校验后的结果）
+        return o.dict()
+    if hasattr(o, 'item'):
+        # NumPy 标量
+        return o.item()
+    raise TypeError(f'Object of type {type(o).__name__} is not serializable')
+
+
+def dumps_json(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    from fastapi.encoders import jsonable_encoder
+    return json.dumps(jsonable_encoder(data), ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads_json(body: bytes):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+def dumps_msgpack(data) -> bytes:
+    return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+def _parse_header(value: Optional[str]) -> Dict[str, float]:
+    """'a, b;q=0.5' -> {'a': 1.0, 'b': 0.5}（小写，同一项出现多次取最大 q）。"""
+    out = {}
+    for part in (value or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for p in params.split(';'):
+            k, _, v = p.strip().partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        out[name] = max(q, out.get(name, 0.0))
+    return out
+
+
+def negotiate_format(accept: Optional[str], offered: Sequence[str] = ('json',)) -> str:
+    """在 offered 中按 Accept 头（含 q 值）选择格式；相同 q 值时按 offered 的顺序。
+    没有可接受的格式（或所需的可选依赖未安装）时返回 'json'，不返回 406。"""
+    ranges = _parse_header(accept)
+    if not ranges:
+        return 'json'
+    best, best_q = 'json', 0.0
+    for fmt in offered:
+        if not available(fmt):
+            continue
+        media = MEDIA_TYPES[fmt]
+        names = [m for m, f in _MEDIA_ALIASES.items() if f == fmt]
+        q = max([ranges[n] for n in names if n in ranges]
+                + [ranges[k] for k in (media.split('/')[0] + '/*', '*/*') if k in ranges] + [0.0])
+        if q > best_q:
+            best, best_q = fmt, q
+    return best
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """优先 br（已安装 brotli 时），其次 gzip；客户端都不接受时返回 None。"""
+    ranges = _parse_header(accept_encoding)
+    for coding in ('br', 'gzip'):
+        if coding == 'br' and brotli is None:
+            continue
+        q = ranges.get(coding, ranges.get('*', 0.0))
+        if q > 0:
+            return coding
+    return None
+
+
+def compress(body: bytes, coding: str) -> bytes:
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def compressible(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.lower().startswith(COMPRESSIBLE_TYPES)
+
+
+# ---------- Arrow ----------
+
+def _arrow_column(pa, values: list):
+    """按取值推断列类型；混合类型（例如同一列既有数字又有字符串）时整列转为字符串。"""
+    values = [float(v) if isinstance(v, Decimal) else v for v in values]
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+def arrow_stream(columns: Sequence[str], rows: Iterable[Sequence], metadata: Optional[dict] = None) -> bytes:
+    """按行给出的表格 -> Arrow IPC 流格式的字节；metadata 写入 schema 的元数据（值转为字符串）。"""
+    pa = _arrow()
+    rows = list(rows)
+    arrays = [_arrow_column(pa, [r[i] for r in rows]) for i in range(len(columns))]
+    table = pa.Table.from_arrays(arrays, names=list(columns))
+    if metadata:
+        table = table.replace_schema_metadata({k: '' if v is None else str(v) for k, v in metadata.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+# ---------- 压缩中间件 ----------
+
+class CompressionMiddleware:
+    """压缩未经 _etag_response 处理（没有 Content-Encoding）的完整响应。
+    只在第一段响应体就是全部内容（more_body 为假）时压缩，流式响应原样透传。"""
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        coding = negotiate_encoding(headers.get('accept-encoding'))
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        passthrough = False
+
+        async def wrapped_send(message):
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] != 'http.response.body' or start is None:
+                await send(message)
+                return
+            body = message.get('body', b'')
+            response_headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in start.get('headers', [])}
+            if (message.get('more_body') or len(body) < self.minimum_size or 'content-encoding' in response_headers
+                    or not compressible(response_headers.get('content-type'))):
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+            body = compress(body, coding)
+            raw = [(k, v) for k, v in start.get('headers', []) if k.lower() not in (b'content-length', b'etag', b'vary')]
+            raw += [(b'content-encoding', coding.encode()), (b'content-length', str(len(body)).encode()),
+                    (b'vary', _vary(response_headers.get('vary'), 'Accept-Encoding').encode('latin-1'))]
+            if 'etag' in response_headers:
+                # 不同的内容编码是不同的表示形式，原 ETag 只能作为弱 ETag
+                etag = response_headers['etag']
+                raw.append((b'etag', (etag if etag.startswith('W/') else 'W/' + etag).encode('latin-1')))
+            passthrough = True
+            await send({**start, 'headers': raw})
+            await send({**message, 'body': body})
+
+        await self.app(scope, receive, wrapped_send)
+
+
+def _vary(existing: Optional[str], name: str) -> str:
+    parts = [p.strip() for p in (existing or '').split(',') if p.strip()]
+    if name.lower() not in (p.lower() for p in parts):
+        parts.append(name)
+    return ', '.join(parts)
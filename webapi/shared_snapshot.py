@@ -0,0 +1,242 @@
+"""
+多个 uvicorn worker 共享的只读数据快照（DATA_BACKEND=shared）。
+
+一个进程（持有 leader 锁的 worker，或单独运行的 python shared_snapshot.py publish）把数据集写成
+快照文件：每个文件是一段 JSON 头（列名、字典等元数据与各数组的位置）加上按 64 字节对齐的原始数组。
+其它 worker 以只读方式 mmap 同一个文件，np.frombuffer 直接引用映射的内存，不复制；
+文件默认放在 /dev/shm（tmpfs）下，所有进程共用同一份物理页，worker 数增加时内存基本不变。
+
+current.json 记录当前代号（generation）与各数据集的文件名，通过写临时文件 + os.replace 原子更新；
+worker 发现代号变化后映射新文件并整体替换引用。旧文件只保留 keep 代：
+已经映射的进程不受删除影响（Linux 上映射在最后一个引用释放前一直有效）。
+
+不使用 multiprocessing.shared_memory：其段的生命周期由 resource_tracker 管理，
+彼此独立启动的 worker 退出时可能把仍在使用的段一并删除。
+"""
+import datetime
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows：没有 flock，每个 worker 各自发布
+    fcntl = None
+
+MAGIC = b'MAPSNAP1'
+ALIGN = 64
+POINTER = 'current.json'
+
+
+def default_directory() -> str:
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'map-data-api')
+
+
+def _encode(value):
+    # 字典中可能出现的非 JSON 类型（MySQL 的 DECIMAL / DATE 列）
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='ignore')
+    raise TypeError(f'cannot serialize {type(value).__name__}')
+
+
+def _decode(obj: dict):
+    if '__decimal__' in obj:
+        return Decimal(obj['__decimal__'])
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    if '__date__' in obj:
+        return datetime.date.fromisoformat(obj['__date__'])
+    return obj
+
+
+def _aligned(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_snapshot(path: str, arrays: Dict[str, np.ndarray], meta: dict):
+    """把 arrays 与 meta 写入 path（先写临时文件再替换）。"""
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    layout, offset = {}, 0
+    for name, arr in arrays.items():
+        layout[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset = _aligned(offset + arr.nbytes)
+    header = json.dumps({'meta': meta, 'arrays': layout}, default=_encode, ensure_ascii=False).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, arr in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            arr.tofile(f)
+        f.truncate(data_start + offset)
+    os.chmod(tmp, 0o600)
+    os.replace(tmp, path)
+
+
+def open_snapshot(path: str) -> Tuple[Dict[str, np.ndarray], dict]:
+    """只读映射 path，返回 (arrays, meta)；数组直接引用映射的内存（只读）。"""
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a snapshot file')
+    (header_len,) = struct.unpack_from('<Q', mm, len(MAGIC))
+    header_start = len(MAGIC) + 8
+    header = json.loads(mm[header_start:header_start + header_len].decode('utf-8'), object_hook=_decode)
+    data_start = _aligned(header_start + header_len)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[name] = np.frombuffer(mm, dtype=dtype, count=count,
+                                     offset=data_start + spec['offset']).reshape(spec['shape'])
+    return arrays, header['meta']
+
+
+class SnapshotStore:
+    """一个目录下的快照：publish 写入新一代，attach 映射当前代。"""
+
+    def __init__(self, directory: Optional[str] = None, keep: int = 2):
+        self.directory = directory or default_directory()
+        self.keep = max(keep, 1)
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self._leader_fd = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _locked(self, name: str):
+        with open(self._path(name), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def try_lead(self) -> bool:
+        """非阻塞地获取 leader 锁（进程存活期间一直持有）；已是 leader 时返回 True。"""
+        if self._leader_fd is not None:
+            return True
+        if fcntl is None:
+            return True
+        fd = os.open(self._path('leader.lock'), os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._leader_fd = fd
+        return True
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader_fd is not None or fcntl is None
+
+    def pointer(self) -> Optional[dict]:
+        try:
+            with open(self._path(POINTER)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def publish(self, datasets: Dict[str, Tuple[Dict[str, np.ndarray], dict]]) -> int:
+        """写入新一代快照（datasets：名称 -> (arrays, meta)），返回代号。多个进程同时发布时依次进行。"""
+        with self._locked('publish.lock'):
+            generation = int((self.pointer() or {}).get('generation') or 0) + 1
+            files = {}
+            for name, (arrays, meta) in datasets.items():
+                files[name] = f'{name}-{generation}.snap'
+                write_snapshot(self._path(files[name]), arrays, meta)
+            pointer = {'generation': generation, 'files': files, 'published_at': time.time(), 'pid': os.getpid()}
+            tmp = self._path(f'{POINTER}.{os.getpid()}.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(pointer, f)
+            os.replace(tmp, self._path(POINTER))
+            self._cleanup(generation)
+        return generation
+
+    def _cleanup(self, generation: int):
+        for name in os.listdir(self.directory):
+            stem, _, ext = name.rpartition('.')
+            if ext != 'snap' or '-' not in stem:
+                continue
+            try:
+                gen = int(stem.rsplit('-', 1)[1])
+            except ValueError:
+                continue
+            if gen <= generation - self.keep:
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+    def attach(self, known_generation: Optional[int] = None):
+        """当前代与 known_generation 不同时返回 (代号, {名称: (arrays, meta)})，否则返回 None。
+        映射期间该代已被清理（发布过于频繁）时也返回 None，下次再试。"""
+        pointer = self.pointer()
+        if not pointer or pointer.get('generation') == known_generation:
+            return None
+        try:
+            datasets = {name: open_snapshot(self._path(fname)) for name, fname in pointer['files'].items()}
+        except FileNotFoundError:
+            return None
+        return pointer['generation'], datasets
+
+    def status(self) -> dict:
+        pointer = self.pointer() or {}
+        files = {}
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.snap'):
+                files[name] = os.path.getsize(self._path(name))
+        return {'directory': self.directory, 'generation': pointer.get('generation'),
+                'published_at': pointer.get('published_at'), 'publisher_pid': pointer.get('pid'),
+                'current_files': pointer.get('files'), 'files': files}
+
+
+def pack_water(data) -> Tuple[Dict[str, np.ndarray], dict]:
+    """WaterMatrix -> (arrays, meta)。"""
+    return ({'X': data.X, 'province_codes': np.asarray(data.province_codes, dtype=np.int32)},
+            {'features': list(data.features), 'provinces': list(data.provinces)})
+
+
+def unpack_water(arrays: Dict[str, np.ndarray], meta: dict):
+    from water_pca import WaterMatrix
+    return WaterMatrix(meta['features'], arrays['X'], arrays['province_codes'], meta['provinces'])
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Publish or inspect the shared data snapshot.')
+    parser.add_argument('command', choices=['publish', 'status'])
+    parser.add_argument('--dir', help='snapshot directory (default: SHARED_SNAPSHOT_DIR or /dev/shm/map-data-api)')
+    args = parser.parse_args(argv)
+    if args.dir:
+        os.environ['SHARED_SNAPSHOT_DIR'] = args.dir
+    if args.command == 'status':
+        print(json.dumps(SnapshotStore(os.environ.get('SHARED_SNAPSHOT_DIR')).status(), indent=2))
+        return
+    # 作为独立的加载进程发布：与 worker 使用同一套读取逻辑
+    os.environ['DATA_BACKEND'] = 'shared'
+    import app
+    print(json.dumps(app.publish_shared_snapshot(), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+/api/execute_sql（模型生成的 SQL）的执行预算。
+
+- 代价检查：执行前先 EXPLAIN（目前支持 MySQL / MariaDB 的传统格式），按嵌套循环估算
+  扫描行数（每张表的 rows 乘以它之前各表过滤后的行数，再求和）与连接产生的行数（同一 SELECT 内
+  各表 rows × filtered 的乘积），任一项超过预算即拒绝，返回结构化的错误说明；
+  其它数据库没有可用的行数估计，跳过这一步，只靠下面的超时兜底；
+- 语句超时：MySQL 在语句上加 /*+ MAX_EXECUTION_TIME(ms) */ 提示，连接建立时再设置会话级
+  max_execution_time（MariaDB 为 max_statement_time）作为兜底；SQLite（本地测试用）用进度回调
+  在超时后中断语句。超时覆盖服务端游标的整个读取过程；
+- 并发上限由 app.py 中 execute_sql 专用的小连接池（max_overflow=0）保证，取不到连接时返回 503。
+"""
+import re
+import time
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy import event, text
+
+# MySQL ER_QUERY_TIMEOUT、MariaDB ER_STATEMENT_TIMEOUT
+_TIMEOUT_ERRNOS = (3024, 1969)
+_SQLITE_INTERRUPT = 9
+_LEADING_SELECT_RE = re.compile(r'^\s*select\b', re.IGNORECASE)
+
+
+class PlanCost:
+    """EXPLAIN 得到的代价估计。plan 为便于阅读的逐表说明。"""
+
+    def __init__(self, scan_rows: float, join_rows: float, plan: List[str]):
+        self.scan_rows = scan_rows
+        self.join_rows = join_rows
+        self.plan = plan
+
+
+def _number(value, default: float) -> float:
+    try:
+        return float(value) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+
+
+def plan_cost(rows: Sequence[Dict]) -> PlanCost:
+    """按 MySQL 传统 EXPLAIN 的各行（id, table, type, rows, filtered, Extra）估算代价。
+    id 相同的行属于同一个 SELECT，按输出顺序是嵌套循环的连接顺序；只有一张表的 SELECT 不计入连接行数。"""
+    scan_rows = 0.0
+    join_rows = 0.0
+    fanout: Dict[object, float] = {}
+    tables: Dict[object, int] = {}
+    plan = []
+    for r in rows:
+        key = r.get('id')
+        n = _number(r.get('rows'), 1.0)
+        prefix = fanout.get(key, 1.0)
+        scan_rows += prefix * n
+        fanout[key] = prefix * n * _number(r.get('filtered'), 100.0) / 100
+        tables[key] = tables.get(key, 0) + 1
+        if tables[key] > 1:
+            join_rows = max(join_rows, fanout[key])
+        plan.append(f"{r.get('table')}: type={r.get('type')} rows={r.get('rows')} "
+                    f"filtered={r.get('filtered')} {r.get('Extra') or ''}".strip())
+    return PlanCost(scan_rows, join_rows, plan)
+
+
+def explain_cost(conn, sql: str, params: dict) -> Optional[PlanCost]:
+    """在 conn 上 EXPLAIN；不支持的数据库返回 None。"""
+    if conn.dialect.name not in ('mysql', 'mariadb'):
+        return None
+    rows = [dict(r) for r in conn.execute(text(f'EXPLAIN {sql}'), params).mappings()]
+    return plan_cost(rows)
+
+
+def check_budget(cost: Optional[PlanCost], max_scan_rows: int, max_join_rows: int) -> Optional[dict]:
+    """超出预算时返回结构化的错误说明，否则返回 None。预算为 0 表示不限制。"""
+    if cost is None:
+        return None
+    if max_scan_rows > 0 and cost.scan_rows > max_scan_rows:
+        message = f'查询预计扫描约 {int(cost.scan_rows):,} 行，超过上限 {max_scan_rows:,} 行'
+    elif max_join_rows > 0 and cost.join_rows > max_join_rows:
+        message = f'查询的连接预计产生约 {int(cost.join_rows):,} 行，超过上限 {max_join_rows:,} 行'
+    else:
+        return None
+    return {'code': 'query_too_expensive', 'message': message,
+            'hint': '请增加过滤条件（省份、病种、年份等）、先聚合再连接，或缩小查询范围',
+            'estimated_rows': int(cost.scan_rows), 'estimated_join_rows': int(cost.join_rows),
+            'max_scan_rows': max_scan_rows, 'max_join_rows': max_join_rows, 'plan': cost.plan}
+
+
+def add_execution_time_hint(sql: str, timeout_ms: int, dialect: str) -> str:
+    """MySQL：在最外层 SELECT 之后加 MAX_EXECUTION_TIME 优化器提示；其它数据库原样返回。"""
+    if timeout_ms <= 0 or dialect != 'mysql':
+        return sql
+    return _LEADING_SELECT_RE.sub(lambda m: f'{m.group(0)} /*+ MAX_EXECUTION_TIME({int(timeout_ms)}) */', sql, count=1)
+
+
+def install_statement_timeout(engine, timeout_ms: int):
+    """为 engine 上的每条语句设置超时（见模块说明）。"""
+    if timeout_ms <= 0:
+        return
+    dialect = engine.dialect.name
+    if dialect in ('mysql', 'mariadb'):
+        @event.listens_for(engine, 'connect')
+        def _session_timeout(dbapi_conn, record):
+            cursor = dbapi_conn.cursor()
+            try:
+                for stmt in (f'SET SESSION max_execution_time = {int(timeout_ms)}',
+                             f'SET SESSION max_statement_time = {timeout_ms / 1000:.3f}'):
+                    try:
+                        cursor.execute(stmt)
+                        break
+                    except Exception:
+                        # 服务器不认识该变量（MySQL / MariaDB 各有其一）；语句上的提示仍然生效
+                        continue
+            finally:
+                cursor.close()
+    elif dialect == 'sqlite':
+        @event.listens_for(engine, 'before_cursor_execute')
+        def _deadline(conn, cursor, statement, parameters, context, executemany):
+            deadline = time.monotonic() + timeout_ms / 1000
+            cursor.connection.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+
+        @event.listens_for(engine, 'checkin')
+        def _clear_deadline(dbapi_conn, record):
+            if dbapi_conn is not None:
+                dbapi_conn.set_progress_handler(None, 0)
+
+
+def is_timeout(exc: BaseException) -> bool:
+    """exc（SQLAlchemy 包装后的异常或驱动异常）是否为语句超时。"""
+    orig = getattr(exc, 'orig', None) or exc
+    args = getattr(orig, 'args', ())
+    if args and args[0] in _TIMEOUT_ERRNOS:
+        return True
+    return getattr(orig, 'sqlite_errorcode', None) == _SQLITE_INTERRUPT
@@ -0,0 +1,433 @@
+"""
+按 public/ 下两个 CSV 学到的分布生成任意行数的合成数据，用于规模测试（基准测试、索引、汇总表）。
+
+china_disease_data（每行独立抽样）：
+- Disease × Province × Age_Group 的联合分布取样本频率，并混入 SMOOTHING 比例的边缘分布乘积，
+  使样本中没出现过的组合也有小概率出现；
+- Gender、Month 按病种的条件分布，Season 按 Month 的条件分布，Year 取边缘分布，
+  Urban_Rural 与 Region_Code 按省份的条件分布；
+- Hospitalized 按病种的比例，其余 12 个标志列按 (病种, 是否住院) 的比例，取值沿用原文件的写法；
+- (Reported_Cases, Deaths) 按病种成对重抽样，Days_Hospitalized 按 (病种, 是否住院) 重抽样。
+
+china_water_pollution_data（每个站点一段逐日时间序列）：
+- 站点均值向全局均值收缩（样本少的站点更接近全局），残差按列标准化后取相关矩阵，
+  各列按 AR(1) 演化（滞后一阶自相关取自同站相邻两次读数），新息按相关矩阵相关；
+- 超出原站点数量的序列复制已有站点并加后缀、微调经纬度；
+- 取值截到样本的最小/最大值，按原文件的小数位数取整；Pollution_Level 按 Water_Quality_Index
+  所在的五分位区间的条件分布，Remarks 取边缘分布。
+
+生成是确定的：每个分区（disease）或每个站点序列（water）的随机数种子由 (--seed, 表, 分区/序列号)
+派生，与 --jobs 无关；disease 的结果与 --partition-rows 有关。各分区由进程池并行生成，
+输出为 <out>/<表>/part-00000.csv（或 .parquet，需要 pyarrow），可选 --db-url 直接经 loader.py 导入。
+
+用法：
+    python synth.py disease --rows 10000000 --out data --jobs 8
+    python synth.py water --rows 1000000 --format parquet
+    python synth.py disease --rows 1000000 --db-url sqlite:///bench.db
+"""
+import argparse
+import csv
+import datetime
+import json
+import math
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from flags import FLAG_COLUMNS, TRUTH_VALUES
+from loader import TABLES
+
+DISEASE_TABLE = 'china_disease_data'
+WATER_TABLE = 'china_water_pollution_data'
+TABLE_ALIASES = {'disease': DISEASE_TABLE, 'water': WATER_TABLE}
+_TABLE_IDS = {DISEASE_TABLE: 1, WATER_TABLE: 2}
+
+PARTITION_ROWS = 1_000_000
+DAYS_PER_STATION = 365
+# 联合分布中混入的边缘分布乘积比例
+SMOOTHING = 0.05
+# 站点均值向全局均值收缩的强度（相当于多少条全局读数）
+SHRINK = 5.0
+START_DATE = datetime.date(2023, 1, 1)
+# 复制站点时经纬度的扰动幅度（度）
+JITTER_DEGREES = 0.05
+_WATER_TEXT = ('Province', 'City', 'Monitoring_Station', 'Latitude', 'Longitude', 'Date', 'Pollution_Level', 'Remarks')
+
+
+def _read(path: str) -> List[dict]:
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return list(csv.DictReader(f))
+
+
+def _probs(counter: Counter, keys: Sequence) -> np.ndarray:
+    p = np.array([counter.get(k, 0) for k in keys], dtype=float)
+    return p / p.sum() if p.sum() else np.full(len(keys), 1.0 / len(keys))
+
+
+def _cdf_table(pairs, groups: Sequence, values: Sequence, fallback: Optional[Counter] = None) -> np.ndarray:
+    """按组的条件分布 → 累积概率表（组数 × 取值数）。空的组使用 fallback（默认为全体）的分布。"""
+    by_group = defaultdict(Counter)
+    overall = Counter()
+    for g, v in pairs:
+        by_group[g][v] += 1
+        overall[v] += 1
+    fallback = fallback or overall
+    table = np.array([_probs(by_group[g] if by_group[g] else fallback, values) for g in groups])
+    return np.cumsum(table, axis=1)
+
+
+def _pick(rng, cdf: np.ndarray, group: np.ndarray) -> np.ndarray:
+    u = rng.random(len(group))
+    return np.minimum((u[:, None] > cdf[group]).sum(axis=1), cdf.shape[1] - 1)
+
+
+def _pools(pairs, groups: Sequence, overall: list):
+    """按组重抽样的池：把各组样本拼接起来，返回 (池, 各组起点, 各组大小)。空组指向全体样本。"""
+    by_group = defaultdict(list)
+    for g, v in pairs:
+        by_group[g].append(v)
+    pool, offsets, sizes = [], [], []
+    for g in groups:
+        items = by_group.get(g) or overall
+        offsets.append(len(pool))
+        sizes.append(len(items))
+        pool.extend(items)
+    return np.array(pool), np.array(offsets), np.array(sizes)
+
+
+def _draw(rng, pools, group: np.ndarray) -> np.ndarray:
+    pool, offsets, sizes = pools
+    return pool[offsets[group] + (rng.random(len(group)) * sizes[group]).astype(np.int64)]
+
+
+def _spellings(values: List[str]):
+    """原文件中“是”与“否”最常见的写法。"""
+    yes = Counter(v for v in values if v.strip(' ').lower() in TRUTH_VALUES)
+    no = Counter(v for v in values if v.strip(' ').lower() not in TRUTH_VALUES)
+    return (yes.most_common(1)[0][0] if yes else 'Yes'), (no.most_common(1)[0][0] if no else 'No')
+
+
+def disease_model(path: Optional[str] = None) -> dict:
+    rows = _read(path or TABLES[DISEASE_TABLE].csv_path)
+    diseases = sorted({r['Disease'] for r in rows})
+    provinces = sorted({r['Province'] for r in rows})
+    ages = sorted({r['Age_Group'] for r in rows})
+    d_ix = {v: i for i, v in enumerate(diseases)}
+    p_ix = {v: i for i, v in enumerate(provinces)}
+
+    joint = Counter((r['Disease'], r['Province'], r['Age_Group']) for r in rows)
+    cells = [(d, p, a) for d in diseases for p in provinces for a in ages]
+    empirical = _probs(joint, cells)
+    marg = [_probs(Counter(r[c] for r in rows), keys)
+            for c, keys in (('Disease', diseases), ('Province', provinces), ('Age_Group', ages))]
+    product = np.einsum('i,j,k->ijk', *marg).ravel()
+    joint_p = (1 - SMOOTHING) * empirical + SMOOTHING * product
+
+    genders = sorted({r['Gender'] for r in rows})
+    months = sorted({int(r['Month']) for r in rows})
+    seasons = sorted({r['Season'] for r in rows})
+    years = sorted({int(r['Year']) for r in rows})
+    urban = sorted({r['Urban_Rural'] for r in rows})
+    hosp_yes = [1 if r['Hospitalized'].strip(' ').lower() in TRUTH_VALUES else 0 for r in rows]
+    # (病种, 是否住院) 组：病种编号 * 2 + 是否住院
+    dh = [d_ix[r['Disease']] * 2 + h for r, h in zip(rows, hosp_yes)]
+    flags = [c for c in FLAG_COLUMNS if c != 'Hospitalized']
+    flag_rates = np.zeros((len(diseases) * 2, len(flags)))
+    for j, col in enumerate(flags):
+        hits, totals = np.zeros(len(diseases) * 2), np.zeros(len(diseases) * 2)
+        for g, r in zip(dh, rows):
+            totals[g] += 1
+            hits[g] += r[col].strip(' ').lower() in TRUTH_VALUES
+        overall = hits.sum() / max(totals.sum(), 1)
+        flag_rates[:, j] = np.where(totals > 0, hits / np.maximum(totals, 1), overall)
+    hosp_rate = np.array([np.mean([h for r, h in zip(rows, hosp_yes) if r['Disease'] == d]) for d in diseases])
+
+    cases = [(int(r['Reported_Cases']), int(r['Deaths'])) for r in rows]
+    days = [int(r['Days_Hospitalized']) for r in rows]
+    codes = [int(r['Region_Code']) for r in rows]
+    return {
+        'diseases': diseases, 'provinces': provinces, 'ages': ages, 'joint_cdf': np.cumsum(joint_p),
+        'genders': genders, 'gender_cdf': _cdf_table(((d_ix[r['Disease']], r['Gender']) for r in rows), range(len(diseases)), genders),
+        'months': months, 'month_cdf': _cdf_table(((d_ix[r['Disease']], int(r['Month'])) for r in rows), range(len(diseases)), months),
+        'seasons': seasons, 'season_cdf': _cdf_table(((int(r['Month']), r['Season']) for r in rows), months, seasons),
+        'years': years, 'year_cdf': np.cumsum(_probs(Counter(int(r['Year']) for r in rows), years)),
+        'urban': urban, 'urban_cdf': _cdf_table(((p_ix[r['Province']], r['Urban_Rural']) for r in rows), range(len(provinces)), urban),
+        'hosp_rate': hosp_rate, 'flags': flags, 'flag_rates': flag_rates,
+        'spellings': {c: _spellings([r[c] for r in rows]) for c in FLAG_COLUMNS},
+        'cases': _pools(((d_ix[r['Disease']], i) for i, r in enumerate(rows)), range(len(diseases)), list(range(len(rows)))),
+        'case_pairs': np.array(cases, dtype=np.int64),
+        'days': _pools(zip(dh, days), range(len(diseases) * 2), days),
+        'codes': _pools(((p_ix[r['Province']], c) for r, c in zip(rows, codes)), range(len(provinces)), codes),
+    }
+
+
+def disease_partition(model: dict, seed: int, part: int, rows: int) -> Dict[str, list]:
+    """一个分区的列（列名 → 取值列表），列顺序与 loader.TABLES 的声明一致。"""
+    rng = np.random.default_rng(np.random.SeedSequence([seed, _TABLE_IDS[DISEASE_TABLE], part]))
+    n_p, n_a = len(model['provinces']), len(model['ages'])
+    cell = np.minimum(np.searchsorted(model['joint_cdf'], rng.random(rows), side='right'), len(model['joint_cdf']) - 1)
+    disease, province, age = cell // (n_p * n_a), (cell // n_a) % n_p, cell % n_a
+    gender = _pick(rng, model['gender_cdf'], disease)
+    month_i = _pick(rng, model['month_cdf'], disease)
+    season = _pick(rng, model['season_cdf'], month_i)
+    year = np.minimum(np.searchsorted(model['year_cdf'], rng.random(rows), side='right'), len(model['years']) - 1)
+    urban = _pick(rng, model['urban_cdf'], province)
+    hosp = (rng.random(rows) < model['hosp_rate'][disease]).astype(np.int64)
+    dh = disease * 2 + hosp
+    flag_hits = rng.random((rows, len(model['flags']))) < model['flag_rates'][dh]
+    pairs = model['case_pairs'][_draw(rng, model['cases'], disease)]
+
+    def spell(col, hits):
+        yes, no = model['spellings'][col]
+        return np.where(hits, yes, no).tolist()
+
+    def names(values, idx):
+        return np.array(values, dtype=object)[idx].tolist()
+
+    out = {
+        'Disease': names(model['diseases'], disease), 'Province': names(model['provinces'], province),
+        'Age_Group': names(model['ages'], age), 'Gender': names(model['genders'], gender),
+        'Reported_Cases': pairs[:, 0].tolist(), 'Deaths': pairs[:, 1].tolist(),
+        'Hospitalized': spell('Hospitalized', hosp == 1),
+        'Month': np.array(model['months'])[month_i].tolist(), 'Year': np.array(model['years'])[year].tolist(),
+        'Season': names(model['seasons'], season), 'Urban_Rural': names(model['urban'], urban),
+    }
+    for j, col in enumerate(model['flags']):
+        out[col] = spell(col, flag_hits[:, j])
+    out['Days_Hospitalized'] = _draw(rng, model['days'], dh).tolist()
+    out['Region_Code'] = _draw(rng, model['codes'], province).tolist()
+    return {col: out[col] for col, _ in TABLES[DISEASE_TABLE].columns}
+
+
+def _decimals(values: List[str]) -> int:
+    return max((len(v.split('.', 1)[1]) for v in values if '.' in v), default=0)
+
+
+def water_model(path: Optional[str] = None) -> dict:
+    rows = _read(path or TABLES[WATER_TABLE].csv_path)
+    features = [c for c in rows[0] if c not in _WATER_TEXT]
+    X = np.array([[float(r[c]) if r[c].strip() else np.nan for c in features] for r in rows])
+    col_mean = np.nanmean(X, axis=0)
+    X = np.where(np.isnan(X), col_mean, X)
+
+    stations = defaultdict(list)
+    for i, r in enumerate(rows):
+        stations[r['Monitoring_Station']].append(i)
+    names = sorted(stations)
+    means, meta = [], []
+    resid = np.empty_like(X)
+    for name in names:
+        idx = stations[name]
+        n = len(idx)
+        mean = (X[idx].sum(axis=0) + SHRINK * col_mean) / (n + SHRINK)
+        means.append(mean)
+        resid[idx] = X[idx] - mean
+        first = rows[idx[0]]
+        meta.append((first['Province'], first['City'], float(first['Latitude']), float(first['Longitude'])))
+    std = resid.std(axis=0, ddof=1)
+    std[std == 0] = 1.0
+    Z = resid / std
+    corr = np.corrcoef(Z, rowvar=False)
+    # 保证正定，便于 Cholesky 分解
+    chol = np.linalg.cholesky(corr + np.eye(len(features)) * 1e-9)
+
+    # 滞后一阶自相关：同一站点按日期排序后的相邻读数
+    lag_a, lag_b = [], []
+    for name in names:
+        idx = sorted(stations[name], key=lambda i: rows[i]['Date'])
+        lag_a.extend(idx[:-1])
+        lag_b.extend(idx[1:])
+    phi = np.zeros(len(features))
+    if lag_a:
+        a, b = Z[lag_a], Z[lag_b]
+        denom = np.sqrt((a * a).sum(axis=0) * (b * b).sum(axis=0))
+        phi = np.where(denom > 0, (a * b).sum(axis=0) / np.where(denom > 0, denom, 1), 0.0)
+    phi = np.clip(phi, 0.0, 0.99)
+
+    wqi = features.index('Water_Quality_Index') if 'Water_Quality_Index' in features else None
+    levels = sorted({r['Pollution_Level'] for r in rows})
+    bins = np.quantile(X[:, wqi], [0.2, 0.4, 0.6, 0.8]) if wqi is not None else np.array([])
+    level_groups = np.searchsorted(bins, X[:, wqi], side='right') if wqi is not None else np.zeros(len(rows), int)
+    remarks = Counter(r['Remarks'] for r in rows)
+    return {
+        'features': features, 'station_names': names, 'station_meta': meta, 'station_means': np.array(means),
+        'std': std, 'chol': chol, 'phi': phi, 'low': X.min(axis=0), 'high': X.max(axis=0),
+        'decimals': [_decimals([r[c] for r in rows]) for c in features],
+        'wqi': wqi, 'wqi_bins': bins, 'levels': levels,
+        'level_cdf': _cdf_table(((g, r['Pollution_Level']) for g, r in zip(level_groups, rows)), range(len(bins) + 1), levels),
+        'remarks': list(remarks), 'remark_cdf': np.cumsum(_probs(remarks, list(remarks))),
+    }
+
+
+def water_series(model: dict, seed: int, series: int, days: int) -> Dict[str, list]:
+    """第 series 条站点序列（从 START_DATE 起连续 days 天）。"""
+    rng = np.random.default_rng(np.random.SeedSequence([seed, _TABLE_IDS[WATER_TABLE], series]))
+    n_st = len(model['station_names'])
+    template, copy = series % n_st, series // n_st
+    name = model['station_names'][template]
+    province, city, lat, lon = model['station_meta'][template]
+    if copy:
+        name = f'{name}_{copy}'
+        lat += rng.uniform(-JITTER_DEGREES, JITTER_DEGREES)
+        lon += rng.uniform(-JITTER_DEGREES, JITTER_DEGREES)
+
+    p = len(model['features'])
+    phi = model['phi']
+    shocks = rng.standard_normal((days, p)) @ model['chol'].T
+    z = np.empty((days, p))
+    z[0] = shocks[0]
+    scale = np.sqrt(1 - phi * phi)
+    for t in range(1, days):
+        z[t] = phi * z[t - 1] + scale * shocks[t]
+    values = np.clip(model['station_means'][template] + z * model['std'], model['low'], model['high'])
+
+    wqi = model['wqi']
+    if wqi is not None:
+        group = np.searchsorted(model['wqi_bins'], values[:, wqi], side='right')
+    else:
+        group = np.zeros(days, dtype=np.int64)
+    level = _pick(rng, model['level_cdf'], group)
+    remark = np.minimum(np.searchsorted(model['remark_cdf'], rng.random(days), side='right'), len(model['remarks']) - 1)
+
+    out = {'Province': [province] * days, 'City': [city] * days, 'Monitoring_Station': [name] * days,
+           'Latitude': [round(lat, 6)] * days, 'Longitude': [round(lon, 6)] * days,
+           'Date': [(START_DATE + datetime.timedelta(days=t)).isoformat() for t in range(days)]}
+    for j, col in enumerate(model['features']):
+        dec = model['decimals'][j]
+        column = np.round(values[:, j], dec)
+        out[col] = column.astype(np.int64).tolist() if dec == 0 else column.tolist()
+    out['Pollution_Level'] = np.array(model['levels'], dtype=object)[level].tolist()
+    out['Remarks'] = np.array(model['remarks'], dtype=object)[remark].tolist()
+    return {col: out[col] for col, _ in TABLES[WATER_TABLE].columns}
+
+
+def _write(columns: Dict[str, list], path: str, fmt: str):
+    if fmt == 'parquet':
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError('Parquet output requires pyarrow (pip install pyarrow)')
+        pq.write_table(pa.table(columns), path)
+        return
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(columns))
+        writer.writerows(zip(*columns.values()))
+
+
+# 子进程内缓存的模型（每个进程只学习一次）
+_models: Dict[str, dict] = {}
+
+
+def _model(table: str) -> dict:
+    if table not in _models:
+        _models[table] = disease_model() if table == DISEASE_TABLE else water_model()
+    return _models[table]
+
+
+def _partition_job(table: str, seed: int, part: int, first: int, count: int, days: int, path: str, fmt: str) -> int:
+    """写一个分区：disease 为 count 行；water 为从第 first 条起的 count 条序列（最后一条可截短）。"""
+    model = _model(table)
+    if table == DISEASE_TABLE:
+        columns = disease_partition(model, seed, part, count)
+    else:
+        columns = defaultdict(list)
+        remaining = count
+        series = first
+        while remaining > 0:
+            for col, values in water_series(model, seed, series, days).items():
+                columns[col].extend(values[:remaining])
+            remaining -= days
+            series += 1
+        columns = dict(columns)
+    _write(columns, path, fmt)
+    return len(next(iter(columns.values())))
+
+
+def plan(table: str, rows: int, partition_rows: int = PARTITION_ROWS, days: int = DAYS_PER_STATION) -> List[tuple]:
+    """[(分区号, 起点, 行数)]。water 的分区按整条序列切分，起点为序列号。"""
+    parts = []
+    if table == DISEASE_TABLE:
+        for part, start in enumerate(range(0, rows, partition_rows)):
+            parts.append((part, start, min(partition_rows, rows - start)))
+        return parts
+    per_part = max(partition_rows // days, 1)
+    n_series = math.ceil(rows / days)
+    for part, first in enumerate(range(0, n_series, per_part)):
+        series_rows = min(per_part * days, rows - first * days)
+        parts.append((part, first, series_rows))
+    return parts
+
+
+def generate(table: str, rows: int, out_dir: str, seed: int = 0, jobs: Optional[int] = None, fmt: str = 'csv',
+             partition_rows: int = PARTITION_ROWS, days: int = DAYS_PER_STATION) -> dict:
+    """生成 rows 行写到 <out_dir>/<表>/，返回 {files, rows, seconds, rows_per_sec, ...}。"""
+    table = TABLE_ALIASES.get(table, table)
+    if table not in _TABLE_IDS:
+        raise ValueError(f'unknown table {table}; known: {sorted(TABLE_ALIASES)}')
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError(f'unknown format {fmt}')
+    target = os.path.join(out_dir, table)
+    os.makedirs(target, exist_ok=True)
+    for name in os.listdir(target):
+        if name.startswith('part-'):
+            os.remove(os.path.join(target, name))
+
+    started = time.time()
+    parts = plan(table, rows, partition_rows, days)
+    paths = [os.path.join(target, f'part-{part:05d}.{fmt}') for part, _, _ in parts]
+    args = [(table, seed, part, first, count, days, path, fmt) for (part, first, count), path in zip(parts, paths)]
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(parts) == 1:
+        written = [_partition_job(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(parts))) as pool:
+            written = list(pool.map(_partition_job, *zip(*args)))
+    elapsed = time.time() - started
+    return {'table': table, 'format': fmt, 'seed': seed, 'rows': sum(written), 'files': paths,
+            'seconds': round(elapsed, 3), 'rows_per_sec': round(sum(written) / max(elapsed, 1e-9), 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate seeded synthetic disease / water-pollution data.')
+    parser.add_argument('table', choices=sorted(TABLE_ALIASES))
+    parser.add_argument('--rows', type=int, required=True)
+    parser.add_argument('--out', default='synthetic', help='output directory (files go to <out>/<table>/)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, help='worker processes (default: CPU count)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--partition-rows', type=int, default=PARTITION_ROWS)
+    parser.add_argument('--days-per-station', type=int, default=DAYS_PER_STATION,
+                        help='length of each water station series')
+    parser.add_argument('--db-url', help='also append the generated CSV partitions to this database via loader.py')
+    parser.add_argument('--method', choices=['executemany', 'infile'], default='executemany',
+                        help='loader method for --db-url')
+    args = parser.parse_args(argv)
+    if args.db_url and args.format != 'csv':
+        parser.error('--db-url needs --format csv')
+
+    try:
+        result = generate(args.table, args.rows, args.out, args.seed, args.jobs, args.format,
+                          args.partition_rows, args.days_per_station)
+    except (RuntimeError, ValueError) as e:
+        parser.exit(1, f'error: {e}\n')
+    print(f"{result['table']}: {result['rows']} rows in {result['seconds']}s", file=sys.stderr)
+    if args.db_url:
+        from sqlalchemy import create_engine
+
+        from loader import load_csv
+        connect_args = {'local_infile': True} if args.method == 'infile' else {}
+        engine = create_engine(args.db_url, connect_args=connect_args)
+        result['loaded'] = [load_csv(engine, result['table'], path, 'append', args.method)['rows']
+                            for path in result['files']]
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
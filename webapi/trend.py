@@ -0,0 +1,160 @@
+"""
+按年月的病例时间序列（/api/trend）。
+
+一次分组查询（省 × 病种 × 年 × 月 的病例数与死亡数之和）构建稠密数组 values[省, 病种, 月份, 指标]：
+月份轴从最早到最晚的年月连续排列，没有数据的月份补 0。各项统计沿时间轴向量化计算，
+前面的维度任意（单个序列、全部 (省, 病种) 对、按省或按病种合计都是同一段代码）：
+
+- rolling_sum / rolling_mean：最近 window 个月之和 / 均值（不足 window 个月时为 null）；
+- yoy_delta / yoy_pct：与 12 个月前相比的差值 / 变化率（上年同月为 0 时变化率为 null）；
+- seasonal_index：各自然月的月均值除以全部月份的均值（1 表示与平均水平持平）。
+
+构建时按默认窗口预先算好所有 (省, 病种)、每个省、每个病种以及全国合计的统计，
+常见请求只需取出对应的行；其它窗口在请求时现算。
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+METRICS = ('cases', 'deaths')
+DEFAULT_WINDOW = 3
+MAX_WINDOW = 36
+_STATS = ('rolling_sum', 'rolling_mean', 'yoy_delta', 'yoy_pct')
+
+
+def _key(value) -> Optional[str]:
+    return str(value).strip().lower() if value is not None else None
+
+
+def series_stats(values: np.ndarray, month_of_year: np.ndarray, window: int) -> Dict[str, np.ndarray]:
+    """values 为 (..., T) 的逐月数值，month_of_year 为各月份的自然月（0-11）；缺失记为 NaN。"""
+    values = np.asarray(values, dtype=np.float64)
+    T = values.shape[-1]
+    csum = np.cumsum(values, axis=-1)
+    rolling = np.full(values.shape, np.nan)
+    if 0 < window <= T:
+        head = np.zeros(values.shape[:-1] + (1,))
+        before = np.concatenate([head, csum[..., :T - window]], axis=-1)
+        rolling[..., window - 1:] = csum[..., window - 1:] - before
+    yoy = np.full(values.shape, np.nan)
+    pct = np.full(values.shape, np.nan)
+    if T > 12:
+        prev = values[..., :-12]
+        yoy[..., 12:] = values[..., 12:] - prev
+        np.divide(yoy[..., 12:], prev, out=pct[..., 12:], where=prev > 0)
+    # 自然月的 one-hot 矩阵：月均值 = values @ onehot / 各自然月出现的次数
+    onehot = np.zeros((T, 12))
+    onehot[np.arange(T), month_of_year] = 1.0
+    months_seen = onehot.sum(axis=0)
+    month_mean = np.divide(values @ onehot, months_seen, out=np.full(values.shape[:-1] + (12,), np.nan),
+                           where=months_seen > 0)
+    overall = values.mean(axis=-1, keepdims=True) if T else np.zeros(values.shape[:-1] + (1,))
+    seasonal = np.divide(month_mean, overall, out=np.full(month_mean.shape, np.nan), where=overall > 0)
+    return {'rolling_sum': rolling, 'rolling_mean': rolling / window, 'yoy_delta': yoy, 'yoy_pct': pct,
+            'seasonal_index': seasonal, 'total': values.sum(axis=-1)}
+
+
+def _as_list(arr: np.ndarray, digits: int = 4) -> list:
+    return [None if np.isnan(v) else round(float(v), digits) for v in arr]
+
+
+class TrendCube:
+    """稠密的 省 × 病种 × 月份 × 指标 数组与预先计算的统计。"""
+
+    def __init__(self, provinces: List[str], diseases: List[str], first_period: int, values: np.ndarray,
+                 window: int = DEFAULT_WINDOW):
+        self.provinces = provinces
+        self.diseases = diseases
+        self._province_ix = {_key(p): i for i, p in enumerate(provinces)}
+        self._disease_ix = {_key(d): i for i, d in enumerate(diseases)}
+        # 月份序号 = 年 * 12 + (月 - 1)
+        periods = first_period + np.arange(values.shape[2])
+        self.periods = [f'{p // 12:04d}-{p % 12 + 1:02d}' for p in periods]
+        self.month_of_year = periods % 12
+        self.values = values
+        self.window = window
+        # 按默认窗口预先计算：(省, 病种)、按省合计、按病种合计、全国合计
+        self._precomputed = {}
+        for m, metric in enumerate(METRICS):
+            v = values[..., m]
+            for level, arr in (('pair', v), ('province', v.sum(axis=1)), ('disease', v.sum(axis=0)),
+                               ('all', v.sum(axis=(0, 1)))):
+                self._precomputed[(metric, level)] = series_stats(arr, self.month_of_year, window)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Sequence], window: int = DEFAULT_WINDOW) -> 'TrendCube':
+        """rows 为 (省, 病种, 年, 月, 病例数, 死亡数)；年或月为空或不是整数的行忽略。"""
+        prov_ix, dis_ix = {}, {}
+        p_codes, d_codes, periods, sums = [], [], [], []
+        for province, disease, year, month, cases, deaths in rows:
+            try:
+                period = int(year) * 12 + int(month) - 1
+            except (TypeError, ValueError):
+                continue
+            if not 1 <= int(month) <= 12:
+                continue
+            p_codes.append(prov_ix.setdefault(province, len(prov_ix)))
+            d_codes.append(dis_ix.setdefault(disease, len(dis_ix)))
+            periods.append(period)
+            sums.append((float(cases or 0), float(deaths or 0)))
+        provinces, diseases = list(prov_ix), list(dis_ix)
+        if not periods:
+            return cls(provinces, diseases, 0, np.zeros((len(provinces), len(diseases), 0, len(METRICS))), window)
+        periods = np.asarray(periods)
+        first = int(periods.min())
+        values = np.zeros((len(provinces), len(diseases), int(periods.max()) - first + 1, len(METRICS)))
+        # 同一 (省, 病种, 月) 可能出现多行（例如省名大小写不同时由调用方合并前），累加即可
+        np.add.at(values, (np.asarray(p_codes), np.asarray(d_codes), periods - first), np.asarray(sums))
+        return cls(provinces, diseases, first, values, window)
+
+    def _indices(self, names: Optional[Sequence[str]], lookup: dict) -> List[Optional[int]]:
+        return [lookup.get(_key(n)) for n in names] if names else []
+
+    def series(self, provinces: Optional[Sequence[str]] = None, diseases: Optional[Sequence[str]] = None,
+               metric: str = 'cases', window: Optional[int] = None) -> List[dict]:
+        """provinces 与 diseases 都给出时每个 (省, 病种) 一条序列；只给一种时按它逐个（另一维合计）；
+        都不给时为全国合计。不存在的省/病种返回全 0 序列。"""
+        if metric not in METRICS:
+            raise ValueError(f'unknown metric {metric}; expected one of {METRICS}')
+        window = window or self.window
+        m = METRICS.index(metric)
+        p_ix = self._indices(provinces, self._province_ix)
+        d_ix = self._indices(diseases, self._disease_ix)
+        if provinces and diseases:
+            level, keys = 'pair', [(p, d, i, j) for p, i in zip(provinces, p_ix) for d, j in zip(diseases, d_ix)]
+        elif provinces:
+            level, keys = 'province', [(p, None, i, None) for p, i in zip(provinces, p_ix)]
+        elif diseases:
+            level, keys = 'disease', [(None, d, None, j) for d, j in zip(diseases, d_ix)]
+        else:
+            level, keys = 'all', [(None, None, None, None)]
+
+        v = self.values[..., m]
+        base = {'pair': v, 'province': v.sum(axis=1), 'disease': v.sum(axis=0), 'all': v.sum(axis=(0, 1))}[level]
+        if window == self.window:
+            stats = self._precomputed[(metric, level)]
+        else:
+            stats = series_stats(base, self.month_of_year, window)
+        zeros = np.zeros(len(self.periods))
+        empty = series_stats(zeros, self.month_of_year, window)
+
+        out = []
+        for province, disease, i, j in keys:
+            if level == 'pair':
+                at = (i, j) if i is not None and j is not None else None
+            elif level == 'province':
+                at = (i,) if i is not None else None
+            elif level == 'disease':
+                at = (j,) if j is not None else None
+            else:
+                at = ()
+            src, values = (stats, base[at]) if at is not None else (empty, zeros)
+            item = {'province': self.provinces[i] if i is not None else province,
+                    'disease': self.diseases[j] if j is not None else disease,
+                    'total': int(round(float(src['total'][at] if at is not None else 0))),
+                    'values': [int(round(x)) for x in values]}
+            for name in _STATS:
+                item[name] = _as_list(src[name][at] if at is not None else src[name])
+            item['seasonal_index'] = _as_list(src['seasonal_index'][at] if at is not None else src['seasonal_index'])
+            out.append(item)
+        return out
@@ -0,0 +1,183 @@
+"""
+LLM 代理端点共用的上游 HTTP 客户端。
+
+- 基于 httpx.AsyncClient：连接池 + keep-alive，后续请求复用已建立的 TCP/TLS 连接；
+- 主机名解析结果按 dns_ttl 缓存：连接池建立新连接时经由 _CachedDNSBackend 使用同一份缓存，
+  请求前的可达性预检（resolve）也读它，因此两者都不会每次重新 getaddrinfo。TLS 的 SNI 与证书校验
+  仍按原主机名进行（httpcore 以请求的主机名做 server_hostname，与连接的 IP 无关）；
+- 每个端点可配置独立超时；
+- 用信号量限制同时进行的上游请求数量，避免突发流量把上游或本机连接数打满。
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional
+
+import httpcore
+import httpx
+
+
+class _CachedDNSBackend(httpcore.AsyncNetworkBackend):
+    """httpcore 的网络后端：建立 TCP 连接前用 UpstreamClient.resolve 的缓存解析主机名，
+    依次尝试各个地址；其余操作交给默认的 anyio 后端。"""
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addrs = await self._resolve(host)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e)) from e
+        error = None
+        for addr in addrs:
+            try:
+                return await self._backend.connect_tcp(addr, port, timeout=timeout, local_address=local_address,
+                                                       socket_options=socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                error = e
+        raise error or httpcore.ConnectError(f'no address for {host}')
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+# httpcore 异常 -> httpx 异常（子类在前），调用方只需处理 httpx 的异常层次
+_EXCEPTIONS = (
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout), (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout), (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.TimeoutException, httpx.TimeoutException), (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError), (httpcore.WriteError, httpx.WriteError),
+    (httpcore.NetworkError, httpx.NetworkError), (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError), (httpcore.ProtocolError, httpx.ProtocolError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+)
+
+
+@contextmanager
+def _map_exceptions():
+    try:
+        yield
+    except Exception as e:
+        for core_exc, httpx_exc in _EXCEPTIONS:
+            if isinstance(e, core_exc):
+                raise httpx_exc(str(e)) from e
+        raise
+
+
+class _ResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream):
+        self._stream = stream
+
+    async def __aiter__(self):
+        with _map_exceptions():
+            async for part in self._stream:
+                yield part
+
+    async def aclose(self):
+        if hasattr(self._stream, 'aclose'):
+            await self._stream.aclose()
+
+
+class _PoolTransport(httpx.AsyncBaseTransport):
+    """把 httpcore 连接池包装成 httpx 的传输层（只用 httpx / httpcore 的公开接口），
+    连接池可以使用自定义的网络后端。"""
+
+    def __init__(self, pool: httpcore.AsyncConnectionPool):
+        self._pool = pool
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=request.url.raw_scheme, host=request.url.raw_host, port=request.url.port,
+                             target=request.url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with _map_exceptions():
+            resp = await self._pool.handle_async_request(core_request)
+        return httpx.Response(status_code=resp.status, headers=resp.headers, stream=_ResponseStream(resp.stream),
+                              extensions=resp.extensions)
+
+    async def aclose(self):
+        await self._pool.aclose()
+
+
+class UpstreamClient:
+    def __init__(self, timeouts: Optional[Dict[str, float]] = None, default_timeout: float = 30,
+                 max_connections: int = 20, max_keepalive: int = 10, max_concurrency: int = 8,
+                 dns_ttl: float = 300):
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.max_concurrency = max_concurrency
+        self.dns_ttl = dns_ttl
+        self._client = None
+        self._sem = None
+        self._loop = None
+        self._dns = {}
+
+    def _transport(self) -> _PoolTransport:
+        # httpx.AsyncHTTPTransport 不接受 network_backend，因此直接建 httpcore 连接池（连接数上限与 keep-alive 在此设置）
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_keepalive)
+        return _PoolTransport(httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_CachedDNSBackend(self.resolve),
+        ))
+
+    async def _ensure(self):
+        # httpx.AsyncClient 与信号量都绑定在创建它们的事件循环上
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            old = self._client
+            self._client = httpx.AsyncClient(transport=self._transport(), timeout=self.default_timeout)
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+            if old is not None:
+                try:
+                    await old.aclose()
+                except Exception:
+                    # 旧事件循环已经结束时，其上的连接无法正常关闭，只能丢弃
+                    pass
+
+    def timeout_for(self, endpoint: str) -> float:
+        return self.timeouts.get(endpoint, self.default_timeout)
+
+    async def resolve(self, host: str) -> list:
+        """解析主机名（结果缓存 dns_ttl 秒）；解析失败抛出 OSError。"""
+        now = time.time()
+        cached = self._dns.get(host)
+        if cached and cached[0] > now:
+            return cached[1]
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None)
+        addrs = sorted({info[4][0] for info in infos})
+        self._dns[host] = (now + self.dns_ttl, addrs)
+        return addrs
+
+    async def post(self, endpoint: str, url: str, **kwargs) -> httpx.Response:
+        """以 endpoint 对应的超时发送 POST，并受并发上限约束。"""
+        await self._ensure()
+        async with self._sem:
+            return await self._client.post(url, timeout=self.timeout_for(endpoint), **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, endpoint: str, method: str, url: str, **kwargs):
+        """流式请求（响应体按块读取）；在整个读取过程中占用一个并发名额。"""
+        await self._ensure()
+        async with self._sem:
+            async with self._client.stream(method, url, timeout=self.timeout_for(endpoint), **kwargs) as resp:
+                yield resp
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,348 @@
+"""
+水质数据的第一主成分（PCA）省级得分，供地图的水质热力图层使用。
+
+与前端原先在浏览器里的实现（MapPieChart.vue 的 loadWaterQualityScores）口径一致：
+- 省份列按列名识别（province / 省份 / prov）；城市、日期、站点、经纬度、备注等列不参与计算；
+- 其余列只要出现过有效数字即视为数值列，非数字取值记为 NaN，全为 NaN 的列丢弃；
+- NaN 用列均值填充，按列标准化（样本标准差，标准差为 0 时按 1 处理）；
+- 取标准化数据协方差矩阵的最大特征向量为第一主成分，每行投影后按省取均值，
+  再线性缩放到 [SCALE_MIN, SCALE_MAX]。
+特征向量的符号本身没有意义，这里固定为与 Water_Quality_Index 同向（没有该列时载荷之和为正），
+保证数据不变时结果稳定。
+
+WaterStats 是同一计算的增量版本：维护按列对的计数、均值与协方差（Welford/Chan 合并）
+以及各省的计数与均值，追加一批数据只需 O(批大小) 的计算，随后由这些统计量直接得出
+载荷与省级得分，与在全部历史数据上调用 compute_scores 的结果一致（浮点误差内）。
+"""
+import csv
+import hashlib
+import math
+import os
+import re
+from array import array
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+SCALE_MIN = 45.0
+SCALE_MAX = 53.0
+UNKNOWN_PROVINCE = 'Unknown'
+IGNORE_COLUMNS = {'city', 'date', 'monitoring_station', 'latitude', 'longitude', 'lat', 'lon', 'remarks',
+                  'monitoring station'}
+_ORIENT_RE = re.compile(r'water[_ ]?quality|wqi|水质', re.I)
+
+
+def find_province_column(names: Sequence[str]) -> Optional[str]:
+    for n in names:
+        if re.search(r'province', n, re.I) or re.search(r'省份|省$', n):
+            return n
+    for n in names:
+        if re.search(r'prov', n, re.I):
+            return n
+    return None
+
+
+def _to_float(v) -> float:
+    if v is None or isinstance(v, bool):
+        return math.nan
+    if isinstance(v, (int, float)):
+        return float(v)
+    if isinstance(v, bytes):
+        v = v.decode('utf-8', errors='ignore')
+    try:
+        return float(str(v).strip() or 'nan')
+    except ValueError:
+        return math.nan
+
+
+class WaterMatrix:
+    """按行读入后的数值矩阵：X（n × p，float64，缺失为 NaN）、features（列名）、
+    province_codes（每行的省份编号）与 provinces（编号 → 省名）。"""
+
+    def __init__(self, features: List[str], X: np.ndarray, province_codes: np.ndarray, provinces: List[str]):
+        self.features = features
+        self.X = X
+        self.province_codes = province_codes
+        self.provinces = provinces
+
+    @property
+    def nrows(self) -> int:
+        return int(self.X.shape[0])
+
+    @classmethod
+    def from_rows(cls, names: Sequence[str], rows: Iterable[Sequence],
+                  features: Optional[Sequence[str]] = None) -> 'WaterMatrix':
+        """features 给定时按这些列（列名大小写不敏感，缺失的列全为 NaN）读取且不丢弃任何列，
+        用于把新追加的数据对齐到已有统计量的列。"""
+        names = [str(n) for n in names]
+        province = find_province_column(names)
+        pidx = names.index(province) if province else None
+        if features is None:
+            cand = [i for i, n in enumerate(names)
+                    if i != pidx and n and n.strip().lower() not in IGNORE_COLUMNS]
+        else:
+            pos = {n.lower(): i for i, n in enumerate(names)}
+            cand = [pos.get(f.lower(), len(names)) for f in features]
+        # array('d') 按列追加，比逐行保留 Python 对象省内存
+        cols = [array('d') for _ in cand]
+        codes = array('i')
+        lookup, provinces = {}, []
+        for row in rows:
+            name = row[pidx] if pidx is not None and pidx < len(row) else None
+            name = str(name) if name not in (None, '') else UNKNOWN_PROVINCE
+            code = lookup.get(name)
+            if code is None:
+                code = lookup[name] = len(provinces)
+                provinces.append(name)
+            codes.append(code)
+            for col, i in zip(cols, cand):
+                col.append(_to_float(row[i]) if i < len(row) else math.nan)
+        n = len(codes)
+        X = np.empty((n, len(cand)), dtype=np.float64)
+        for j, col in enumerate(cols):
+            X[:, j] = np.frombuffer(col, dtype=np.float64) if n else col
+        X[~np.isfinite(X)] = np.nan
+        codes = np.frombuffer(codes, dtype=np.int32).copy()
+        if features is not None:
+            return cls(list(features), X, codes, provinces)
+        keep = [j for j in range(len(cand)) if n and not np.isnan(X[:, j]).all()]
+        return cls([names[cand[j]] for j in keep], X[:, keep], codes, provinces)
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'WaterMatrix':
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            header = next(reader, None) or []
+            return cls.from_rows(header, (r for r in reader if r))
+
+    @classmethod
+    def from_result(cls, result, batch_size: int = 50000, features: Optional[Sequence[str]] = None) -> 'WaterMatrix':
+        """从 SQLAlchemy 查询结果分批（fetchmany）读取。"""
+        def batches():
+            while True:
+                chunk = result.fetchmany(batch_size)
+                if not chunk:
+                    break
+                yield from chunk
+        return cls.from_rows(list(result.keys()), batches(), features)
+
+
+def orient(loadings: np.ndarray, features: Sequence[str]) -> np.ndarray:
+    """固定特征向量的符号：与水质指数列同向，没有该列时载荷之和为正。"""
+    ref = next((j for j, f in enumerate(features) if _ORIENT_RE.search(f)), None)
+    sign = loadings[ref] if ref is not None and loadings[ref] != 0 else loadings.sum()
+    return -loadings if sign < 0 else loadings
+
+
+def first_component(cov: np.ndarray, features: Sequence[str]):
+    """标准化数据的协方差矩阵 → (第一主成分载荷, 解释方差占比)。"""
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    total = float(eigvals.sum())
+    loadings = orient(eigvecs[:, -1], features)
+    return loadings, (float(eigvals[-1]) / total if total > 0 else 0.0)
+
+
+def rescale(raw: dict, lo: float = SCALE_MIN, hi: float = SCALE_MAX) -> dict:
+    """省级均值线性缩放到 [lo, hi]；所有省相同时取中点。"""
+    vals = [v for v in raw.values() if math.isfinite(v)]
+    if not vals:
+        return {}
+    vmin, vmax = min(vals), max(vals)
+    if vmax == vmin:
+        return {k: (lo + hi) / 2 for k in raw}
+    return {k: lo + (v - vmin) / (vmax - vmin) * (hi - lo) for k, v in raw.items()}
+
+
+def compute_scores(data: WaterMatrix) -> dict:
+    """在完整数据上计算第一主成分与省级得分。"""
+    n, p = data.X.shape
+    result = {'rows': n, 'features': list(data.features), 'loadings': {}, 'explained_variance_ratio': None,
+              'raw': {}, 'scores': {}}
+    if n == 0 or p == 0:
+        return result
+    X = data.X
+    means = np.nanmean(X, axis=0)
+    filled = np.where(np.isnan(X), means, X)
+    centered = filled - means
+    ddof = 1 if n > 1 else 0
+    stds = np.sqrt((centered ** 2).sum(axis=0) / max(n - ddof, 1))
+    stds[stds == 0] = 1.0
+    Z = centered / stds
+    cov = (Z.T @ Z) / max(n - ddof, 1)
+    loadings, ratio = first_component(cov, data.features)
+    row_scores = Z @ loadings
+    counts = np.bincount(data.province_codes, minlength=len(data.provinces))
+    sums = np.bincount(data.province_codes, weights=row_scores, minlength=len(data.provinces))
+    raw = {name: float(sums[i] / counts[i]) for i, name in enumerate(data.provinces) if counts[i]}
+    result.update(loadings=dict(zip(data.features, loadings.tolist())), explained_variance_ratio=ratio,
+                  raw=raw, scores=rescale(raw))
+    return result
+
+
+def _pair_moments(X: np.ndarray):
+    """一批数据的按列对统计量：N[j,k] 为 j、k 同时有值的行数，A[j,k] 为这些行上 j 的均值，
+    C[j,k] 为这些行上 j、k 相对各自均值的离差积之和。先按本批列均值平移再求和，减小抵消误差。"""
+    mask = ~np.isnan(X)
+    M = mask.astype(np.float64)
+    counts = M.sum(axis=0)
+    shift = np.divide(np.where(mask, X, 0.0).sum(axis=0), counts, out=np.zeros(X.shape[1]), where=counts > 0)
+    X0 = np.where(mask, X - shift, 0.0)
+    N = M.T @ M
+    S = X0.T @ M
+    A0 = np.divide(S, N, out=np.zeros_like(S), where=N > 0)
+    C = X0.T @ X0 - N * A0 * A0.T
+    return N, A0 + shift[:, None], C
+
+
+class WaterStats:
+    """compute_scores 的增量版本。列（features）在创建时固定，之后追加的数据按列名对齐。"""
+
+    def __init__(self, features: Sequence[str]):
+        p = len(features)
+        self.features = list(features)
+        self.n = 0
+        self.N = np.zeros((p, p))
+        self.A = np.zeros((p, p))
+        self.C = np.zeros((p, p))
+        self.provinces: List[str] = []
+        self._province_index = {}
+        self.prov_n = np.zeros(0)
+        self.prov_count = np.zeros((0, p))
+        self.prov_mean = np.zeros((0, p))
+
+    @classmethod
+    def from_matrix(cls, data: WaterMatrix) -> 'WaterStats':
+        stats = cls(data.features)
+        stats.append(data)
+        return stats
+
+    def _province_codes(self, data: WaterMatrix) -> np.ndarray:
+        remap = np.empty(len(data.provinces), dtype=np.int64)
+        for i, name in enumerate(data.provinces):
+            idx = self._province_index.get(name)
+            if idx is None:
+                idx = self._province_index[name] = len(self.provinces)
+                self.provinces.append(name)
+            remap[i] = idx
+        grow = len(self.provinces) - self.prov_n.shape[0]
+        if grow > 0:
+            p = len(self.features)
+            self.prov_n = np.concatenate([self.prov_n, np.zeros(grow)])
+            self.prov_count = np.vstack([self.prov_count, np.zeros((grow, p))])
+            self.prov_mean = np.vstack([self.prov_mean, np.zeros((grow, p))])
+        return remap[data.province_codes]
+
+    def append(self, data: WaterMatrix):
+        """合并一批数据（data.features 需与 self.features 相同，可用 WaterMatrix.from_rows(..., features=) 对齐）。"""
+        if list(data.features) != self.features:
+            raise ValueError('feature columns do not match')
+        if data.nrows == 0:
+            return
+        X = data.X
+        # 按列对的 Chan 合并
+        Nb, Ab, Cb = _pair_moments(X)
+        N = self.N + Nb
+        delta = Ab - self.A
+        self.C = self.C + Cb + delta * delta.T * np.divide(self.N * Nb, N, out=np.zeros_like(N), where=N > 0)
+        self.A = self.A + delta * np.divide(Nb, N, out=np.zeros_like(N), where=N > 0)
+        self.N = N
+        self.n += data.nrows
+        # 各省的行数，以及每列有值的行数与均值
+        codes = self._province_codes(data)
+        P = len(self.provinces)
+        mask = ~np.isnan(X)
+        self.prov_n += np.bincount(codes, minlength=P)
+        for j in range(X.shape[1]):
+            sel = mask[:, j]
+            cnt = np.bincount(codes[sel], minlength=P).astype(np.float64)
+            tot = np.bincount(codes[sel], weights=X[sel, j], minlength=P)
+            new_count = self.prov_count[:, j] + cnt
+            batch_mean = np.divide(tot, cnt, out=np.zeros(P), where=cnt > 0)
+            self.prov_mean[:, j] += (batch_mean - self.prov_mean[:, j]) * np.divide(cnt, new_count, out=np.zeros(P), where=new_count > 0)
+            self.prov_count[:, j] = new_count
+
+    def result(self) -> dict:
+        """由累计的统计量得出与 compute_scores 相同结构的结果，耗时与历史行数无关。"""
+        n, p = self.n, len(self.features)
+        result = {'rows': n, 'features': list(self.features), 'loadings': {}, 'explained_variance_ratio': None,
+                  'raw': {}, 'scores': {}}
+        if n == 0 or p == 0:
+            return result
+        mu = np.diag(self.A).copy()
+        # 缺失值按列均值填充后离差为 0，所以只需各列对同时有值的行，但要以整列均值为中心
+        G = self.C + self.N * (self.A - mu[:, None]) * (self.A.T - mu[None, :])
+        denom = max(n - (1 if n > 1 else 0), 1)
+        stds = np.sqrt(np.maximum(np.diag(self.C), 0.0) / denom)
+        stds[stds == 0] = 1.0
+        cov = G / denom / np.outer(stds, stds)
+        loadings, ratio = first_component(cov, self.features)
+        contrib = (self.prov_count * (self.prov_mean - mu)) @ (loadings / stds)
+        raw = {name: float(contrib[i] / self.prov_n[i]) for i, name in enumerate(self.provinces) if self.prov_n[i]}
+        result.update(loadings=dict(zip(self.features, loadings.tolist())), explained_variance_ratio=ratio,
+                      raw=raw, scores=rescale(raw))
+        return result
+
+
+# ---------- 追加写入的 CSV ----------
+# 站点数据按天追加到 CSV 末尾时，只需读取上次读到的位置之后的新行。CsvCursor 记录已读到的
+# 字节位置、表头以及该位置之前一小段内容的哈希；文件被改写（而不是追加）时哈希不再匹配，调用方改为全量重算。
+_TAIL_CHECK_BYTES = 4096
+
+
+class CsvCursor:
+    __slots__ = ('path', 'header', 'offset', 'tail_hash')
+
+    def __init__(self, path: str, header: List[str], offset: int, tail_hash: str):
+        self.path = path
+        self.header = header
+        self.offset = offset
+        self.tail_hash = tail_hash
+
+
+def _tail_hash(f, end: int) -> str:
+    start = max(0, end - _TAIL_CHECK_BYTES)
+    f.seek(start)
+    return hashlib.sha1(f.read(end - start)).hexdigest()
+
+
+def _complete_end(f, size: int, offset: int) -> int:
+    """最后一个换行符之后的位置：正在写入的半行留到下一次读取。"""
+    pos = size
+    while pos > offset:
+        start = max(offset, pos - 65536)
+        f.seek(start)
+        idx = f.read(pos - start).rfind(b'\n')
+        if idx >= 0:
+            return start + idx + 1
+        pos = start
+    return offset
+
+
+def _read_lines(f, offset: int, end: int):
+    f.seek(offset)
+    remaining = end - offset
+    while remaining > 0:
+        line = f.readline(remaining)
+        if not line:
+            break
+        remaining -= len(line)
+        yield line.decode('utf-8', errors='replace')
+
+
+def read_csv(path: str, cursor: Optional[CsvCursor] = None,
+             features: Optional[Sequence[str]] = None) -> Tuple[Optional[WaterMatrix], Optional[CsvCursor]]:
+    """读取 CSV：cursor 为 None 时从头读取；否则只读取 cursor 之后追加的完整行（按 features 对齐）。
+    返回 (数据, 新 cursor)；文件不是在原内容之后追加时返回 (None, None)，调用方应全量重算。"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if cursor is not None:
+            if size < cursor.offset or _tail_hash(f, cursor.offset) != cursor.tail_hash:
+                return None, None
+            offset, header = cursor.offset, cursor.header
+        else:
+            first = f.readline()
+            header = next(csv.reader([first.decode('utf-8-sig')]), [])
+            offset = len(first)
+        end = _complete_end(f, size, offset)
+        data = WaterMatrix.from_rows(header, (r for r in csv.reader(_read_lines(f, offset, end)) if r), features)
+        return data, CsvCursor(path, header, end, _tail_hash(f, end))